@@ -0,0 +1,263 @@
+'''
+The IDR pipeline of the idr command as a library call, in memory.
+
+The command runs each step from its options, passing results between
+steps as files. IdrAnalysis takes Homer peaks as DataFrames or file
+names instead. It keeps the narrowPeak tables, cleaned peaks, and
+comparisons in memory from conversion through thresholding, with the
+numpy engine, and returns them. Nothing is written unless an output
+directory is given, and the number of peaks selected is returned rather
+than printed, so the pipeline can run inside a long-lived worker.
+
+    analysis = IdrAnalysis(genome='hg19')
+    result = analysis.run([rep_1, rep_2],
+                          pseudoreps=[(rep_1_pr1, rep_1_pr2),
+                                      (rep_2_pr1, rep_2_pr2)],
+                          pooled_pseudoreps=[(pooled_pr1, pooled_pr2)],
+                          pooled_peaks=pooled)
+    result['peaks']  # The top set of pooled peaks, with Rank and IDR
+'''
+from collections import OrderedDict
+import itertools
+import os
+
+import numpy as np
+from pandas import DataFrame, Series
+
+from idr.compression import open_file, split_name
+from idr.idr_engine import IdrEngine
+from idr.overlap import PeakOverlapper
+from idr import profiling
+from idr.utils import IdrUtilities
+
+class IdrAnalysis(object):
+    '''
+    Converts, truncates, compares, and thresholds peaks in memory.
+    '''
+    # Groups of comparisons, with the directory each is written to.
+    groups = OrderedDict((('replicates', 'replicate_comparisons'),
+                          ('pseudoreps', 'pseudorep_comparisons'),
+                          ('pooled', 'pooled_comparisons')))
+
+    def __init__(self, ranking_measure='tag-count', threshold=None,
+                 pooled_threshold=None, genome=None, em_acceleration=None,
+                 warm_start=False, uri_points=100, seed=None,
+                 output_dir=None, columnar=False, compress=False):
+        '''
+        Options are those of the idr command. ranking_measure is
+        tag-count or p-value; thresholds not passed are determined from
+        the number of peaks compared. Pass output_dir to also write the
+        comparisons and the top set of pooled peaks there, in the
+        layout of the idr command.
+        '''
+        self.ranking_measure = ranking_measure
+        self.threshold = threshold
+        self.pooled_threshold = pooled_threshold
+        self.warm_start = warm_start
+        self.output_dir = output_dir
+        self.engine = IdrEngine(genome=genome, seed=seed,
+                                columnar=columnar, compress=compress,
+                                em_acceleration=em_acceleration,
+                                uri_points=uri_points)
+        self.idrutils = IdrUtilities()
+
+    def run(self, replicates, pseudoreps=(), pooled_pseudoreps=(),
+            pooled_peaks=None):
+        '''
+        replicates: the Homer peaks of each replicate, as DataFrames
+            or file names, in a list or in a dict by name.
+        pseudoreps: the (pseudorep 1, pseudorep 2) pair of peaks of each
+            replicate, likewise.
+        pooled_pseudoreps: the pairs of pooled pseudoreplicate peaks.
+        pooled_peaks: the Homer peaks of the pooled replicates to
+            select the final peaks from, or None.
+
+        Returns a dict of:
+            narrowpeaks: the truncated narrowPeak tables of each group.
+            comparisons: the comparisons of each group; see compare.
+            threshold, pooled_threshold: the IDR thresholds used.
+            counts: for each group, the greatest number of peaks within
+                its threshold in any comparison.
+            peaks: the top set of pooled peaks, in rank order, with Rank
+                and IDR columns, or None.
+            number_of_peaks: the number of peaks in the top set, or None.
+            output_file: the top set file written, if any.
+        '''
+        peak_sets = [self.get_named_peaks(replicates, 'Rep'),
+                     self.get_named_pairs(pseudoreps, 'Pseudorep'),
+                     self.get_named_pairs(pooled_pseudoreps, 'Pooled')]
+        if not peak_sets[0]: raise Exception('Pass at least one replicate.')
+        if pooled_peaks is not None and len(peak_sets[0]) < 2:
+            raise Exception('Pass at least two replicates to select '
+                            + 'pooled peaks.')
+
+        with profiling.stage('convert'):
+            tables = [self.idrutils.homer_to_narrow_peaks(
+                            self.read_homer_peaks(peaks))
+                      for peak_set in peak_sets for _, peaks in peak_set]
+        tables = self.idrutils.truncate_tables(tables)
+        narrowpeaks, start = OrderedDict(), 0
+        for group, peak_set in zip(self.groups, peak_sets):
+            narrowpeaks[group] = tables[start:start + len(peak_set)]
+            start += len(peak_set)
+        result = {'narrowpeaks': narrowpeaks}
+
+        # Each table is cleaned and indexed once, for all its pairs.
+        with profiling.stage('read peaks'):
+            reps = [self.engine.process_narrow_peaks(table)
+                    for table in tables]
+            genome, indexes = PeakOverlapper(genome=self.engine.genome)\
+                                    .index_peaks(*reps)
+        comparisons, start = OrderedDict(), 0
+        for group, peak_set in zip(self.groups, peak_sets):
+            names = [name for name, _ in peak_set]
+            positions = range(start, start + len(peak_set))
+            if group == 'replicates':
+                pairs = itertools.combinations(positions, 2)
+            else: pairs = zip(positions[::2], positions[1::2])
+            comparisons[group] = self.compare(
+                            [(names[i - start], names[j - start],
+                              reps[i], reps[j], (indexes[i], indexes[j]))
+                             for i, j in pairs], genome, group)
+            start += len(peak_set)
+        result['comparisons'] = comparisons
+
+        self.threshold_peaks(result, len(tables[0]), pooled_peaks)
+        return result
+
+    def get_named_peaks(self, peaks, prefix):
+        '''
+        (name, peaks) for each of a list or dict of peaks. Files are
+        named for their base names, and tables by prefix and position.
+        '''
+        if isinstance(peaks, dict): return list(peaks.items())
+        return [(self.get_name(p, '{}{}'.format(prefix, i + 1)), p)
+                for i, p in enumerate(peaks)]
+
+    def get_named_pairs(self, pairs, prefix):
+        '''
+        (name, peaks) for each of a list or dict of pairs of peaks,
+        pairs kept together.
+        '''
+        if isinstance(pairs, dict): pairs = list(pairs.items())
+        else: pairs = [('{}{}'.format(prefix, i + 1), pair)
+                       for i, pair in enumerate(pairs)]
+        named = []
+        for name, pair in pairs:
+            if len(pair) != 2:
+                raise Exception('Pass pseudoreplicates in pairs; '
+                                + '{} has {} peak sets.'.format(name,
+                                                                len(pair)))
+            named.extend((self.get_name(peaks, '{}-{}'.format(name, i + 1)),
+                          peaks) for i, peaks in enumerate(pair))
+        return named
+
+    def get_name(self, peaks, default):
+        if isinstance(peaks, str): return split_name(peaks)[0]
+        return default
+
+    def read_homer_peaks(self, peaks):
+        if isinstance(peaks, DataFrame): return peaks
+        return self.idrutils.import_homer_peaks(peaks)
+
+    def compare(self, pairs, genome, group):
+        '''
+        Compare each (name_1, name_2, rep_1, rep_2, indexes).
+
+        Returns a list of dicts, one per comparison, of: name_1 and
+        name_2; the overlapped_peaks, as in -overlapped-peaks files; the
+        em_fit; the sorted idr values; and the counts of peaks within
+        each IDR cutoff of -npeaks-aboveIDR.txt, as a Series. With an
+        output_dir, the output_prefix the comparison was written to.
+        '''
+        if self.ranking_measure == 'p-value': ranking_measure = 'p.value'
+        else: ranking_measure = 'signal.value'
+        comparisons, init = [], None
+        for name_1, name_2, rep_1, rep_2, indexes in pairs:
+            with profiling.stage('compare {}-{}'.format(name_1, name_2)):
+                compared = self.engine.compare_peaks(rep_1, rep_2,
+                                    ranking_measure=ranking_measure,
+                                    init=init, genome=genome,
+                                    indexes=indexes)
+            idr = compared['idr']
+            comparison = {'name_1': name_1, 'name_2': name_2,
+                          'overlapped_peaks': self.engine.get_overlapped_peaks(
+                                        compared['pruned_1'],
+                                        compared['pruned_2'],
+                                        compared['idr_local'], idr),
+                          'em_fit': compared['em_fit'],
+                          'idr': np.sort(idr),
+                          'counts': Series(
+                                self.engine.count_within_idr_cutoffs(idr),
+                                index=self.engine.idr_cutoffs)}
+            if self.output_dir:
+                comparison['output_prefix'] = self.write_comparison(
+                                        compared, name_1, name_2, group)
+            comparisons.append(comparison)
+            # With warm starts, each pair starts from the one before.
+            if self.warm_start: init = compared['em_fit']
+        return comparisons
+
+    def write_comparison(self, compared, name_1, name_2, group):
+        output_dir = os.path.join(self.output_dir, self.groups[group])
+        if not os.path.exists(output_dir): os.makedirs(output_dir)
+        if group == 'replicates': filename = '{}-{}'.format(name_1, name_2)
+        else: filename = name_1 + '-pair'
+        output_prefix = os.path.join(output_dir, filename)
+        self.engine.write_comparison(compared, name_1, name_2, output_prefix)
+        return output_prefix
+
+    def threshold_peaks(self, result, number_of_peaks, pooled_peaks=None):
+        '''
+        Determine thresholds from the number of peaks compared, count
+        the peaks within them, and select the top set of pooled peaks.
+        '''
+        threshold = self.threshold or self.idrutils.determine_threshold(
+                                                number_of_peaks, pooled=False)
+        pooled_threshold = self.pooled_threshold \
+                            or self.idrutils.determine_threshold(
+                                                number_of_peaks, pooled=True)
+        counts = OrderedDict()
+        for group, comparisons in result['comparisons'].items():
+            if not comparisons: continue
+            counts[group] = self.idrutils.get_max_count(
+                    [int(c['idr'].searchsorted(
+                            pooled_threshold if group == 'pooled'
+                            else threshold, side='right'))
+                     for c in comparisons])
+        result.update(threshold=threshold, pooled_threshold=pooled_threshold,
+                      counts=counts, peaks=None, number_of_peaks=None,
+                      output_file=None)
+        if pooled_peaks is None: return result
+
+        if 'pooled' in counts:
+            self.idrutils.check_pooled_count(counts['replicates'],
+                                             counts['pooled'])
+        with profiling.stage('slice'):
+            result['peaks'] = self.idrutils.slice_peak_table(
+                        self.read_homer_peaks(pooled_peaks),
+                        counts['replicates'], self.ranking_measure,
+                        idrs=[c['idr'] for c
+                              in result['comparisons']['replicates']])
+        result['number_of_peaks'] = len(result['peaks'])
+        if self.output_dir:
+            result['output_file'] = self.write_peaks(result['peaks'],
+                    self.get_name(pooled_peaks, 'Pooled') + '.txt')
+        return result
+
+    def write_peaks(self, peaks, filename):
+        '''
+        Write the top set as slice_peaks does: as Homer peaks, with \\r
+        line endings, and again with the Rank and IDR columns. Returns
+        the name of the first.
+        '''
+        basename, ext = split_name(filename)
+        output_files = []
+        for suffix, data in (('-top-set', peaks.drop(columns=['Rank', 'IDR'])),
+                             ('-top-set-idr', peaks)):
+            output_file = os.path.join(self.output_dir,
+                                       basename + suffix + ext)
+            with open_file(output_file, 'w') as f:
+                data.to_csv(f, sep='\t', index=False, lineterminator='\r\n')
+            output_files.append(output_file)
+        return output_files[0]
@@ -0,0 +1,275 @@
+'''
+Benchmarks each stage of the pipeline on synthetic experiments at
+realistic scales, and checks that the faster engines reproduce the IDR
+values of the reference R engine.
+
+For each scale, a synthetic experiment is generated (see simulate.py),
+and these stages are timed: create_pseudoreps, homer2narrow,
+standardize_peak_counts, the pairwise analysis with each engine,
+thresholding, and slice_peaks. Then each engine's overlapped peaks are
+matched to the reference's by position, and the IDR values and the
+peaks kept at each cutoff are compared. Engines rank tied signals at
+random, so tied peaks may swap IDR values from run to run; the IDR
+values are therefore held to the tolerance as sorted distributions,
+and the largest difference for any one peak is reported alongside.
+
+Where Rscript is not installed, the plain numpy engine, which mirrors
+the R code, is the reference instead, and the report says so.
+'''
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+from pandas import DataFrame
+from pandas.io.parsers import read_csv
+
+from idr.columnar import ColumnarTable
+from idr.compression import open_file
+from idr.idr_caller import IdrCaller
+from idr.idr_index import IdrIndex
+from idr.simulate import SyntheticData
+from idr import profiling
+from idr.utils import IdrUtilities
+
+class Benchmark(object):
+    '''
+    Times the pipeline on synthetic experiments, and compares engines.
+    '''
+    # Number of peaks and of tags per replicate for each named scale.
+    scales = OrderedDict((('small', (50000, 10*10**6)),
+                          ('medium', (300000, 50*10**6)),
+                          ('large', (1000000, 200*10**6))))
+
+    # Engines compared, by name, with the IdrCaller options of each.
+    # The first available is the reference.
+    engines = OrderedDict((('r', {'engine': 'r'}),
+                           ('numpy', {'engine': 'numpy'}),
+                           ('numpy-squarem', {'engine': 'numpy',
+                                              'em_acceleration': 'squarem'}),
+                           ('numpy-columnar', {'engine': 'numpy',
+                                               'columnar': True})))
+
+    # Largest difference from the reference in the sorted IDR values,
+    # and in the share of peaks kept at any cutoff.
+    idr_tolerance = 0.01
+    count_tolerance = 0.01
+    idr_cutoffs = (0.01, 0.02, 0.05, 0.1)
+
+    position_columns = ['chr1', 'start1', 'stop1', 'chr2', 'start2', 'stop2']
+
+    def __init__(self, output_dir, scales=('small',), seed=0, jobs=1):
+        self.output_dir = output_dir
+        self.scales = OrderedDict((scale, self.get_scale(scale))
+                                  for scale in scales)
+        self.seed = seed
+        self.jobs = jobs or 1
+
+    @classmethod
+    def get_scale(cls, scale):
+        '''
+        The number of peaks and tags of a named scale, or of one given
+        as peaks:tags, such as 5000:1e6.
+        '''
+        if scale in cls.scales: return cls.scales[scale]
+        try:
+            peaks, tags = scale.split(':')
+            return int(float(peaks)), int(float(tags))
+        except ValueError:
+            raise Exception('Unknown benchmark scale "{}". '.format(scale)
+                            + 'Options are: {}, '.format(', '.join(cls.scales))
+                            + 'or peaks:tags, such as 5000:1e6.')
+
+    def get_available_engines(self):
+        available = OrderedDict()
+        for name, options in self.engines.items():
+            if options['engine'] == 'r' and not shutil.which('Rscript'):
+                continue
+            available[name] = options
+        return available
+
+    def run(self):
+        '''
+        Run every scale, and write the results as idr-benchmark.json and
+        a table of timings, idr-benchmark.txt, to the output directory.
+
+        Raises an Exception if any engine falls outside the tolerances,
+        once the results are written.
+        '''
+        if not os.path.exists(self.output_dir): os.makedirs(self.output_dir)
+        results = OrderedDict()
+        for scale, (number_of_peaks, number_of_tags) in self.scales.items():
+            print('Benchmarking {} scale: {} peaks, {} tags'.format(
+                                    scale, number_of_peaks, number_of_tags))
+            with profiling.stage('benchmark ' + scale):
+                results[scale] = self.run_scale(scale, number_of_peaks,
+                                                number_of_tags)
+
+        output_file = os.path.join(self.output_dir, 'idr-benchmark.json')
+        with open(output_file, 'w') as f:
+            json.dump({'environment': profiling.get_environment(),
+                       'scales': results}, f, indent=1)
+        table = self.get_table(results)
+        table.to_csv(os.path.join(self.output_dir, 'idr-benchmark.txt'),
+                     sep='\t', index=False)
+        print(table.to_string(index=False))
+        print('Benchmark output to {}'.format(output_file))
+
+        failed = ['{} ({})'.format(engine, scale)
+                  for scale, result in results.items()
+                  for engine, check in result['equivalence'].items()
+                  if not check['passed']]
+        if failed:
+            raise Exception('IDR values differ from the reference beyond '
+                            + 'tolerance for: {}'.format(', '.join(failed)))
+        return output_file
+
+    def run_scale(self, scale, number_of_peaks, number_of_tags):
+        '''
+        Generate the experiment for a scale and run each stage on it.
+        '''
+        scale_dir = os.path.join(self.output_dir, scale.replace(':', '-'))
+        work_dir = os.path.join(scale_dir, 'work')
+        # Start from a clean slate, keeping the generated data.
+        if os.path.exists(work_dir): shutil.rmtree(work_dir)
+        os.makedirs(work_dir)
+        timings = OrderedDict()
+        idrutils = IdrUtilities()
+
+        with self.timed('generate', timings):
+            data = SyntheticData(seed=self.seed).write_experiment(
+                                            os.path.join(scale_dir, 'data'),
+                                            number_of_peaks, number_of_tags)
+
+        with self.timed('create_pseudoreps', timings):
+            idrutils.create_pseudoreps(data['tag_dirs'][0], work_dir,
+                                       seed=self.seed, jobs=self.jobs)
+
+        with self.timed('homer2narrow', timings):
+            converted = [idrutils.convert_homer_peaks(peak_file,
+                                os.path.join(work_dir,
+                                             'Rep{}.narrowPeak'.format(i + 1)),
+                                with_count=True)
+                         for i, peak_file in enumerate(data['peak_files'])]
+            narrowpeaks, counts = zip(*converted)
+        with self.timed('standardize_peak_counts', timings):
+            truncated = idrutils.standardize_peak_counts(list(narrowpeaks),
+                                                         work_dir,
+                                                         counts=list(counts),
+                                                         jobs=self.jobs)
+
+        engines = self.get_available_engines()
+        if 'r' not in engines:
+            print('Rscript not found; comparing engines to the numpy '
+                  + 'engine as the reference.')
+        idr_files = OrderedDict()
+        for name, engine_options in engines.items():
+            idrcaller = IdrCaller(jobs=1, **engine_options)
+            output_prefix = os.path.join(work_dir, name)
+            with self.timed('compare ' + name, timings):
+                idrcaller.run_batch_analysis(truncated[0], truncated[1],
+                                             output_prefix,
+                                             ranking_measure='signal.value')
+            idr_files[name] = idrcaller.get_overlapped_peaks_file(
+                                                            output_prefix)
+
+        reference = next(iter(idr_files))
+        with self.timed('threshold', timings):
+            threshold = idrutils.determine_threshold(number_of_peaks)
+            keep_count = idrutils.get_peaks_within_threshold(threshold,
+                                                    [idr_files[reference]])
+        with self.timed('slice_peaks', timings):
+            idrutils.slice_peaks(data['pooled_peaks'], keep_count,
+                                 'tag-count', work_dir,
+                                 idr_files=[idr_files[reference]])
+
+        equivalence = OrderedDict()
+        for name, idr_file in idr_files.items():
+            if name == reference: continue
+            equivalence[name] = self.compare_idr(idr_files[reference],
+                                                 idr_file)
+        return {'peaks': number_of_peaks, 'tags': number_of_tags,
+                'reference': reference, 'threshold': threshold,
+                'peaks_kept': keep_count, 'timings': timings,
+                'equivalence': equivalence}
+
+    @contextmanager
+    def timed(self, name, timings):
+        '''
+        Record the wall time of the enclosed stage in timings, and
+        profile it as a stage if profiling.
+        '''
+        started = time.perf_counter()
+        with profiling.stage(name):
+            yield
+        timings[name] = time.perf_counter() - started
+
+    def read_overlapped_peaks(self, idr_file):
+        if ColumnarTable.is_columnar(idr_file):
+            return ColumnarTable.read(idr_file,
+                                      columns=self.position_columns + ['IDR'])
+        with open_file(idr_file, 'r') as f:
+            return read_csv(f, sep=' ', header=0,
+                            usecols=self.position_columns + ['IDR'])
+
+    def compare_idr(self, reference_file, idr_file):
+        '''
+        Match the peaks of two overlapped peaks files by position, and
+        compare their IDR values, and the share of peaks each keeps at
+        each of idr_cutoffs.
+        '''
+        reference = self.read_overlapped_peaks(reference_file)
+        other = self.read_overlapped_peaks(idr_file)
+        merged = reference.merge(other, on=self.position_columns,
+                                 suffixes=('_reference', ''))
+        matched = len(merged) == len(reference) == len(other) > 0
+        max_peak_difference = float(np.abs(merged['IDR_reference']
+                                           - merged['IDR']).max()) \
+                                if len(merged) else None
+
+        reference_index = IdrIndex.load(reference_file)
+        index = IdrIndex.load(idr_file)
+        max_difference = float(np.abs(reference_index.idr
+                                      - index.idr).max()) if matched else None
+        reference_counts = reference_index.count(self.idr_cutoffs)
+        counts = index.count(self.idr_cutoffs)
+        count_differences = np.abs(counts - reference_counts)\
+                                /max(len(reference), 1)
+        passed = matched and max_difference <= self.idr_tolerance \
+                    and count_differences.max() <= self.count_tolerance
+        return {'reference_peaks': len(reference), 'peaks': len(other),
+                'matched_peaks': len(merged),
+                'max_idr_difference': max_difference,
+                'max_peak_idr_difference': max_peak_difference,
+                'reference_counts': reference_counts.tolist(),
+                'counts': counts.tolist(),
+                'cutoffs': list(self.idr_cutoffs),
+                'passed': bool(passed)}
+
+    def get_table(self, results):
+        '''
+        A row of timings in seconds for each stage of each scale, with
+        the result of the equivalence check for each engine compared.
+        '''
+        rows = []
+        for scale, result in results.items():
+            for stage, seconds in result['timings'].items():
+                check = ''
+                engine = stage[len('compare '):] \
+                            if stage.startswith('compare ') else None
+                if engine == result['reference']: check = 'reference'
+                elif engine in result['equivalence']:
+                    equivalence = result['equivalence'][engine]
+                    check = '{} (max IDR difference {:.3g})'.format(
+                                'passed' if equivalence['passed'] else 'FAILED',
+                                equivalence['max_idr_difference'] or 0)
+                rows.append({'scale': scale, 'peaks': result['peaks'],
+                             'tags': result['tags'], 'stage': stage,
+                             'seconds': seconds if seconds is None
+                                                else round(seconds, 3),
+                             'equivalence': check})
+        return DataFrame(rows, columns=['scale', 'peaks', 'tags', 'stage',
+                                        'seconds', 'equivalence'])
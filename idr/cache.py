@@ -0,0 +1,164 @@
+'''
+A content-addressed cache of stage outputs, so that reruns skip work
+whose inputs and parameters have not changed.
+
+Entries are keyed on the hashes of the input files' contents, the
+parameters, and the code that produces the outputs. Each entry holds
+the output files of one run, named by their suffix relative to an
+output prefix, so that they can be restored under any prefix.
+
+The cache is bounded in size; the least recently used entries are
+evicted first.
+'''
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+class ResultCache(object):
+    '''
+    Stores and restores the outputs of a stage, keyed by get_key.
+    '''
+    # Default size bound, in bytes.
+    default_max_size = 10*2**30
+
+    # Bytes to read at a time when hashing files.
+    hash_chunk_size = 2**20
+
+    # Hashes of files already read, by (path, size, mtime).
+    _file_hashes = {}
+
+    def __init__(self, cache_dir=None, max_size=None):
+        if not cache_dir:
+            cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME')
+                                     or os.path.expanduser('~/.cache'),
+                                     'homer-idr')
+        self.cache_dir = cache_dir
+        self.max_size = self.default_max_size if max_size is None\
+                            else max_size
+
+    def get_file_hash(self, filename):
+        '''
+        SHA-256 of a file's contents. Hashes are remembered for the life
+        of the process, as long as the file's size and mtime are unchanged.
+        '''
+        stat = os.stat(filename)
+        memo = (os.path.realpath(filename), stat.st_size, stat.st_mtime_ns)
+        if memo not in self._file_hashes:
+            digest = hashlib.sha256()
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.hash_chunk_size), b''):
+                    digest.update(chunk)
+            self._file_hashes[memo] = digest.hexdigest()
+        return self._file_hashes[memo]
+
+    def get_key(self, stage, input_files, params=None, code_files=()):
+        '''
+        Key for a stage run on the passed input files. The key changes
+        when any input's contents, any parameter, or any of the code
+        files that implement the stage change; input file names do not
+        matter.
+        '''
+        description = {'stage': stage,
+                       'inputs': [self.get_file_hash(f) for f in input_files],
+                       'params': params or {},
+                       'code': [self.get_file_hash(f) for f in code_files]}
+        return hashlib.sha256(json.dumps(description, sort_keys=True,
+                                         default=str).encode()).hexdigest()
+
+    def get_entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get_sizes(self, output_prefix, suffixes):
+        '''
+        Sizes of the files output_prefix + suffix, by suffix, for outputs
+        that runs append to; 0 for files that do not exist yet.
+        '''
+        return dict((suffix, os.path.getsize(output_prefix + suffix)
+                        if os.path.exists(output_prefix + suffix) else 0)
+                    for suffix in suffixes)
+
+    def store(self, key, output_prefix, suffixes, appended=None):
+        '''
+        Store the files output_prefix + suffix written by a run; missing
+        files are skipped.
+
+        Runs add to the files for suffixes in appended, a dict of their
+        sizes before the run (see get_sizes), rather than replacing them,
+        so only what the run added is stored.
+        '''
+        appended = appended or {}
+        suffixes = [s for s in suffixes if os.path.exists(output_prefix + s)]
+
+        entry_dir = self.get_entry_dir(key)
+        if os.path.exists(entry_dir): return
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+
+        # Build the entry beside its destination, then move it into
+        # place, so that concurrent readers never see half an entry.
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir))
+        try:
+            meta = {'files': {}}
+            for suffix in suffixes:
+                source = output_prefix + suffix
+                target = os.path.join(tmp_dir, 'output-{}'.format(
+                                                    len(meta['files'])))
+                start = appended.get(suffix, 0)
+                with open(source, 'rb') as f, open(target, 'wb') as out:
+                    f.seek(start)
+                    shutil.copyfileobj(f, out)
+                meta['files'][suffix] = {'path': os.path.basename(target),
+                                         'append': suffix in appended}
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another run stored the same entry first.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.exists(entry_dir): raise
+        self.evict()
+
+    def fetch(self, key, output_prefix):
+        '''
+        Restore the outputs stored for key under output_prefix.
+
+        Returns the list of restored files, or None on a miss.
+        '''
+        entry_dir = self.get_entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        restored = []
+        for suffix, stored in sorted(meta['files'].items()):
+            target = output_prefix + suffix
+            with open(os.path.join(entry_dir, stored['path']), 'rb') as f,\
+                    open(target, 'ab' if stored['append'] else 'wb') as out:
+                shutil.copyfileobj(f, out)
+            restored.append(target)
+
+        # Mark the entry as recently used.
+        os.utime(entry_dir)
+        return restored
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the cache fits in
+        max_size.
+        '''
+        entries, total = [], 0
+        for root, dirs, files in os.walk(self.cache_dir):
+            if 'meta.json' not in files: continue
+            size = sum(os.path.getsize(os.path.join(root, f)) for f in files)
+            entries.append((os.path.getmtime(root), size, root))
+            total += size
+            dirs[:] = []
+
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_size: break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
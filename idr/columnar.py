@@ -0,0 +1,165 @@
+'''
+A compact binary columnar format for the narrowPeak and overlapped-peak
+tables passed between stages, so that intermediate files need not be
+written out as text and parsed again.
+
+A file holds a short magic string, the length of a JSON header, the
+header, and then each column as a raw array, aligned so that the whole
+file can be memory-mapped and columns viewed in place. String columns
+are stored as integer codes, with their categories in the header.
+
+Text is written only at the edges: for the R code, and for final output.
+'''
+import json
+import struct
+
+import numpy as np
+from pandas import Categorical, DataFrame, factorize
+from pandas.api.types import is_numeric_dtype, is_bool_dtype
+
+class ColumnarTable(object):
+    '''
+    Reads and writes tables in the binary columnar format. Each table
+    records its kind, narrowPeak or overlapped-peaks, which determines
+    its text export.
+    '''
+    extension = '.cols'
+    magic = b'IDRCOLS1'
+    alignment = 64
+
+    narrow_peak_columns = ['chrom', 'chromStart', 'chromEnd', 'name',
+                           'score', 'strand', 'signalValue', 'pValue',
+                           'qValue', 'peak']
+
+    @classmethod
+    def is_columnar(cls, filename):
+        '''
+        Whether the file is in the columnar format, judged by its magic
+        string rather than its name.
+        '''
+        try:
+            with open(filename, 'rb') as f:
+                return f.read(len(cls.magic)) == cls.magic
+        except (IOError, OSError):
+            return False
+
+    @classmethod
+    def write(cls, data, filename, kind='narrowPeak'):
+        '''
+        Write a DataFrame or dict of equal-length arrays.
+        '''
+        columns, arrays = [], []
+        offset = 0
+        for name in data.keys():
+            values = data[name]
+            column = {'name': name}
+            if not (is_numeric_dtype(values) or is_bool_dtype(values)):
+                values, categories = factorize(values)
+                column['categories'] = [str(c) for c in categories]
+            values = np.asarray(values)
+            if np.issubdtype(values.dtype, np.integer) and values.shape[0]:
+                # Store integers, and codes, in the smallest type that fits.
+                values = values.astype(np.promote_types(
+                                np.min_scalar_type(values.min()),
+                                np.min_scalar_type(values.max())))
+            values = np.ascontiguousarray(values)
+            column['dtype'] = values.dtype.str
+            column['offset'] = offset
+            offset += cls.get_padded(values.nbytes)
+            columns.append(column)
+            arrays.append(values)
+
+        rows = arrays[0].shape[0] if arrays else 0
+        header = json.dumps({'kind': kind, 'rows': rows,
+                             'columns': columns}).encode()
+        start = cls.get_padded(len(cls.magic) + 8 + len(header))
+        with open(filename, 'wb') as f:
+            f.write(cls.magic + struct.pack('<Q', len(header)) + header)
+            f.write(b'\0'*(start - f.tell()))
+            for values in arrays:
+                f.write(memoryview(values).cast('B'))
+                f.write(b'\0'*(cls.get_padded(values.nbytes) - values.nbytes))
+        return filename
+
+    @classmethod
+    def read_header(cls, filename):
+        '''
+        Returns the header, with the offset of the first column as start.
+        '''
+        with open(filename, 'rb') as f:
+            if f.read(len(cls.magic)) != cls.magic:
+                raise Exception('{} is not a columnar table.'.format(filename))
+            length = struct.unpack('<Q', f.read(8))[0]
+            header = json.loads(f.read(length).decode())
+        header['start'] = cls.get_padded(len(cls.magic) + 8 + length)
+        return header
+
+    @classmethod
+    def read(cls, filename, columns=None):
+        '''
+        Read the table as a DataFrame. Pass columns to read only those;
+        as the file is memory-mapped, other columns are never loaded.
+        '''
+        header = cls.read_header(filename)
+        raw = np.memmap(filename, dtype=np.uint8, mode='r')
+        data = {}
+        for column in header['columns']:
+            if columns is not None and column['name'] not in columns: continue
+            dtype = np.dtype(column['dtype'])
+            start = header['start'] + column['offset']
+            values = raw[start:start + header['rows']*dtype.itemsize]\
+                        .view(dtype)
+            if 'categories' in column:
+                values = Categorical.from_codes(values, column['categories'])
+            data[column['name']] = values
+        names = [c['name'] for c in header['columns'] if c['name'] in data]
+        return DataFrame(data, columns=names)
+
+    @classmethod
+    def strip_extension(cls, filename):
+        '''
+        The filename without the columnar extension, if it has one.
+        '''
+        if filename.endswith(cls.extension):
+            return filename[:-len(cls.extension)]
+        return filename
+
+    @classmethod
+    def count_rows(cls, filename):
+        return cls.read_header(filename)['rows']
+
+    @classmethod
+    def to_text(cls, filename, output_file):
+        '''
+        Export a columnar table as text in the format its kind has
+        upstream: tab-separated narrowPeak, or the R write.table format
+        of -overlapped-peaks.txt.
+        '''
+        kind = cls.read_header(filename)['kind']
+        data = cls.read(filename)
+        if kind == 'overlapped-peaks':
+            with open(output_file, 'w') as f: write_r_table(data, f)
+        else:
+            data.to_csv(output_file, sep='\t', header=False, index=False)
+        return output_file
+
+    @classmethod
+    def get_padded(cls, size):
+        return -(-size//cls.alignment)*cls.alignment
+
+def write_r_table(data, f):
+    '''
+    Write a DataFrame as R's write.table does by default: space separated,
+    with quoted column names, row names, and strings.
+    '''
+    formats = []
+    for col in data.columns:
+        if not is_numeric_dtype(data[col]): formats.append('"{}"')
+        elif np.issubdtype(data[col].dtype, np.floating):
+            formats.append('{:.15g}')
+        else: formats.append('{}')
+    row_format = '"{}" ' + ' '.join(formats) + '\n'
+    f.write(' '.join('"{}"'.format(c) for c in data.columns) + '\n')
+    columns = [data[col].values for col in data.columns]
+    for i, row in enumerate(zip(*columns)):
+        f.write(row_format.format(i + 1, *row))
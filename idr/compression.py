@@ -0,0 +1,201 @@
+'''
+Transparent reading and writing of gzip-compressed files, so that peak
+files, tag files, and outputs can stay compressed on disk rather than
+being decompressed to scratch space first.
+
+Compressed files are recognized by their magic bytes, whatever their
+names, and are decompressed on a background thread as they are read.
+Files named .gz or .bgz are written in the blocked gzip format of bgzip,
+with blocks compressed on a pool of background threads while the caller
+goes on producing data. BGZF files are ordinary multi-member gzip files,
+so gzip, zcat, R, and pandas all read them.
+'''
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import io
+import os
+import queue
+import struct
+import threading
+import zlib
+
+compressed_extensions = ('.gz', '.bgz')
+gzip_magic = b'\x1f\x8b'
+
+# Threads to compress blocks on for each file written.
+compression_threads = min(4, os.cpu_count() or 1)
+
+def is_compressed(filename):
+    '''
+    Whether a file is gzip-compressed, judged by its magic bytes if it
+    exists, or else by its name.
+    '''
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(gzip_magic)) == gzip_magic
+    except (IOError, OSError):
+        return filename.endswith(compressed_extensions)
+
+def strip_compression(filename):
+    '''
+    The filename without a compression extension, if it has one.
+    '''
+    for extension in compressed_extensions:
+        if filename.endswith(extension): return filename[:-len(extension)]
+    return filename
+
+def split_name(filename):
+    '''
+    Split a file's basename into its stem and its extension, including
+    any compression extension: peaks.narrowPeak.gz gives
+    ('peaks', '.narrowPeak.gz').
+    '''
+    basename = os.path.basename(filename)
+    stripped = strip_compression(basename)
+    stem, ext = os.path.splitext(stripped)
+    return stem, ext + basename[len(stripped):]
+
+def open_file(filename, mode='r', threads=None):
+    '''
+    Open a file for reading or writing as open does, compressed or not.
+
+    Compressed files are read through a background decompression thread.
+    Files written with a compression extension are written as BGZF, on
+    threads background threads; appending adds further gzip members.
+    '''
+    binary = 'b' in mode
+    mode = mode.replace('b', '').replace('t', '')
+    if mode == 'r':
+        if not is_compressed(filename):
+            return open(filename, 'rb' if binary else 'r')
+        raw = io.BufferedReader(DecompressingReader(filename))
+    elif filename.endswith(compressed_extensions):
+        raw = BgzfWriter(filename, mode=mode, threads=threads)
+    else:
+        return open(filename, mode + ('b' if binary else ''))
+    return raw if binary else io.TextIOWrapper(raw)
+
+class DecompressingReader(io.RawIOBase):
+    '''
+    Reads a gzip file decompressed on a background thread, a chunk
+    ahead of the caller.
+    '''
+    chunk_size = 2**20
+    read_ahead = 4
+
+    def __init__(self, filename):
+        super().__init__()
+        self._chunks = queue.Queue(maxsize=self.read_ahead)
+        self._stopped = threading.Event()
+        self._current = memoryview(b'')
+        self._done = False
+        self._thread = threading.Thread(target=self._decompress,
+                                        args=(filename,), daemon=True)
+        self._thread.start()
+
+    def _decompress(self, filename):
+        try:
+            with gzip.open(filename, 'rb') as f:
+                while not self._stopped.is_set():
+                    chunk = f.read(self.chunk_size)
+                    self._put(chunk)
+                    if not chunk: return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        # Give up if the reader is closed before we are done.
+        while not self._stopped.is_set():
+            try:
+                self._chunks.put(item, timeout=.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._current and not self._done:
+            chunk = self._chunks.get()
+            if isinstance(chunk, Exception): raise chunk
+            if not chunk: self._done = True
+            self._current = memoryview(chunk)
+        size = min(len(buffer), len(self._current))
+        buffer[:size] = self._current[:size]
+        self._current = self._current[size:]
+        return size
+
+    def close(self):
+        self._stopped.set()
+        super().close()
+
+class BgzfWriter(io.BufferedIOBase):
+    '''
+    Writes BGZF: gzip members of at most block_size bytes of data each,
+    with their compressed size recorded in the header, ending with the
+    standard empty member. Blocks are compressed concurrently, and
+    written in order.
+    '''
+    block_size = 65280
+    eof_block = bytes.fromhex('1f8b08040000000000ff0600424302001b00'
+                              '0300000000000000000000')
+
+    def __init__(self, filename, mode='w', threads=None, level=6):
+        super().__init__()
+        self.level = level
+        self._file = open(filename, mode + 'b')
+        self._buffer = bytearray()
+        self._pending = deque()
+        threads = threads or compression_threads
+        self._max_pending = 4*threads
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+        # Bound the blocks held in memory.
+        self._write_pending(self._max_pending)
+        return len(data)
+
+    def flush(self):
+        if self.closed: return
+        self._write_pending(0)
+        self._file.flush()
+
+    def close(self):
+        if self.closed: return
+        try:
+            if self._buffer: self._submit(self._buffer)
+            self._buffer = bytearray()
+            self._write_pending(0)
+            self._file.write(self.eof_block)
+        finally:
+            self._executor.shutdown(wait=True)
+            super().close()
+            self._file.close()
+
+    def _submit(self, data):
+        self._pending.append(self._executor.submit(compress_block,
+                                                   bytes(data), self.level))
+
+    def _write_pending(self, limit):
+        while len(self._pending) > limit:
+            self._file.write(self._pending.popleft().result())
+
+def compress_block(data, level=6):
+    '''
+    Compress data as one BGZF block. zlib releases the GIL while it
+    compresses, so blocks compress in parallel on threads.
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    body = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff,
+                         6, 66, 67, 2, len(body) + 25)
+    return header + body + struct.pack('<II', zlib.crc32(data), len(data))
@@ -0,0 +1,116 @@
+'''
+Chromosome size tables for the genomes bundled in idrCode/genome_tables,
+or any custom table, so that each run can name its genome rather than
+relying on the single idrCode/genome_table.txt.
+
+Positions are concatenated across chromosomes as concatenate.chr does in
+functions-all-clayton-12-13.r: chromosomes are sorted by name and each is
+shifted by the summed sizes of those before it. Encoding and decoding
+(deconcatenate.chr) are then single vectorized lookups.
+'''
+import os
+
+import numpy as np
+from pandas import Index
+from pandas.io.parsers import read_csv
+
+class Genome(object):
+    '''
+    Chromosome names, sizes, and cumulative offsets for one genome.
+
+    Use Genome.get to look up a bundled genome by name, or to read a
+    custom table; tables are read once per process and cached.
+    '''
+    genome_tables_dir = os.path.join(
+                            os.path.dirname(os.path.realpath(__file__)),
+                            'idrCode', 'genome_tables')
+
+    # Genomes already read, by name or path.
+    _cache = {}
+
+    def __init__(self, chroms, sizes, name=None):
+        order = np.argsort(np.asarray(chroms, dtype=str), kind='mergesort')
+        self.name = name
+        self.chroms = np.asarray(chroms, dtype=object)[order]
+        self.sizes = np.asarray(sizes, dtype=np.int64)[order]
+        self.offsets = np.r_[0, np.cumsum(self.sizes)[:-1]].astype(np.int64)
+        self.index = Index(self.chroms)
+        if not self.index.is_unique:
+            raise Exception('Genome {} lists a chromosome more than once.'\
+                            .format(name))
+
+    @classmethod
+    def available(cls):
+        '''
+        Bundled genomes, as a dict of name to table path. Files named
+        genome_table.<species>.<name>.txt are listed under <name>.
+        '''
+        genomes = {}
+        if not os.path.isdir(cls.genome_tables_dir): return genomes
+        for filename in sorted(os.listdir(cls.genome_tables_dir)):
+            parts = filename.split('.')
+            if parts[0] != 'genome_table' or parts[-1] != 'txt': continue
+            genomes[parts[-2]] = os.path.join(cls.genome_tables_dir, filename)
+        return genomes
+
+    @classmethod
+    def get(cls, genome):
+        '''
+        Return the Genome for a bundled genome name (hg19, mm9, ...)
+        or the path to a custom table of chromosome names and sizes.
+        Passing a Genome returns it as is.
+        '''
+        if isinstance(genome, Genome): return genome
+        if genome not in cls._cache:
+            available = cls.available()
+            if genome in available: path = available[genome]
+            elif os.path.isfile(genome): path = genome
+            else:
+                raise Exception('Unknown genome "{}". Options are: {}, '.format(
+                                    genome, ', '.join(sorted(available)))
+                                + 'or the path to a table of chromosome sizes.')
+            cls._cache[genome] = cls.read(path, name=genome)
+        return cls._cache[genome]
+
+    @classmethod
+    def read(cls, path, name=None):
+        '''
+        Read a whitespace-delimited table of chromosome names and sizes,
+        as in genome_table.txt.
+        '''
+        table = read_csv(path, sep=r'\s+', header=None, usecols=[0, 1],
+                         names=['chrom', 'size'], dtype={'chrom': str})
+        return cls(table['chrom'].values, table['size'].values,
+                   name=name or path)
+
+    def get_codes(self, chroms, strict=False):
+        '''
+        Index of each passed chromosome name in self.chroms, or -1 for
+        names not in this genome. If strict, raise an Exception for
+        names not in this genome instead.
+        '''
+        codes = self.index.get_indexer(np.asarray(chroms, dtype=object))
+        if strict and (codes < 0).any():
+            unknown = np.unique(np.asarray(chroms, dtype=str)[codes < 0])
+            raise Exception('Chromosomes not in genome {}: {}'.format(
+                                        self.name, ', '.join(unknown[:10])))
+        return codes
+
+    def encode(self, chroms, positions):
+        '''
+        Shift positions on each chromosome into genome-wide coordinates.
+
+        Raises an Exception if any chromosome is not in this genome.
+        '''
+        codes = self.get_codes(chroms, strict=True)
+        return np.asarray(positions, dtype=np.int64) + self.offsets[codes]
+
+    def decode(self, positions):
+        '''
+        Inverse of encode: returns chromosome names and positions on them
+        for genome-wide coordinates.
+        '''
+        positions = np.asarray(positions, dtype=np.int64)
+        codes = np.searchsorted(self.offsets, positions, 'right') - 1
+        return self.chroms[codes], positions - self.offsets[codes]
+
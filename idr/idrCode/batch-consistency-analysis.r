@@ -6,7 +6,7 @@
 # This program performs consistency analysis for a pair of peak calling outputs
 # It takes narrowPeak or broadPeak formats.
 # 
-# usage: Rscript batch-consistency-analysis2.r peakfile1 peakfile2 half.width outfile.prefix overlap.ratio  is.broadpeak sig.value
+# usage: Rscript batch-consistency-analysis2.r peakfile1 peakfile2 half.width outfile.prefix overlap.ratio  is.broadpeak sig.value [chr.file]
 #
 # peakfile1 and peakfile2 : the output from peak callers in narrowPeak or broadPeak format
 # half.width: -1 if using the reported peak width, 
@@ -15,6 +15,7 @@
 # overlap.ratio: a value between 0 and 1. It controls how much overlaps two peaks need to have to be called as calling the same region. It is the ratio of overlap / short peak of the two. When setting at 0, it means as long as overlapped width >=1bp, two peaks are deemed as calling the same region.
 # is.broadpeak: a logical value. If broadpeak is used, set as T; if narrowpeak is used, set as F
 # sig.value: type of significant values, "q.value", "p.value" or "signal.value" (default, i.e. fold of enrichment)
+# chr.file: optional table of chromosome sizes; defaults to genome_table.txt in the working directory
 
 args <- commandArgs(trailingOnly=T)
 
@@ -55,7 +56,11 @@ sig.value <- args[7]
 source("functions-all-clayton-12-13.r")
 
 # read the length of the chromosomes, which will be used to concatenate chr's
-chr.file <- "genome_table.txt"
+if(length(args) >= 8){
+  chr.file <- args[8]
+}else{
+  chr.file <- "genome_table.txt"
+}
 
 chr.size <- read.table(chr.file)
 
@@ -0,0 +1,92 @@
+# Persistent worker for homer-idr
+#
+# Sources the function library once, then runs batch-consistency-analysis.r
+# and batch-consistency-plot.r jobs read from stdin, one per line, so that
+# each job does not pay for starting R and sourcing the library again.
+#
+# usage: Rscript batch-consistency-worker.r
+#
+# Each request is a tab-separated line:
+#   [job.id] [job.type] [log.file] [arguments ...]
+# job.type: analysis or plot, to run that script with the arguments it
+#           takes on the command line; ping, to check the worker is
+#           responsive; or quit.
+# log.file: file the job's output and messages are appended to
+#
+# Once started, and after each request, the worker writes one
+# tab-separated line to stdout: "ready"; [job.id] "ok"; or
+# [job.id] "error" [message]. Each job runs in the global environment,
+# as under Rscript; what it defines there is removed afterwards, and the
+# library restored.
+
+source("functions-all-clayton-12-13.r")
+
+library.file <- "functions-all-clayton-12-13.r"
+job.scripts <- c(analysis="batch-consistency-analysis.r",
+                 plot="batch-consistency-plot.r")
+base.source <- base::source
+
+# Jobs see their own arguments, and do not source the library again.
+job.args <- character(0)
+commandArgs <- function(trailingOnly=FALSE) job.args
+source <- function(file, ...){
+  if(basename(file) != library.file) base.source(file, ...)
+  invisible(NULL)
+}
+
+# Report warnings as they happen, into the job's log.
+options(warn=1)
+
+respond <- function(...){
+  cat(paste(..., sep="\t"), "\n", sep="")
+  flush(stdout())
+}
+
+run.job <- function(job.type, log.file, args){
+  log <- file(log.file, open="a")
+  sink(log)
+  sink(log, type="message")
+  assign("job.args", args, envir=globalenv())
+  error <- tryCatch({
+    base.source(job.scripts[[job.type]], local=globalenv())
+    NULL
+  }, error=function(e) conditionMessage(e))
+  if(!is.null(error)) cat("Error:", error, "\n")
+
+  # Undo what the job left behind: sinks, devices, and objects.
+  while(sink.number() > 0) sink()
+  sink(type="message")
+  close(log)
+  graphics.off()
+  rm(list=setdiff(ls(globalenv(), all.names=TRUE),
+                  c(names(worker.objects), "worker.objects")),
+     envir=globalenv())
+  list2env(worker.objects, envir=globalenv())
+  error
+}
+
+serve <- function(){
+  requests <- file("stdin", open="r")
+  respond("ready")
+  repeat{
+    line <- readLines(requests, n=1)
+    if(length(line) == 0) break
+    fields <- strsplit(line, "\t", fixed=TRUE)[[1]]
+    job.id <- fields[1]
+    job.type <- fields[2]
+    if(job.type == "quit") break
+    if(job.type == "ping"){
+      respond(job.id, "ok")
+    }else if(!(job.type %in% names(job.scripts)) || length(fields) < 3){
+      respond(job.id, "error", paste("Unknown request:", job.type))
+    }else{
+      error <- run.job(job.type, fields[3], fields[-(1:3)])
+      if(is.null(error)) respond(job.id, "ok")
+      else respond(job.id, "error", gsub("[\t\r\n]+", " ", error))
+    }
+  }
+  close(requests)
+}
+
+worker.objects <- mget(ls(globalenv(), all.names=TRUE), envir=globalenv())
+serve()
@@ -1,5 +1,7 @@
 #!/bin/bash
 # Converts pairwise IDR peak overlap output to narrowPeak
+# Now runs the overlap2narrow command of homer-idr's run_idr.py, which
+# writes the same gzipped output without shelling out to sort and awk.
 
 if [[ "$#" -lt 1 ]]
     then
@@ -21,17 +23,6 @@ fi
 # Output directory
 oDir=$(dirname ${ovFile})
 [[ $# -gt 1 ]] && oDir=$2
-if [[ ! -d ${oDir} ]]
-    then
-    mkdir ${oDir}
-fi
-oDir=$(echo ${oDir} | sed -r 's:/$::g')
 
-# Create output file
-oFile="${oDir}/$(basename ${ovFile} .gz).npk.gz"
-if grep -q -E '\.gz$' ${ovFile}
-    then
-    zcat ${ovFile} | sed 1d | sed -r 's/"//g' | sort -k11g,11g | awk '{if ($3 <=$7) st=$3 ; else st=$7 ; if ($4 >= $8) sto=$4 ; else sto=$8 ; printf "%s\t%d\t%d\t%d\t%s\t.\t%s\t%f\t%f\n",$2,st,sto,NR,$5,$9,-log($10)/log(10),-log($11)/log(10)}' | gzip -c > ${oFile}
-else
-    sed 1d ${ovFile} | sed -r 's/"//g' | sort -k11g,11g | awk '{if ($3 <=$7) st=$3 ; else st=$7 ; if ($4 >= $8) sto=$4 ; else sto=$8 ; printf "%s\t%d\t%d\t%d\t%s\t.\t%s\t%f\t%f\n",$2,st,sto,NR,$5,$9,-log($10)/log(10),-log($11)/log(10)}' | gzip -c > ${oFile}
-fi
\ No newline at end of file
+# Create output file, ${oDir}/$(basename ${ovFile} .gz).npk.gz
+python "$(dirname $0)/../run_idr.py" overlap2narrow -p ${ovFile} -o ${oDir} --compress
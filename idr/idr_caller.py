@@ -3,40 +3,127 @@ Created on Aug 7, 2014
 
 @author: karmel
 '''
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor,\
+    as_completed
+from contextlib import redirect_stderr, redirect_stdout
 import itertools
 import os
 import subprocess
+import threading
+import time
+import traceback
+
+from idr.columnar import ColumnarTable
+from idr.compression import split_name
+from idr.genome import Genome
+from idr.idr_engine import IdrEngine
+from idr.plotting import IdrPlotter
+from idr import profiling
+from idr.r_workers import RWorkerPool
+from idr.session import PeakSession
 
 class IdrCaller(object):
     '''
-    Dispatches prepped files to the IDR R package code.
+    Dispatches prepped files to the IDR R package code, or to the 
+    in-process NumPy engine.
     '''
+    engines = ('r', 'numpy')
+    
+    # Outputs of each comparison, by suffix to the output prefix;
+    # the overlapped peaks file is added according to the format.
+    r_output_suffixes = ('-npeaks-aboveIDR.txt', '-Rout.txt', 
+                         '-uri.sav', '-em.sav')
+    numpy_output_suffixes = ('-npeaks-aboveIDR.txt', '-em-fit.json', 
+                             '-em-trace.txt', '-plot-summary.json')
+    # Outputs that comparisons append to rather than replace.
+    appended_suffixes = ('-npeaks-aboveIDR.txt',)
+    npeaks_suffix = '-npeaks-aboveIDR.txt'
+    
+    def __init__(self, engine='r', jobs=1, genome=None, columnar=False,
+                 compress=False, cache=None, em_acceleration=None, 
+                 warm_start=False, uri_points=100, plot_format='pdf',
+                 r_workers=0):
+        if engine not in self.engines:
+            raise Exception('Unknown IDR engine "{}". Options are: {}'.format(
+                                        engine, ', '.join(self.engines)))
+        self.engine = engine
+        self.jobs = jobs or 1
+        # Resolve the genome now so that unknown names fail early.
+        self.genome = genome and Genome.get(genome)
+        # R reads and writes only text, so this applies to numpy alone.
+        self.columnar = columnar and engine == 'numpy'
+        # Likewise, R writes its overlapped peaks uncompressed,
+        # and fits EM its own way.
+        self.compress = compress and engine == 'numpy'
+        self.em_acceleration = engine == 'numpy' and em_acceleration or None
+        self.warm_start = warm_start and engine == 'numpy'
+        self.uri_points = uri_points or 100
+        # Format of plots drawn from -plot-summary.json files.
+        self.plot_format = plot_format or 'pdf'
+        # A ResultCache to reuse comparisons from, or None.
+        self.cache = cache
+        # Number of long-lived R processes to run R jobs on, rather
+        # than starting Rscript for each; see RWorkerPool.
+        self.r_workers = engine == 'r' and r_workers or 0
+        
+        # Running Rscript processes by output prefix, so that we can stop
+        # those of a failed run_pairs.
+        self._processes = {}
+        self._lock = threading.Lock()
+        # A pool shared by concurrent calls to run_pairs, if started.
+        self._executor = None
+        self._r_pool = None
+    
+    def __getstate__(self):
+        # Locks and processes stay behind when sent to worker processes.
+        state = self.__dict__.copy()
+        state['_processes'], state['_lock'] = {}, None
+        state['_executor'], state['_r_pool'] = None, None
+        return state
     
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        
     def compare_replicates(self, replicates, output_dir, 
                            ranking_measure='signal.value'):
         '''
         Do all pairwise comparisons for passed files.
         '''
+        pairs = self.get_replicate_pairs(replicates, output_dir)
+        return self.run_pairs(pairs, ranking_measure=ranking_measure)
+        
+    def compare_pseudoreps(self, pseudoreps, output_dir,
+                           ranking_measure='signal.value'):
+        '''
+        Compare each pseudoreplicate to its mate.
+        '''
+        pairs = self.get_pseudorep_pairs(pseudoreps, output_dir)
+        return self.run_pairs(pairs, ranking_measure=ranking_measure)
+    
+    def get_replicate_pairs(self, replicates, output_dir):
+        '''
+        List (file_1, file_2, output_prefix) for all pairwise 
+        comparisons of the passed files.
+        '''
         pairs = itertools.combinations_with_replacement(replicates,2)
 
-        prefixes = []
+        planned = []
         for file_1, file_2 in pairs:
             # Skip self-comparisons
             if file_1 == file_2: continue
 
-            file_1_name = os.path.splitext(os.path.basename(file_1))[0]
-            file_2_name = os.path.splitext(os.path.basename(file_2))[0]
+            file_1_name = split_name(ColumnarTable.strip_extension(file_1))[0]
+            file_2_name = split_name(ColumnarTable.strip_extension(file_2))[0]
             filename = '{}-{}'.format(file_1_name, file_2_name)
             output_prefix = os.path.join(output_dir, filename)
-            self.run_batch_analysis(file_1, file_2, output_prefix, 
-                                    ranking_measure=ranking_measure)
-            prefixes.append(output_prefix)
-        return prefixes
+            planned.append((file_1, file_2, output_prefix))
+        return planned
         
-    def compare_pseudoreps(self, pseudoreps, output_dir,
-                           ranking_measure='signal.value'):
+    def get_pseudorep_pairs(self, pseudoreps, output_dir):
         '''
-        Compare each pseudoreplicate to its mate.
+        List (file_1, file_2, output_prefix) pairing each 
+        pseudoreplicate with its mate.
         
         Warning:: 
             Assumes files are named such that pseudoreps are paired
@@ -47,24 +134,345 @@ class IdrCaller(object):
         
         # Sort our sets of pseudoreps so that we can find pairs
         sorted_reps = sorted(pseudoreps)
-        prefixes = []
+        planned = []
         for file_1, file_2 in zip(sorted_reps[::2],sorted_reps[1::2]):
-            file_1_name = os.path.splitext(os.path.basename(file_1))[0]
+            file_1_name = split_name(ColumnarTable.strip_extension(file_1))[0]
             filename = file_1_name + '-pair'
             output_prefix = os.path.join(output_dir, filename)
-            self.run_batch_analysis(file_1, file_2, output_prefix, 
-                                    ranking_measure=ranking_measure)
-            prefixes.append(output_prefix)
+            planned.append((file_1, file_2, output_prefix))
             
-        return prefixes
+        return planned
+    
+    def get_overlapped_peaks_file(self, output_prefix):
+        '''
+        Where the overlapped peaks for a comparison are written.
+        '''
+        return self.get_engine().get_overlapped_peaks_file(output_prefix)
+    
+    def run_pairs(self, pairs, ranking_measure='signal.value'):
+        '''
+        Run batch analysis for each (file_1, file_2, output_prefix).
+        
+        If start_executor was called, pairs run on its shared pool of
+        self.jobs workers, however few are passed; otherwise, with more
+        than one job and pair, on a pool of their own. Either way, each 
+        pair's output is written to output_prefix.log rather than 
+        interleaved on stdout. If any pair fails, pending pairs
+        are cancelled and the error is raised; outputs of pairs that 
+        already completed are left in place.
+        
+        With the numpy engine, if files are shared between pairs, as 
+        when comparing every pair of several replicates, each file is 
+        read and indexed just once, in a PeakSession that all pairs use.
+        
+        Returns the list of output prefixes, in the order passed.
+        '''
+        pairs = list(pairs)
+        session = self.open_session(pairs)
+        try:
+            self.run_pairs_in_session(pairs, ranking_measure, session)
+        finally:
+            if session is not None: session.close()
+        return [output_prefix for _, _, output_prefix in pairs]
+    
+    def open_session(self, pairs):
+        '''
+        A PeakSession of the files of pairs, in a scratch directory beside 
+        the first output, if the numpy engine would read any file more 
+        than once; otherwise None.
+        '''
+        files = [f for file_1, file_2, _ in pairs for f in (file_1, file_2)]
+        if self.engine != 'numpy' or len(set(files)) == len(files): 
+            return None
+        with profiling.stage('read peaks for session'):
+            return PeakSession.create(self.get_engine(), files, 
+                            parent_dir=os.path.dirname(
+                                        os.path.abspath(pairs[0][2])))
+    
+    def run_pairs_in_session(self, pairs, ranking_measure, session=None):
+        '''
+        Run batch analysis for each pair; see run_pairs.
+        '''
+        if not pairs: return
+        # Only run pairs inline when there is no shared pool: otherwise
+        # concurrent calls, each with a pair or two, would run side by 
+        # side on their callers' threads rather than on the pool.
+        if self._executor is None and (self.jobs <= 1 or len(pairs) <= 1):
+            init = None
+            for file_1, file_2, output_prefix in pairs:
+                self.run_batch_analysis(file_1, file_2, output_prefix, 
+                                        ranking_measure=ranking_measure,
+                                        init=init, session=session)
+                # With warm starts, each pair starts from the one before.
+                init = output_prefix + '-em-fit.json'
+            return
+        
+        executor, workers = self._executor, self.jobs
+        if executor is None:
+            workers = min(self.jobs, len(pairs))
+            executor = self.get_executor(workers)
+        futures = {}
+        for file_1, file_2, output_prefix in pairs:
+            future = executor.submit(self.run_batch_analysis, 
+                                     file_1, file_2, output_prefix,
+                                     ranking_measure=ranking_measure,
+                                     log_file=output_prefix + '.log',
+                                     session=session)
+            futures[future] = output_prefix
+        print('Running {} comparisons on {} workers.'.format(
+                                        len(pairs), workers))
+        
+        try:
+            for future in as_completed(futures):
+                output_prefix = futures[future]
+                try:
+                    future.result()
+                except Exception:
+                    print('!! Comparison failed; see {}.log'.format(
+                                                            output_prefix))
+                    raise
+                print('Finished comparison {}'.format(output_prefix))
+        except BaseException:
+            # Only this call's pairs are stopped: others sharing the pool,
+            # such as another experiment's in a batch, carry on.
+            for future in futures: future.cancel()
+            self.terminate_running(futures.values())
+            raise
+        finally:
+            if executor is not self._executor: executor.shutdown(wait=True)
+    
+    def get_executor(self, workers):
+        # R runs in child processes already, so threads suffice to drive 
+        # them; the numpy engine needs its own processes.
+        if self.engine == 'numpy': 
+            return ProcessPoolExecutor(max_workers=workers)
+        return ThreadPoolExecutor(max_workers=workers)
+    
+    def start_executor(self):
+        '''
+        Share one pool of self.jobs workers across all calls to run_pairs 
+        until shutdown, so that comparisons started concurrently, from 
+        different threads, still run at most self.jobs at a time.
+        '''
+        with self._lock:
+            if self._executor is None and self.jobs > 1:
+                self._executor = self.get_executor(self.jobs)
+    
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            r_pool, self._r_pool = self._r_pool, None
+        if executor is not None: executor.shutdown(wait=True)
+        if r_pool is not None: r_pool.close()
+    
+    def terminate_running(self, output_prefixes):
+        '''
+        Stop any Rscript processes or R worker jobs still running for 
+        comparisons to the passed output prefixes. The pool of R workers
+        stays open for other comparisons.
+        '''
+        output_prefixes = set(os.path.abspath(p) for p in output_prefixes)
+        with self._lock:
+            processes = [process for output_prefix, process 
+                         in self._processes.items() 
+                         if output_prefix in output_prefixes]
+            r_pool = self._r_pool
+        for process in processes:
+            if process.poll() is None: process.terminate()
+        if r_pool is not None: 
+            r_pool.terminate([p + '.log' for p in output_prefixes])
+    
+    def get_r_pool(self):
+        '''
+        The pool of R workers, started on first use; shut down with 
+        shutdown.
+        '''
+        with self._lock:
+            if self._r_pool is None:
+                self._r_pool = RWorkerPool(self.r_workers)
+            return self._r_pool
         
     def run_batch_analysis(self, file_1, file_2, output_prefix, 
-                           ranking_measure='signalValue'):
+                           ranking_measure='signalValue', log_file=None,
+                           init=None, session=None):
         '''
         Rscript batch-consistency-analysis.r [peakfile1] [peakfile2] 
             [peak.half.width] [outfile.prefix] 
             [min.overlap.ratio] [is.broadpeak] [ranking.measure]
-            
+        
+        If the numpy engine is selected, the same analysis runs in-process
+        and writes the same output files.
+        
+        If a genome was passed, its chromosome size table is used in place
+        of idrCode/genome_table.txt.
+        
+        Columnar narrowPeak inputs are exported to text for R next to
+        the output, and removed afterwards.
+        
+        If log_file is passed, stdout and stderr are written there.
+        
+        With warm starts, the numpy engine starts its EM fit from an 
+        earlier fit of this pair, if there is one, or else from init, the 
+        -em-fit.json of a sibling pair, if it exists.
+        
+        The numpy engine takes the peaks of both files from session, a
+        PeakSession, if it has them.
+        
+        With a cache, a comparison of files with the same contents, run
+        with the same parameters and code, is restored from the cache
+        rather than run again.
+        '''
+        init = self.get_warm_start(output_prefix, init)
+        if self.cache is None:
+            return self.compute_batch_analysis(file_1, file_2, output_prefix,
+                                    ranking_measure=ranking_measure, 
+                                    log_file=log_file, init=init,
+                                    session=session)
+        
+        key = self.get_cache_key(file_1, file_2, ranking_measure, init=init)
+        appended = self.cache.get_sizes(output_prefix, 
+                                        self.appended_suffixes)
+        if self.cache.fetch(key, output_prefix) is not None:
+            # Keys ignore file names, so the counts restored name the
+            # files of whichever run was stored; name ours instead.
+            self.rename_npeaks(output_prefix, appended[self.npeaks_suffix],
+                               *self.get_npeaks_names(file_1, file_2, 
+                                                      output_prefix))
+            print('Reusing cached comparison for {}'.format(output_prefix))
+            return
+        
+        suffixes = self.get_output_suffixes(output_prefix)
+        self.compute_batch_analysis(file_1, file_2, output_prefix,
+                                    ranking_measure=ranking_measure, 
+                                    log_file=log_file, init=init,
+                                    session=session)
+        self.cache.store(key, output_prefix, suffixes, appended=appended)
+    
+    def get_npeaks_names(self, file_1, file_2, output_prefix):
+        '''
+        The names the engine gives file_1 and file_2 in 
+        -npeaks-aboveIDR.txt: as passed for numpy, and for R as the 
+        absolute paths it is run on, including exported columnar inputs.
+        '''
+        if self.engine == 'numpy': return file_1, file_2
+        names = []
+        for i, filename in enumerate((file_1, file_2)):
+            if ColumnarTable.is_columnar(filename):
+                filename = output_prefix + '-input{}.narrowPeak'.format(i + 1)
+            names.append(os.path.abspath(filename))
+        return names
+    
+    def rename_npeaks(self, output_prefix, start, file_1, file_2):
+        '''
+        Rename the files compared in the lines of -npeaks-aboveIDR.txt 
+        from byte start on, keeping each line's cutoff and count.
+        '''
+        filename = output_prefix + self.npeaks_suffix
+        if not os.path.exists(filename): return
+        with open(filename, 'rb+') as f:
+            f.seek(start)
+            lines = f.read().decode().splitlines()
+            f.seek(start)
+            f.truncate()
+            for line in lines:
+                fields = line.split(' ')
+                f.write((' '.join([file_1, file_2] + fields[-2:]) 
+                         + '\n').encode())
+    
+    def get_warm_start(self, output_prefix, init=None):
+        '''
+        The fit file to warm start a comparison from, or None.
+        '''
+        if not self.warm_start: return None
+        for fit_file in (output_prefix + '-em-fit.json', init):
+            if fit_file and os.path.exists(fit_file): return fit_file
+        return None
+    
+    def get_cache_key(self, file_1, file_2, ranking_measure, init=None):
+        '''
+        Cache key for a comparison: the contents of both files, and of
+        the fit warm started from, the parameters, and the code of the 
+        engine.
+        '''
+        code_dir = os.path.dirname(os.path.realpath(__file__))
+        if self.engine == 'numpy':
+            code_files = [os.path.join(code_dir, f) for f in 
+                          ('idr_engine.py', 'overlap.py', 'genome.py', 
+                           'columnar.py')]
+        else:
+            code_files = [os.path.join(code_dir, 'idrCode', f) for f in
+                          ('batch-consistency-analysis.r', 
+                           'functions-all-clayton-12-13.r',
+                           'genome_table.txt')]
+        genome = None
+        if self.genome is not None:
+            genome = list(zip(self.genome.chroms, self.genome.sizes))
+        params = {'engine': self.engine, 'ranking_measure': ranking_measure,
+                  'half_width': None, 'overlap_ratio': 0, 
+                  'genome': genome, 'columnar': self.columnar,
+                  'compress': self.compress, 
+                  'em_acceleration': self.em_acceleration,
+                  'uri_points': self.uri_points}
+        input_files = [file_1, file_2] + ([init] if init else [])
+        return self.cache.get_key('batch_analysis', input_files, 
+                                  params=params, code_files=code_files)
+    
+    def get_output_suffixes(self, output_prefix):
+        if self.engine == 'numpy': suffixes = self.numpy_output_suffixes
+        else: suffixes = self.r_output_suffixes
+        overlapped = self.get_overlapped_peaks_file(output_prefix)
+        return (overlapped[len(output_prefix):],) + suffixes
+    
+    def compute_batch_analysis(self, file_1, file_2, output_prefix, 
+                               ranking_measure='signalValue', log_file=None,
+                               init=None, session=None):
+        '''
+        Run the comparison with the selected engine; see 
+        run_batch_analysis.
+        '''
+        with profiling.stage('compare ' + os.path.basename(output_prefix),
+                             kind='comparison'):
+            if self.engine == 'numpy':
+                if log_file:
+                    with open(log_file, 'w') as log, redirect_stdout(log),\
+                            redirect_stderr(log):
+                        try:
+                            self.get_engine().run_batch_analysis(
+                                    file_1, file_2, output_prefix, 
+                                    ranking_measure=ranking_measure, init=init,
+                                    session=session)
+                        except Exception:
+                            traceback.print_exc(file=log)
+                            raise
+                else:
+                    self.get_engine().run_batch_analysis(
+                                    file_1, file_2, output_prefix,
+                                    ranking_measure=ranking_measure, init=init,
+                                    session=session)
+                return
+        
+            # R reads text, so export any columnar inputs for it.
+            exported = []
+            try:
+                if ColumnarTable.is_columnar(file_1):
+                    file_1 = ColumnarTable.to_text(file_1, 
+                                    output_prefix + '-input1.narrowPeak')
+                    exported.append(file_1)
+                if ColumnarTable.is_columnar(file_2):
+                    file_2 = ColumnarTable.to_text(file_2, 
+                                    output_prefix + '-input2.narrowPeak')
+                    exported.append(file_2)
+                self.run_rscript(file_1, file_2, output_prefix, 
+                                 ranking_measure=ranking_measure, 
+                                 log_file=log_file)
+            finally:
+                for f in exported: os.remove(f)
+    
+    def run_rscript(self, file_1, file_2, output_prefix, 
+                    ranking_measure='signalValue', log_file=None):
+        '''
+        Run batch-consistency-analysis.r on two narrowPeak text files,
+        on the pool of R workers if there is one.
         '''
         # Make sure to cd into idrCode dir, as the r scripts call other scripts
         # assuming they are in the same directory.
@@ -75,15 +483,71 @@ class IdrCaller(object):
         file_2 = os.path.abspath(file_2)
         output_prefix = os.path.abspath(output_prefix)
         
+        if self.r_workers:
+            args = [file_1, file_2, -1, output_prefix, 0, 'F', 
+                    ranking_measure]
+            if self.genome is not None: args.append(self.get_genome_table())
+            return self.run_r_job('analysis', args, log_file=log_file)
+        
         cmd = 'cd {}'.format(os.path.join(os.path.dirname(
                             os.path.realpath(__file__)), 'idrCode'))\
                     + ' && Rscript batch-consistency-analysis.r'\
                     + ' {} {} {} {} {} {} {}'.format(
                                 file_1, file_2, -1,
                                 output_prefix, 0, 'F', ranking_measure)
-        print('Running command:')
-        print(cmd)
-        subprocess.check_call(cmd, shell=True)
+        if self.genome is not None:
+            cmd += ' {}'.format(self.get_genome_table())
+        if not log_file:
+            print('Running command:')
+            print(cmd)
+            profiling.check_call(cmd, name='batch-consistency-analysis.r',
+                                 shell=True)
+            return
+        
+        with open(log_file, 'w') as log:
+            log.write('Running command:\n' + cmd + '\n')
+            log.flush()
+            started = time.time()
+            process = subprocess.Popen(cmd, shell=True, 
+                                       stdout=log, stderr=log)
+            with self._lock: self._processes[output_prefix] = process
+            try:
+                profiling.wait(process, 'batch-consistency-analysis.r', 
+                               started)
+            finally:
+                with self._lock: del self._processes[output_prefix]
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+    
+    def run_r_job(self, job_type, args, log_file=None):
+        '''
+        Run an analysis or plot job, with the arguments its script takes,
+        on the pool of R workers.
+        '''
+        description = 'Running R worker job: {} {}'.format(job_type, 
+                                        ' '.join(str(a) for a in args))
+        if log_file:
+            with open(log_file, 'w') as log: log.write(description + '\n')
+        else: print(description)
+        self.get_r_pool().run(job_type, args, log_file=log_file)
+        
+    def get_engine(self):
+        return IdrEngine(genome=self.genome, columnar=self.columnar,
+                         compress=self.compress, 
+                         em_acceleration=self.em_acceleration,
+                         uri_points=self.uri_points)
+    
+    def get_genome_table(self):
+        '''
+        Absolute path to the chromosome size table for self.genome, for the
+        R code to read. Genomes built in Python from arrays have no table.
+        '''
+        available = Genome.available()
+        if self.genome.name in available: return available[self.genome.name]
+        if self.genome.name and os.path.isfile(self.genome.name):
+            return os.path.abspath(self.genome.name)
+        raise Exception('The r engine needs a genome table file; '
+                        + 'pass a bundled genome name or a table path.')
         
     def plot_comparisons(self, comparison_files, output_dir, output_prefix):
         '''
@@ -92,7 +556,28 @@ class IdrCaller(object):
         
         Rscript batch-consistency-plot.r [npairs] [output.prefix] 
             [input.file.prefix1] [input.file.prefix2] [input.file.prefix3] ...
+        
+        Comparisons run with the numpy engine are instead plotted with 
+        matplotlib from their saved summaries, to a file in plot_format.
         '''
+        if not comparison_files:
+            print('Skipping plots for {}; there are no comparisons.'.format(
+                                                            output_prefix))
+            return
+        if IdrPlotter.has_summaries(comparison_files):
+            plotter = IdrPlotter(self.plot_format)
+            output_file = plotter.get_output_file(
+                                    os.path.join(output_dir, output_prefix))
+            print('Plotting {} comparisons to {}'.format(
+                                    len(comparison_files), output_file))
+            with profiling.stage('plot ' + output_prefix):
+                return plotter.plot_comparisons(comparison_files, output_file)
+        if self.engine == 'numpy':
+            # The R plotting script needs the .sav files only R writes.
+            print('Skipping plots for {}; '.format(output_prefix)
+                  + 'no plot summaries were found.')
+            return
+        
         # Make sure to cd into idrCode dir, as the r scripts call other scripts
         # assuming they are in the same directory.
         
@@ -100,6 +585,10 @@ class IdrCaller(object):
         output_f = os.path.abspath(os.path.join(output_dir, output_prefix))
         comparison_files = [os.path.abspath(f) for f in comparison_files]
         
+        if self.r_workers:
+            return self.run_r_job('plot', [len(comparison_files), output_f]
+                                          + comparison_files)
+        
         cmd = 'cd {}'.format(os.path.join(os.path.dirname(
                             os.path.realpath(__file__)), 'idrCode'))\
                     + ' && Rscript batch-consistency-plot.r'\
@@ -109,6 +598,6 @@ class IdrCaller(object):
                                 ' '.join(comparison_files))
         print('Running command:')
         print(cmd)
-        subprocess.check_call(cmd, shell=True)
+        profiling.check_call(cmd, name='batch-consistency-plot.r', shell=True)
         
     
\ No newline at end of file
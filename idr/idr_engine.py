@@ -0,0 +1,853 @@
+'''
+A native NumPy implementation of the pairwise consistency analysis
+performed by batch-consistency-analysis.r and the function library in
+functions-all-clayton-12-13.r.
+
+The steps mirror the R code:
+
+1. process.narrowpeak: read and clean each narrowPeak file.
+2. pair.peaks.filter: pair overlapping peaks across the two replicates,
+   impute missing peaks, merge peaks that map to the same region, and
+   filter by overlap ratio. See idr.overlap.
+3. compute.pair.uri: compute the correspondence profile.
+4. fit.em: fit the two-component Gaussian copula mixture model.
+
+The outputs written are the same -overlapped-peaks.txt and
+-npeaks-aboveIDR.txt files, so downstream thresholding works unchanged.
+In place of R's -uri.sav and -em.sav, the curves plotted by
+batch-consistency-plot.r are saved to -plot-summary.json; see idr.plotting.
+'''
+import json
+import os
+import time
+
+import numpy as np
+from pandas import DataFrame
+from pandas.io.parsers import read_csv
+from scipy.interpolate import CubicSpline
+from scipy.linalg import solveh_banded
+from scipy.optimize import brentq, minimize_scalar
+from scipy.special import ndtri
+
+from idr.columnar import ColumnarTable, write_r_table
+from idr.compression import open_file
+from idr.genome import Genome
+from idr.idr_index import IdrIndex
+from idr.overlap import PeakOverlapper
+from idr import profiling
+
+class IdrEngine(object):
+    '''
+    Runs the IDR pairwise analysis in-process with vectorized NumPy,
+    as an alternative to shelling out to Rscript.
+    '''
+    # Map the R sig.value names to our narrowPeak column names
+    sig_value_columns = {'signal.value': 'signal_value',
+                         'signalValue': 'signal_value',
+                         'p.value': 'p_value',
+                         'q.value': 'q_value'}
+
+    # Grid used for the correspondence profile, as in compute.pair.uri,
+    # unless set otherwise
+    uri_grid = np.arange(1, 101)/100
+
+    # Degrees of freedom of the spline smoothing the correspondence
+    # profile of matched peaks, as in batch-consistency-plot.r
+    matched_spline_df = 10
+    # Quantiles of the number of peaks to plot the IDR at, as in 
+    # plot.ez.group
+    idr_plot_quantiles = np.arange(1, 100)/100
+
+    # IDR cutoffs reported in -npeaks-aboveIDR.txt
+    idr_cutoffs = np.arange(1, 26)/100
+    
+    # Options for accelerating the EM fit
+    em_accelerations = (None, 'squarem')
+
+    def __init__(self, half_width=None, overlap_ratio=0,
+                 p_value_impute=0, merge='mean', genome=None, seed=None,
+                 columnar=False, compress=False, em_acceleration=None,
+                 uri_points=100):
+        '''
+        half_width: None to use the reported peak widths, or an integer
+            half-width to truncate wider peaks to.
+        overlap_ratio: minimum overlap/shorter peak ratio for two peaks
+            to be considered a match. 0 means any overlap.
+        merge: how to merge multiple peaks from one replicate in the same
+            region; 'mean' as merge.peaks, or 'best' as merge.peaks.best.
+        genome: bundled genome name or chromosome size table to
+            concatenate chromosomes by, as the R code does with 
+            genome_table.txt. Peaks on other chromosomes are dropped. 
+        seed: seed for breaking ties randomly when ranking peaks.
+        columnar: write overlapped peaks as a binary columnar table
+            rather than text.
+        compress: write overlapped peaks as gzip-compressed text.
+        em_acceleration: None, or 'squarem' to accelerate the EM fit;
+            see fit_em.
+        uri_points: number of points t in (0, 1] to compute the 
+            correspondence profile at; R uses 100.
+        '''
+        self.half_width = half_width
+        self.overlap_ratio = overlap_ratio
+        self.merge = merge
+        self.genome = genome and Genome.get(genome)
+        self.p_value_impute = p_value_impute
+        self.random_state = np.random.RandomState(seed)
+        self.columnar = columnar
+        self.compress = compress
+        self.em_acceleration = em_acceleration
+        self.uri_grid = np.arange(1, uri_points + 1)/uri_points
+
+    def run_batch_analysis(self, file_1, file_2, output_prefix,
+                           ranking_measure='signal.value', init=None,
+                           session=None):
+        '''
+        Equivalent to:
+
+        Rscript batch-consistency-analysis.r [peakfile1] [peakfile2]
+            [peak.half.width] [outfile.prefix]
+            [min.overlap.ratio] [is.broadpeak] [ranking.measure]
+        
+        Pass init, an earlier fit or the -em-fit.json file of an earlier
+        run, to warm start the EM fit from it.
+        
+        Pass a PeakSession holding both files to use the peaks it has 
+        already read and indexed, rather than reading them again.
+        
+        Besides the files R writes, the fit is saved to -em-fit.json, 
+        its per-iteration log likelihood and timing to -em-trace.txt,
+        and the curves to plot to -plot-summary.json.
+        '''
+        genome, indexes = None, None
+        with profiling.stage('read peaks'):
+            if session is not None and session.has(file_1) \
+                    and session.has(file_2):
+                (rep_1, index_1), (rep_2, index_2) = session.get(file_1), \
+                                                     session.get(file_2)
+                genome, indexes = session.genome, (index_1, index_2)
+            else:
+                rep_1 = self.process_narrow_peaks(file_1)
+                rep_2 = self.process_narrow_peaks(file_2)
+                print('Read {}: {} peaks left after cleaning.'.format(
+                                                file_1, rep_1.shape[0]))
+                print('Read {}: {} peaks left after cleaning.'.format(
+                                                file_2, rep_2.shape[0]))
+
+        result = self.compare_peaks(rep_1, rep_2, 
+                                    ranking_measure=ranking_measure,
+                                    init=init, genome=genome, indexes=indexes)
+        with profiling.stage('write'):
+            self.write_comparison(result, file_1, file_2, output_prefix)
+        return result
+
+    def compare_peaks(self, rep_1, rep_2, ranking_measure='signal.value',
+                      init=None, genome=None, indexes=None):
+        '''
+        The analysis of run_batch_analysis, in memory: pair the cleaned 
+        peaks of two replicates, as from process_narrow_peaks, compute
+        the correspondence profile, and fit the copula mixture.
+        
+        Returns the uri, the em_fit, and the matched peaks of each
+        replicate, pruned_1 and pruned_2, with their idr_local and idr.
+        '''
+        with profiling.stage('pair peaks'):
+            merge_1, merge_2 = self.pair_peaks(rep_1, rep_2,
+                                        ranking_measure=ranking_measure,
+                                        genome=genome, indexes=indexes)
+        with profiling.stage('uri'):
+            uri = self.compute_uri(merge_1['sig_value'].values,
+                                   merge_2['sig_value'].values)
+
+        # Only matched peaks go into the EM fit
+        matched = (merge_1['sig_value'].values > self.p_value_impute)\
+                    & (merge_2['sig_value'].values > self.p_value_impute)
+        pruned_1, pruned_2 = merge_1[matched], merge_2[matched]
+        if isinstance(init, str): init = self.load_em_fit(init)
+        with profiling.stage('em'):
+            em_fit = self.fit_em(pruned_1['sig_value'].values,
+                                 pruned_2['sig_value'].values, init=init,
+                                 acceleration=self.em_acceleration)
+        print('EM estimation: p={p}, rho1={rho1}, rho2={rho2}'.format(
+                                                    **em_fit['para']))
+
+        idr_local = 1 - em_fit['e_z']
+        idr = self.get_idr(idr_local)
+        return {'uri': uri, 'em_fit': em_fit, 
+                'pruned_1': pruned_1, 'pruned_2': pruned_2,
+                'idr_local': idr_local, 'idr': idr}
+
+    def write_comparison(self, result, file_1, file_2, output_prefix):
+        '''
+        Write the files of a comparison from the result of compare_peaks;
+        file_1 and file_2 name the replicates in -npeaks-aboveIDR.txt.
+        '''
+        pruned_1, pruned_2 = result['pruned_1'], result['pruned_2']
+        idr, em_fit = result['idr'], result['em_fit']
+        self.write_overlapped_peaks(self.get_overlapped_peaks(pruned_1,
+                                            pruned_2, result['idr_local'], 
+                                            idr),
+                            self.get_overlapped_peaks_file(output_prefix))
+        self.write_npeaks_above_idr(file_1, file_2, idr,
+                            output_prefix + '-npeaks-aboveIDR.txt')
+        self.save_em_fit(em_fit, output_prefix + '-em-fit.json')
+        self.write_em_telemetry(em_fit, output_prefix + '-em-trace.txt')
+        with profiling.stage('plot summary'):
+            self.save_plot_summary(self.get_plot_summary(result['uri'], 
+                                                pruned_1, pruned_2, idr),
+                                   output_prefix + '-plot-summary.json')
+
+    ######################################################
+    # Reading peaks
+    ######################################################
+    def process_narrow_peaks(self, filename):
+        '''
+        Read a narrowPeak file and clean it as process.narrowpeak does:
+        drop zero-width peaks, make stops inclusive, optionally truncate
+        wide peaks around the summit, and fix stops that coincide with
+        other peaks' starts.
+        
+        Pass a DataFrame of the ten narrowPeak columns, in order, in 
+        place of a filename to clean peaks already in memory.
+
+        Returns a DataFrame with chrom, start, stop, start_ori, stop_ori,
+        signal_value, p_value, q_value, and summit columns.
+        '''
+        names = ['chrom', 'start', 'stop', 'signal_value',
+                 'p_value', 'q_value', 'summit']
+        if isinstance(filename, DataFrame):
+            data = filename.iloc[:, [0, 1, 2, 6, 7, 8, 9]].copy()
+            data.columns = names
+            data['chrom'] = np.asarray(data['chrom'], dtype=object)
+            for col in ('start', 'stop', 'summit'):
+                data[col] = data[col].astype(np.int64)
+            for col in ('signal_value', 'p_value', 'q_value'):
+                data[col] = data[col].astype(np.float64)
+        elif ColumnarTable.is_columnar(filename):
+            columns = [ColumnarTable.narrow_peak_columns[i] 
+                       for i in (0, 1, 2, 6, 7, 8, 9)]
+            data = ColumnarTable.read(filename, columns=columns)
+            data.columns = names
+            data['chrom'] = np.asarray(data['chrom'], dtype=object)
+            # Integers are stored narrowed; widen them for arithmetic.
+            for col in ('start', 'stop', 'summit'):
+                data[col] = data[col].astype(np.int64)
+        else:
+            with open_file(filename, 'r') as f:
+                data = read_csv(f, sep=r'\s+', header=None,
+                                usecols=[0, 1, 2, 6, 7, 8, 9], names=names,
+                                dtype={'chrom': str})
+
+        keep = data['start'] != data['stop']
+        if self.genome is not None:
+            in_genome = self.genome.get_codes(data['chrom'].values) >= 0
+            if not in_genome.all():
+                print('Drop {} peaks on chromosomes not in genome {}'.format(
+                                (~in_genome).sum(), self.genome.name))
+            keep &= in_genome
+        data = data[keep].reset_index(drop=True)
+        data['start_ori'] = data['start']
+        data['stop_ori'] = data['stop']
+
+        # Stops are exclusive in narrowPeak format.
+        start = data['start'].values.copy()
+        stop = data['stop'].values - 1
+
+        if self.half_width is not None:
+            # Chop peaks wider than the window to the window around
+            # the summit offset.
+            is_wider = (stop - start + 1) > 2*self.half_width
+            summit = data['start_ori'].values + data['summit'].values
+            start[is_wider] = summit[is_wider] - self.half_width
+            stop[is_wider] = summit[is_wider] + self.half_width
+
+        data['start'], data['stop'] = start, stop
+        data = data[data['start'] != data['stop']].reset_index(drop=True)
+
+        # If some stops and starts are the same, fix them.
+        chrom_codes = data['chrom'].astype('category').cat.codes.values
+        span = int(max(data['stop'].max(), data['start'].max())) + 1 \
+                    if data.shape[0] else 1
+        start_keys = chrom_codes.astype(np.int64)*span + data['start'].values
+        stop_keys = chrom_codes.astype(np.int64)*span + data['stop'].values
+        stop_in_start = np.isin(stop_keys, start_keys)
+        if stop_in_start.any():
+            print('Fix {} stops'.format(stop_in_start.sum()))
+            data.loc[stop_in_start, 'stop'] -= 1
+
+        return data
+
+    ######################################################
+    # Pairing peaks across replicates
+    ######################################################
+    def pair_peaks(self, rep_1, rep_2, ranking_measure='signal.value',
+                   genome=None, indexes=None):
+        '''
+        Pair peaks across replicates, as pair.peaks.filter does, with
+        PeakOverlapper. Replicates are DataFrames, or dicts of arrays.
+        
+        Pass the indexes of both replicates, with the genome they were
+        indexed by, to pair them without indexing them again.
+        
+        Returns two aligned DataFrames, one row per region.
+        '''
+        sig_col = self.sig_value_columns[ranking_measure]
+        overlapper = PeakOverlapper(overlap_ratio=self.overlap_ratio,
+                                    impute_value=self.p_value_impute,
+                                    merge=self.merge, 
+                                    genome=genome or self.genome)
+        reps = []
+        for rep in (rep_1, rep_2):
+            rep = dict((col, np.asarray(rep[col])) for col in rep)
+            rep['sig_value'] = rep[sig_col]
+            reps.append(rep)
+        merge_1, merge_2 = overlapper.pair_peaks(*reps, indexes=indexes)
+        return DataFrame(merge_1), DataFrame(merge_2)
+
+    ######################################################
+    # Correspondence profile
+    ######################################################
+    def compute_uri(self, x_1, x_2, tt=None, spline_df=6.4):
+        '''
+        Compute the correspondence profile (upper rank intersection)
+        as get.uri.2d does: for each t, the proportion of peaks in the
+        top t on both replicates.
+        
+        Rather than scanning the ordered values once per t, as comp.uri 
+        does, each peak is assigned the first t at which it is counted,
+        so the whole curve comes from one sort and one cumulative count, 
+        and a grid of 1000 points costs little more than one of 100.
+        
+        Also returns the first derivative of the smoothing spline fit to
+        the curve up to the jump, as uri_der, in place of R's uri.der.
+        '''
+        if tt is None: tt = self.uri_grid
+        tt = np.asarray(tt, dtype=np.float64)
+        n = x_1.shape[0]
+
+        # Sort x_2 by decreasing x_1, breaking ties by x_2.
+        order = np.lexsort((-x_2, -x_1))
+        x_2_ordered = x_2[order]
+
+        # Peak i counts for t once it is within the top ceil(n*t) by x_1,
+        # and its x_2 is at least the 1 - t quantile. Both hold from some 
+        # t on, as t increases.
+        t_order = np.argsort(tt, kind='mergesort')
+        t_sorted = tt[t_order]
+        q = np.percentile(x_2_ordered, 100*(1 - t_sorted))
+        top = np.ceil(n*t_sorted).astype(np.int64)
+        first_by_rank = np.searchsorted(top, np.arange(n), side='right')
+        first_by_value = t_sorted.shape[0] - np.searchsorted(
+                                        q[::-1], x_2_ordered, side='right')
+        counts = np.cumsum(np.bincount(
+                            np.maximum(first_by_rank, first_by_value),
+                            minlength=t_sorted.shape[0] + 1))
+        uri = np.empty(tt.shape[0])
+        uri[t_order] = counts[:t_sorted.shape[0]]/n
+
+        # Slope of the URI from every fourth point of the default grid
+        step = max(tt.shape[0]//25, 1)
+        uri_binned, tt_binned = uri[::step], tt[::step]
+        uri_slope = np.diff(uri_binned)/np.diff(tt_binned)
+
+        # Don't fit the jump beyond the shorter list
+        short_list_length = min(np.count_nonzero(x_1 > 0)/n,
+                                np.count_nonzero(x_2 > 0)/n)
+        if short_list_length < tt.max():
+            jump_left = int(np.argmax(tt > short_list_length))
+        else:
+            jump_left = int(np.argmax(tt)) + 1
+        if jump_left < 6: jump_left = tt.shape[0]
+        
+        uri_spline, uri_der = self.fit_smoothing_spline(tt[:jump_left],
+                                            uri[:jump_left], df=spline_df)
+
+        return {'tv': np.column_stack((tt, tt)), 'uri': uri,
+                'uri_slope': uri_slope, 't_binned': tt_binned[1:],
+                'uri_spline': uri_spline, 'uri_der': uri_der,
+                'jump_left': jump_left, 'ntotal': n}
+    
+    def fit_smoothing_spline(self, x, y, df=6.4):
+        '''
+        Fit a cubic smoothing spline with knots at every x, smoothed to
+        df equivalent degrees of freedom, as smooth.spline(x, y, df=df).
+        R's smooth.spline places fewer knots for more than 49 points, so 
+        fits agree closely rather than exactly.
+        
+        Uses the Reinsch form of Green and Silverman (1994): the fit is 
+        y - lambda*Q*gamma, where (R + lambda*Q'Q) gamma = Q'y, and its 
+        degrees of freedom are n - lambda*tr((R + lambda*Q'Q)^-1 Q'Q).
+        R and Q'Q are banded, so each solve is linear in n, and lambda is 
+        found by root finding on the degrees of freedom.
+        
+        Returns the fitted values and the first derivative of the
+        fit at each x.
+        '''
+        n = x.shape[0]
+        fitted = np.asarray(y, dtype=np.float64).copy()
+        if n < 2: return fitted, np.zeros(n)
+        if n > 3 and df < n:
+            h = np.diff(x)
+            # The three nonzero entries of each column of Q
+            a, b, c = 1/h[:-1], -1/h[:-1] - 1/h[1:], 1/h[1:]
+            qtq = (a**2 + b**2 + c**2, 
+                   b[:-1]*a[1:] + c[:-1]*b[1:],
+                   c[:-2]*a[2:])
+            qtq_dense = np.diag(qtq[0]) + np.diag(qtq[1], 1)\
+                            + np.diag(qtq[1], -1) + np.diag(qtq[2], 2)\
+                            + np.diag(qtq[2], -2)
+            qty = a*fitted[:-2] + b*fitted[1:-1] + c*fitted[2:]
+            
+            def get_band(lam):
+                # Upper banded form of R + lambda*Q'Q, for solveh_banded
+                band = np.zeros((3, n - 2))
+                band[2] = (h[:-1] + h[1:])/3 + lam*qtq[0]
+                band[1, 1:] = h[1:-1]/6 + lam*qtq[1]
+                band[0, 2:] = lam*qtq[2]
+                return band
+            
+            def get_excess_df(log_lam):
+                lam = np.exp(log_lam)
+                trace = np.trace(solveh_banded(get_band(lam), qtq_dense))
+                return n - lam*trace - df
+            
+            # Degrees of freedom fall from n towards 2 as lambda grows.
+            lam = np.exp(brentq(get_excess_df, -40, 20, xtol=1e-8))
+            gamma = lam*solveh_banded(get_band(lam), qty)
+            fitted[:-2] -= a*gamma
+            fitted[1:-1] -= b*gamma
+            fitted[2:] -= c*gamma
+        
+        # The smoothing spline is the natural cubic spline through its
+        # fitted values.
+        derivative = CubicSpline(x, fitted, bc_type='natural').derivative()
+        return fitted, derivative(x)
+
+    ######################################################
+    # Copula mixture model
+    ######################################################
+    def fit_em(self, sig_1, sig_2, p0=0.5, rho1_0=0.7, rho2_0=0, eps=0.01,
+               fix_p=False, fix_rho2=True, max_iterations=1000, init=None,
+               acceleration=None):
+        '''
+        Fit the two-component Gaussian copula mixture, as fit.em and
+        em.2gaussian.quick do, with nonparametric histogram marginals.
+        
+        init: an earlier fit to start from rather than from p0, such as
+            the fit of a sibling pseudorep pair or an earlier run of the 
+            same pair; see load_em_fit. Its marginals are rescaled to the 
+            number of peaks here.
+        acceleration: None for plain EM, stopped by the Aitken criterion 
+            as in R, or 'squarem' to extrapolate along each pair of EM 
+            steps until the log likelihood changes by less than eps, and
+            then finish with plain EM.
+
+        Returns a dict with the fitted parameters, e_z (the posterior
+        probability of each pair being reproducible), the log
+        likelihood trace, and telemetry: the log likelihood, EM steps 
+        taken, and elapsed seconds at each iteration.
+        '''
+        if acceleration not in self.em_accelerations:
+            raise Exception('Unknown EM acceleration "{}". Options are: {}'\
+                            .format(acceleration, ', '.join(
+                                    str(a) for a in self.em_accelerations)))
+        start = time.time()
+        
+        # Rank the negated significance values, breaking ties randomly.
+        x = self.rank_randomly(-sig_1)
+        y = self.rank_randomly(-sig_2)
+        n = x.shape[0]
+
+        xy_min, xy_max = min(x.min(), y.min()), max(x.max(), y.max())
+        binwidth = (xy_max - xy_min)/50
+        breaks = np.linspace(xy_min - binwidth/100, xy_max + binwidth/100, 51)
+        # Ranks stay in the same bins throughout, so find them once.
+        bins = (self.get_bins(x, breaks), self.get_bins(y, breaks))
+        
+        def fix(p, rho1, rho2):
+            return (p0 if fix_p else p), rho1, (rho2_0 if fix_rho2 else rho2)
+        
+        def em_step(p, rho1, rho2, para):
+            e_z = self.e_step(p, rho1, rho2, para)
+            para = self.m_step(x, y, e_z, breaks, fix_rho2, bins=bins)
+            return fix(para['p'], para['rho1'], para['rho2']) + (para, e_z)
+        
+        if init is None:
+            # Initial assignment: the first p0 share are reproducible
+            n_1 = int(np.floor(n*p0 + .5))
+            e_z = np.r_[np.repeat(.9, n_1), np.repeat(.1, n - n_1)]
+            para = self.m_step(x, y, e_z, breaks, fix_rho2, bins=bins)
+        else:
+            para = self.get_warm_start(init, x, y, breaks, bins)
+            e_z = self.e_step(para['p'], para['rho1'], para['rho2'], para)
+        p, rho1, rho2 = fix(para['p'], para['rho1'], para['rho2'])
+
+        loglik_trace = [self.loglik(p, rho1, rho2, para)]
+        telemetry = [{'iteration': 0, 'loglik': loglik_trace[0], 
+                      'em_steps': 0, 'seconds': time.time() - start}]
+        em_steps, plain_start = 0, 0
+        accelerating = acceleration == 'squarem'
+        to_run = True
+        while to_run and len(loglik_trace) < max_iterations:
+            if accelerating:
+                p, rho1, rho2, para, e_z, steps = self.squarem_step(
+                                        em_step, p, rho1, rho2, para, 
+                                        loglik_trace[-1], x, y, breaks, bins)
+                em_steps += steps
+            else:
+                p, rho1, rho2, para, e_z = em_step(p, rho1, rho2, para)
+                em_steps += 1
+
+            loglik_trace.append(self.loglik(p, rho1, rho2, para))
+            telemetry.append({'iteration': len(loglik_trace) - 1, 
+                              'loglik': loglik_trace[-1], 
+                              'em_steps': em_steps, 
+                              'seconds': time.time() - start})
+
+            if accelerating:
+                # Once extrapolation stops gaining, finish with plain EM
+                # steps, so the fit stops by the same criterion as in R.
+                if abs(loglik_trace[-1] - loglik_trace[-2]) <= eps:
+                    accelerating = False
+                    plain_start = len(loglik_trace) - 1
+            elif len(loglik_trace) - plain_start > 2:
+                # Aitken acceleration criterion
+                l_2, l_1, l_0 = loglik_trace[-3:]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    l_inf = l_2 + (l_1 - l_2)/(1 - (l_0 - l_1)/(l_1 - l_2))
+                to_run = bool(abs(l_inf - l_0) > eps)
+        
+        print('EM fit in {} iterations, {} EM steps, {:.2f}s'.format(
+                len(loglik_trace) - 1, em_steps, time.time() - start))
+        return {'para': {'p': para['p'], 'rho1': rho1, 'rho2': rho2},
+                'loglik': loglik_trace[-1], 'loglik_trace': loglik_trace,
+                'telemetry': telemetry, 'e_z': e_z, 'breaks': breaks,
+                'x_mar': para['x_mar'], 'y_mar': para['y_mar']}
+    
+    def squarem_step(self, em_step, p, rho1, rho2, para, loglik,
+                     x, y, breaks, bins):
+        '''
+        One SQUAREM iteration (Varadhan and Roland, 2008, scheme S3):
+        take two EM steps, extrapolate along them, and take one more EM
+        step from there to stabilize. If that loses likelihood, keep the
+        second plain EM step instead.
+        
+        Returns p, rho1, rho2, para, e_z, and the number of EM steps taken.
+        '''
+        theta_0 = self.pack_para(p, rho1, rho2, para)
+        step_1 = em_step(p, rho1, rho2, para)
+        step_2 = em_step(*step_1[:4])
+        r = self.pack_para(*step_1[:4]) - theta_0
+        v = self.pack_para(*step_2[:4]) - theta_0 - 2*r
+        if not (v**2).sum(): return step_2 + (2,)
+        
+        alpha = min(-np.sqrt((r**2).sum()/(v**2).sum()), -1)
+        theta = theta_0 - 2*alpha*r + alpha**2*v
+        step_3 = em_step(*self.unpack_para(theta, x, y, breaks, bins))
+        if self.loglik(*step_3[:4]) >= self.loglik(*step_2[:4]):
+            return step_3 + (3,)
+        return step_2 + (2,)
+    
+    def pack_para(self, p, rho1, rho2, para):
+        '''
+        The parameters as one vector: p, the correlations, and the
+        density of each marginal in each bin.
+        '''
+        return np.r_[p, rho1, rho2, para['x_mar']['f1']['density'],
+                     para['x_mar']['f2']['density'],
+                     para['y_mar']['f1']['density'],
+                     para['y_mar']['f2']['density']]
+    
+    def unpack_para(self, theta, x, y, breaks, bins):
+        '''
+        Inverse of pack_para, projecting extrapolated values back into 
+        bounds: p in (0, 1), correlations in the range optimized over, 
+        and positive densities with the same total mass.
+        
+        Returns p, rho1, rho2, and para.
+        '''
+        nbin = breaks.shape[0] - 1
+        binwidth = np.diff(breaks)
+        p = min(max(theta[0], 1e-6), 1 - 1e-6)
+        rho1, rho2 = np.clip(theta[1:3], -0.998, 0.998)
+        densities = theta[3:].reshape(4, nbin)
+        para = {'p': p, 'rho1': rho1, 'rho2': rho2}
+        for i, (name, values, value_bins) in enumerate((
+                                ('x_mar', x, bins[0]), ('y_mar', y, bins[1]))):
+            mass = (x.shape[0] + nbin)/(x.shape[0] + nbin + 1)
+            marginals = {}
+            for j, component in enumerate(('f1', 'f2')):
+                density = np.maximum(densities[2*i + j], 1e-12)
+                density *= mass/(density*binwidth).sum()
+                marginals.update(self.get_marginal(density, values, breaks, 
+                                                   value_bins, component))
+            para[name] = marginals
+        return p, rho1, rho2, para
+    
+    def get_warm_start(self, init, x, y, breaks, bins):
+        '''
+        Parameters to start EM from, from an earlier fit. Marginal 
+        densities are over ranks, so those of a fit of a different number 
+        of peaks are rescaled to these breaks, and interpolated.
+        '''
+        init_breaks = np.asarray(init['breaks'])
+        scale = (breaks[-1] - breaks[0])/(init_breaks[-1] - init_breaks[0])
+        init_mids = (init_breaks[:-1] - init_breaks[0])*scale + breaks[0]\
+                        + np.diff(init_breaks)*scale/2
+        mids = (breaks[:-1] + breaks[1:])/2
+        theta = [init['para']['p'], init['para']['rho1'], 
+                 init['para']['rho2']]
+        for name in ('x_mar', 'y_mar'):
+            for component in ('f1', 'f2'):
+                density = np.asarray(init[name][component]['density'])
+                theta.append(np.interp(mids, init_mids, density/scale))
+        return self.unpack_para(np.hstack(theta), x, y, breaks, bins)[3]
+    
+    def save_em_fit(self, em_fit, filename):
+        '''
+        Save the parameters and marginal densities of a fit, for later
+        fits to warm start from.
+        '''
+        fit = {'para': dict((k, float(v)) for k, v in em_fit['para'].items()),
+               'breaks': em_fit['breaks'].tolist(),
+               'loglik': float(em_fit['loglik'])}
+        for name in ('x_mar', 'y_mar'):
+            fit[name] = dict((component, 
+                    {'density': em_fit[name][component]['density'].tolist()})
+                    for component in ('f1', 'f2'))
+        with open(filename, 'w') as f: json.dump(fit, f)
+    
+    def load_em_fit(self, filename):
+        with open(filename, 'r') as f: return json.load(f)
+    
+    def write_em_telemetry(self, em_fit, output_file):
+        '''
+        Write the log likelihood, EM steps, and elapsed time at each
+        iteration, tab-delimited.
+        '''
+        DataFrame(em_fit['telemetry']).to_csv(output_file, sep='\t', 
+                                              index=False)
+
+    def rank_randomly(self, x):
+        '''
+        Rank values from 1 to n, breaking ties at random.
+        '''
+        order = np.lexsort((self.random_state.random_sample(x.shape[0]), x))
+        ranks = np.empty(x.shape[0])
+        ranks[order] = np.arange(1, x.shape[0] + 1)
+        return ranks
+    
+    def get_bins(self, x, breaks):
+        '''
+        Bin of each value, with bins closed on the left but the last
+        closed on both sides, as in est.mar.hist.
+        '''
+        bins = np.searchsorted(breaks, x, side='right') - 1
+        return np.minimum(bins, breaks.shape[0] - 2)
+
+    def est_mar_hist(self, x, e_z, breaks, bins=None):
+        '''
+        Histogram estimator of each component's marginal density,
+        as est.mar.hist. Each bin gets one pseudo-observation to avoid
+        empty bins. Weights are summed per bin with one bincount rather
+        than a mask per bin; pass bins, from get_bins, to reuse them.
+
+        Returns the bin densities and starting cdfs for each component,
+        and the pdf and cdf values at each point in x.
+        '''
+        if bins is None: bins = self.get_bins(x, breaks)
+        nbin = breaks.shape[0] - 1
+        nx = x.shape[0]
+        binwidth = np.diff(breaks)
+        scale = (nx + nbin)/(nx + nbin + 1)
+
+        marginals = {}
+        for name, weight in (('f1', e_z), ('f2', 1 - e_z)):
+            weight_sums = np.bincount(bins, weights=weight, minlength=nbin)
+            density = (weight_sums + 1)/(weight.sum() + nbin)/binwidth*scale
+            marginals.update(self.get_marginal(density, x, breaks, bins, name))
+        return marginals
+    
+    def get_marginal(self, density, x, breaks, bins, name):
+        '''
+        The marginal for bin densities, with its pdf and cdf at each
+        point in x, keyed as in est_mar_hist.
+        '''
+        cdf = np.r_[0, np.cumsum(density*np.diff(breaks))[:-1]]
+        return {name: {'breaks': breaks, 'density': density, 'cdf': cdf},
+                name + '_value': {'pdf': density[bins], 
+                                  'cdf': cdf[bins] + density[bins]\
+                                                *(x - breaks[bins])}}
+
+    def m_step(self, x, y, e_z, breaks, fix_rho2, bins=(None, None)):
+        '''
+        Update marginals, copula correlations and the mixing proportion.
+        '''
+        x_mar = self.est_mar_hist(x, e_z, breaks, bins=bins[0])
+        y_mar = self.est_mar_hist(y, e_z, breaks, bins=bins[1])
+
+        rho1 = self.mle_gaussian_copula(x_mar['f1_value']['cdf'],
+                                        y_mar['f1_value']['cdf'], e_z)
+        if not fix_rho2:
+            rho2 = self.mle_gaussian_copula(x_mar['f2_value']['cdf'],
+                                            y_mar['f2_value']['cdf'], 1 - e_z)
+        else: rho2 = 0
+
+        return {'p': e_z.sum()/e_z.shape[0], 'rho1': rho1, 'rho2': rho2,
+                'x_mar': x_mar, 'y_mar': y_mar}
+
+    def e_step(self, p, rho1, rho2, para):
+        '''
+        Posterior probability of each pair belonging to the
+        reproducible component.
+        '''
+        x_mar, y_mar = para['x_mar'], para['y_mar']
+        c1 = self.gaussian_copula_density(x_mar['f1_value']['cdf'],
+                                          y_mar['f1_value']['cdf'], rho1)
+        c2 = self.gaussian_copula_density(x_mar['f2_value']['cdf'],
+                                          y_mar['f2_value']['cdf'], rho2)
+        d1 = p*c1*x_mar['f1_value']['pdf']*y_mar['f1_value']['pdf']
+        d2 = (1 - p)*c2*x_mar['f2_value']['pdf']*y_mar['f2_value']['pdf']
+        return d1/(d1 + d2)
+
+    def loglik(self, p, rho1, rho2, para):
+        '''
+        Log likelihood of the two Gaussian copula mixture.
+        '''
+        x_mar, y_mar = para['x_mar'], para['y_mar']
+        c1 = self.gaussian_copula_density(x_mar['f1_value']['cdf'],
+                                          y_mar['f1_value']['cdf'], rho1)
+        c2 = self.gaussian_copula_density(x_mar['f2_value']['cdf'],
+                                          y_mar['f2_value']['cdf'], rho2)
+        return np.log(p*c1*x_mar['f1_value']['pdf']*y_mar['f1_value']['pdf']
+                      + (1 - p)*c2*x_mar['f2_value']['pdf']
+                                    *y_mar['f2_value']['pdf']).sum()
+
+    def gaussian_copula_density(self, t, s, rho):
+        '''
+        Bivariate Gaussian copula density for percentiles t and s.
+        '''
+        q_t, q_s = ndtri(t), ndtri(s)
+        return np.exp(self.gaussian_copula_loglik(q_t**2 + q_s**2,
+                                                  q_t*q_s, rho))
+
+    def gaussian_copula_loglik(self, a, b, rho):
+        return -np.log(1 - rho**2)/2 - rho/(2*(1 - rho**2))*(rho*a - 2*b)
+
+    def mle_gaussian_copula(self, t, s, e_z):
+        '''
+        Maximize the weighted copula log likelihood over rho, as
+        mle.gaussian.copula does with optimize.
+        '''
+        q_t, q_s = ndtri(t), ndtri(s)
+        a, b = q_t**2 + q_s**2, q_t*q_s
+        result = minimize_scalar(
+                    lambda rho: -(e_z*self.gaussian_copula_loglik(a, b, rho)
+                                  ).sum(),
+                    bounds=(-0.998, 0.998), method='bounded',
+                    options={'xatol': 0.00001})
+        return result.x
+
+    ######################################################
+    # Output
+    ######################################################
+    def get_idr(self, idr_local):
+        '''
+        The IDR of each peak is the mean local IDR of all peaks with
+        local IDR no greater than its own.
+        '''
+        order = np.argsort(idr_local, kind='mergesort')
+        idr = np.empty(idr_local.shape[0])
+        idr[order] = np.cumsum(idr_local[order])\
+                        /np.arange(1, idr_local.shape[0] + 1)
+        return idr
+
+    def get_overlapped_peaks_file(self, output_prefix):
+        if self.columnar: extension = ColumnarTable.extension
+        elif self.compress: extension = '.txt.gz'
+        else: extension = '.txt'
+        return output_prefix + '-overlapped-peaks' + extension
+    
+    def get_overlapped_peaks(self, pruned_1, pruned_2, idr_local, idr):
+        '''
+        Matched peaks with their local IDR and IDR, in the columns of
+        -overlapped-peaks files.
+        '''
+        return DataFrame({'chr1': pruned_1['chrom'].values, 
+                          'start1': pruned_1['start_ori'].values,
+                          'stop1': pruned_1['stop_ori'].values,
+                          'sig.value1': pruned_1['sig_value'].values,
+                          'chr2': pruned_2['chrom'].values,
+                          'start2': pruned_2['start_ori'].values,
+                          'stop2': pruned_2['stop_ori'].values,
+                          'sig.value2': pruned_2['sig_value'].values,
+                          'idr.local': idr_local, 'IDR': idr})
+    
+    def write_overlapped_peaks(self, data, output_file):
+        '''
+        Write overlapped peaks, as from get_overlapped_peaks, in the
+        format R's write.table produces: space separated,
+        quoted strings, and row names. Files named with the columnar
+        extension are written as columnar tables instead, and files 
+        named .gz are compressed.
+        
+        The sorted IDR values are saved alongside as an IdrIndex.
+        '''
+        if output_file.endswith(ColumnarTable.extension):
+            ColumnarTable.write(data, output_file, kind='overlapped-peaks')
+        else:
+            with open_file(output_file, 'w') as f: write_r_table(data, f)
+        IdrIndex.write(data['IDR'].values, output_file)
+        print('Write overlapped peaks and local idr to: ' + output_file)
+
+    def get_plot_summary(self, uri, pruned_1, pruned_2, idr):
+        '''
+        The curves batch-consistency-plot.r draws for a comparison, 
+        scaled from proportions to numbers of peaks as scale.t2n does:
+        the correspondence profiles of all peaks and of matched peaks,
+        and the IDR against the number of peaks selected, at the 
+        quantiles get.ez.tt.all and plot.ez.group use.
+        '''
+        matched = self.compute_uri(pruned_1['sig_value'].values,
+                                   pruned_2['sig_value'].values,
+                                   spline_df=self.matched_spline_df)
+        idr = np.sort(idr)
+        n_plot = np.round(1 + self.idr_plot_quantiles*(idr.shape[0] - 1))
+        n_plot = n_plot.astype(int)
+        return {'all': self.scale_uri(uri), 'matched': self.scale_uri(matched),
+                'idr': {'npeaks': idr.shape[0], 'n': n_plot.tolist(), 
+                        'idr': idr[n_plot - 1].tolist()}}
+    
+    def scale_uri(self, uri):
+        '''
+        Equivalent to scale.t2n, keeping only what is plotted.
+        '''
+        ntotal, jump_left = uri['ntotal'], uri['jump_left']
+        tt = uri['tv'][:, 0]*ntotal
+        return {'ntotal': int(ntotal), 'jump_left': int(jump_left),
+                'tv': tt.tolist(), 'uri': (uri['uri']*ntotal).tolist(),
+                't_binned': (uri['t_binned']*ntotal).tolist(),
+                'uri_slope': uri['uri_slope'].tolist(),
+                'uri_spline': (uri['uri_spline']*ntotal).tolist(),
+                'uri_der': uri['uri_der'].tolist()}
+    
+    def save_plot_summary(self, summary, filename):
+        with open(filename, 'w') as f: json.dump(summary, f)
+    
+    def write_npeaks_above_idr(self, file_1, file_2, idr, output_file):
+        '''
+        Append the number of peaks passing each IDR cutoff from
+        0.01 to 0.25, as batch-consistency-analysis.r does.
+        '''
+        counts = self.count_within_idr_cutoffs(idr)
+        with open(output_file, 'a') as f:
+            for cutoff, count in zip(self.idr_cutoffs, counts):
+                f.write('{} {} {:.15g} {}\n'.format(file_1, file_2,
+                                                    cutoff, count))
+        print('Write number of peaks above IDR cutoff [0.01, 0.25]: '
+              + os.path.basename(output_file))
+    
+    def count_within_idr_cutoffs(self, idr):
+        '''
+        Number of peaks with IDR no greater than each of idr_cutoffs.
+        '''
+        return np.searchsorted(np.sort(idr), self.idr_cutoffs, side='right')
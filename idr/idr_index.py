@@ -0,0 +1,101 @@
+'''
+A sorted index of the IDR values of a comparison, saved next to its
+-overlapped-peaks file, so that the number of peaks within any IDR
+threshold is a binary search rather than a parse of the whole file.
+
+Indexes are written by the numpy engine along with its results, and
+built on first use for results from R, or for any index older than its
+overlapped peaks file.
+'''
+import os
+
+import numpy as np
+from pandas import DataFrame
+from pandas.io.parsers import read_csv
+
+from idr.columnar import ColumnarTable
+from idr.compression import open_file, strip_compression
+
+class IdrIndex(object):
+    '''
+    Sorted IDR values of one comparison.
+    '''
+    extension = '.idr.npy'
+
+    def __init__(self, idr):
+        self.idr = idr
+
+    @classmethod
+    def get_index_file(cls, idr_file):
+        '''
+        x-overlapped-peaks.txt, x-overlapped-peaks.txt.gz, and 
+        x-overlapped-peaks.cols are all indexed in 
+        x-overlapped-peaks.idr.npy.
+        '''
+        base = strip_compression(ColumnarTable.strip_extension(idr_file))
+        if base.endswith('.txt'): base = base[:-len('.txt')]
+        return base + cls.extension
+
+    @classmethod
+    def write(cls, idr, idr_file):
+        '''
+        Sort and save the IDR values of idr_file.
+        '''
+        index = cls(np.sort(np.asarray(idr, dtype=np.float64), kind='mergesort'))
+        index_file = cls.get_index_file(idr_file)
+        # Write beside the target and rename, so that concurrent
+        # readers never load half an index.
+        tmp_file = index_file + '.tmp.npy'
+        np.save(tmp_file, index.idr)
+        os.replace(tmp_file, index_file)
+        return index
+
+    @classmethod
+    def build(cls, idr_file):
+        '''
+        Read the IDR column of idr_file and index it. If the index cannot
+        be saved, for example in a read-only directory, it is still
+        returned.
+        '''
+        if ColumnarTable.is_columnar(idr_file):
+            idr = ColumnarTable.read(idr_file, columns=['IDR'])['IDR'].values
+        else:
+            with open_file(idr_file, 'r') as f:
+                idr = read_csv(f, sep=' ', header=0,
+                               usecols=['IDR'])['IDR'].values
+        try:
+            return cls.write(idr, idr_file)
+        except (IOError, OSError):
+            return cls(np.sort(idr.astype(np.float64), kind='mergesort'))
+
+    @classmethod
+    def load(cls, idr_file):
+        '''
+        The index for idr_file, built if it is missing or stale.
+        '''
+        index_file = cls.get_index_file(idr_file)
+        if os.path.exists(index_file) \
+            and os.path.getmtime(index_file) >= os.path.getmtime(idr_file):
+            return cls(np.load(index_file, mmap_mode='r'))
+        return cls.build(idr_file)
+
+    def __len__(self):
+        return self.idr.shape[0]
+
+    def count(self, threshold):
+        '''
+        Number of peaks with IDR no greater than threshold; pass an
+        array of thresholds to get an array of counts.
+        '''
+        return np.searchsorted(self.idr, threshold, side='right')
+
+def sweep(idr_files, thresholds):
+    '''
+    Count the peaks within each threshold for each IDR file.
+
+    Returns a DataFrame with a row per threshold and a column per file.
+    '''
+    thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
+    counts = dict((idr_file, IdrIndex.load(idr_file).count(thresholds))
+                  for idr_file in idr_files)
+    return DataFrame(counts, index=thresholds, columns=list(idr_files))
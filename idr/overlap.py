@@ -0,0 +1,277 @@
+'''
+Vectorized pairing of peaks across two replicates, replacing the
+find.overlap, fill.missing.peaks, merge.peaks(.best) and pair.peaks.filter
+loops in functions-all-clayton-12-13.r.
+
+Peaks are compared on integer coordinates in which each chromosome is
+shifted into its own range (see idr.genome), so a single pass over sorted
+arrays covers every chromosome at once.
+'''
+import numpy as np
+from pandas import factorize
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from idr.genome import Genome
+
+class PeakOverlapper(object):
+    '''
+    Pairs peaks across replicates with binary searches over sorted
+    coordinate arrays.
+
+    Peaks that are connected through overlaps between the two replicates
+    form a region and share an ID. Regions found in only one replicate are
+    imputed in the other with impute_value. Multiple peaks from one
+    replicate in a region are merged, either by averaging their values
+    (merge='mean', as merge.peaks) or keeping the largest (merge='best',
+    as merge.peaks.best). Regions whose overlap ratio falls below
+    overlap_ratio are then dropped.
+
+    If a genome is passed (a Genome, bundled genome name, or table path),
+    chromosomes are concatenated by its sizes, as concatenate.chr does;
+    otherwise each chromosome seen is given a range wide enough for all
+    peaks.
+    '''
+    value_columns = ('sig_value', 'signal_value', 'p_value', 'q_value')
+    merge_methods = ('mean', 'best')
+
+    def __init__(self, overlap_ratio=0, impute_value=0, merge='mean',
+                 genome=None):
+        if merge not in self.merge_methods:
+            raise Exception('Unknown merge method "{}". Options are: {}'.format(
+                                        merge, ', '.join(self.merge_methods)))
+        self.overlap_ratio = float(overlap_ratio)
+        self.impute_value = impute_value
+        self.merge = merge
+        self.genome = genome and Genome.get(genome)
+
+    def pair_peaks(self, rep_1, rep_2, indexes=None):
+        '''
+        Given two peak tables (DataFrames or dicts of arrays) with chrom,
+        start, stop (inclusive), start_ori, stop_ori, and the
+        value_columns, return two aligned dicts of arrays with one entry per
+        region that passes the overlap ratio filter. Each has an id column
+        numbering regions in genomic order, starting from 1.
+        
+        Pass the indexes of both replicates, as from index_peaks with this
+        overlapper's genome, if they are already known.
+        '''
+        n_1 = len(rep_1['start'])
+        if indexes is None:
+            genome, indexes = self.index_peaks(rep_1, rep_2)
+        else: genome = self.genome
+        codes, starts, stops = [np.concatenate([index[col] 
+                                                for index in indexes])
+                                for col in ('codes', 'starts', 'stops')]
+
+        # Search within each replicate sorted by position.
+        orders = (np.asarray(indexes[0]['order']),
+                  np.asarray(indexes[1]['order']) + n_1)
+        labels, n_regions = self.find_overlap(starts[orders[0]],
+                                              stops[orders[0]],
+                                              starts[orders[1]],
+                                              stops[orders[1]])
+
+        merged = []
+        for rep, order, rep_labels, first in (
+                        (rep_1, orders[0], labels[:n_1], 0),
+                        (rep_2, orders[1], labels[n_1:], n_1)):
+            columns = dict((col, np.asarray(rep[col], dtype=float))
+                           for col in self.value_columns)
+            columns['start_ori'] = np.asarray(rep['start_ori'])
+            columns['stop_ori'] = np.asarray(rep['stop_ori'])
+            columns['chrom'] = codes[first:first + len(rep['start'])]
+            columns['start'] = starts[first:first + len(rep['start'])]
+            columns['stop'] = stops[first:first + len(rep['start'])]
+            merged.append(self.merge_peaks(columns, rep_labels, n_regions,
+                                           order=order - first))
+
+        merge_1, merge_2 = self.fill_missing_peaks(*merged)
+
+        frag_ratio = self.get_overlap_ratio(merge_1['start'], merge_1['stop'],
+                                            merge_2['start'], merge_2['stop'])
+        frag_ratio[(merge_1['sig_value'] == self.impute_value)
+                   | (merge_2['sig_value'] == self.impute_value)] = 0
+        keep = np.flatnonzero(frag_ratio >= self.overlap_ratio)
+        filtered = keep.shape[0] < frag_ratio.shape[0]
+
+        for merge in (merge_1, merge_2):
+            merge['frag_ratio'] = frag_ratio
+            if filtered:
+                for col in list(merge.keys()):
+                    merge[col] = merge[col][keep]
+            merge['chrom'] = genome.chroms[merge['chrom']]
+        return merge_1, merge_2
+
+    def index_peaks(self, *reps):
+        '''
+        Shift each chromosome of the passed replicates into its own range 
+        of coordinates, by this overlapper's genome or else one spanning
+        all their peaks, and sort each replicate by position.
+        
+        Returns the genome, and for each replicate, a dict of the code of
+        each peak's chromosome, its shifted starts and stops, and the 
+        order that sorts it.
+        '''
+        chroms = np.concatenate([np.asarray(rep['chrom'], dtype=object)
+                                 for rep in reps])
+        starts = np.concatenate([np.asarray(rep['start']) 
+                                 for rep in reps]).astype(np.int64)
+        stops = np.concatenate([np.asarray(rep['stop']) 
+                                for rep in reps]).astype(np.int64)
+
+        if self.genome is not None:
+            genome = self.genome
+            codes = genome.get_codes(chroms, strict=True)
+        else:
+            codes, uniques = factorize(chroms)
+            span = int(max(stops.max(), starts.max())) + 1 \
+                        if starts.shape[0] else 1
+            genome = Genome(uniques, [span]*len(uniques))
+            codes = genome.get_codes(uniques)[codes]
+        offsets = genome.offsets[codes]
+        starts, stops = starts + offsets, stops + offsets
+
+        indexes, first = [], 0
+        for rep in reps:
+            last = first + len(rep['start'])
+            indexes.append({'codes': codes[first:last], 
+                            'starts': starts[first:last],
+                            'stops': stops[first:last],
+                            'order': np.argsort(starts[first:last], 
+                                                kind='mergesort')})
+            first = last
+        return genome, indexes
+
+    def find_overlap(self, start_1, stop_1, start_2, stop_2):
+        '''
+        Assign region labels to the peaks of two replicates, given
+        inclusive, chromosome-shifted coordinates, each sorted by start.
+
+        Two peaks overlap exactly when one starts within the other, so 
+        each peak overlaps a contiguous run of the other replicate's
+        sorted peaks, found by binary search. Linking each peak to the 
+        first of its run, and each run member to the next, connects 
+        every overlapping pair; the connected components are the regions.
+
+        Returns labels for rep 1 followed by rep 2, numbered from 0 in
+        order of each region's first start, and the number of regions.
+        '''
+        n_1, n = start_1.shape[0], start_1.shape[0] + start_2.shape[0]
+        if n == 0: return np.zeros(0, dtype=np.int64), 0
+
+        sources, targets, firsts_within = [], [], []
+        for starts, stops, other_starts, first, other_first in (
+                        (start_1, stop_1, start_2, 0, n_1),
+                        (start_2, stop_2, start_1, n_1, 0)):
+            lo = np.searchsorted(other_starts, starts, 'left')
+            firsts_within.append(lo)
+            hi = np.searchsorted(other_starts, stops, 'right')
+            hits = np.flatnonzero(hi > lo)
+            sources.append(hits + first)
+            targets.append(lo[hits] + other_first)
+
+            # Chain the members of each run to one another, marking
+            # the neighbors covered by any run with a difference array.
+            runs = hits[hi[hits] - lo[hits] > 1]
+            m = other_starts.shape[0]
+            covered = np.cumsum(np.bincount(lo[runs], minlength=m)
+                                - np.bincount(hi[runs] - 1, minlength=m))
+            chained = np.flatnonzero(covered[:-1] > 0)
+            sources.append(chained + other_first)
+            targets.append(chained + other_first + 1)
+
+        sources, targets = np.concatenate(sources), np.concatenate(targets)
+        graph = coo_matrix((np.ones(sources.shape[0], dtype=np.int8),
+                            (sources, targets)), shape=(n, n))
+        _, components = connected_components(graph, directed=False)
+
+        # Renumber components in order of first start, rep 1 first on ties.
+        sweep = np.concatenate((
+                    np.arange(n_1) + firsts_within[0],
+                    np.arange(n - n_1) + np.searchsorted(start_1, start_2,
+                                                         'right')))
+        by_sweep = np.empty(n, dtype=np.int64)
+        by_sweep[sweep] = components
+        first = np.empty(components.max() + 1, dtype=np.int64)
+        # Assigning in reverse leaves the earliest position for each.
+        first[by_sweep[::-1]] = np.arange(n - 1, -1, -1)
+        is_first = np.zeros(n, dtype=bool)
+        is_first[first] = True
+        region = np.cumsum(is_first) - 1
+        return region[first[components]], int(first.shape[0])
+
+    def merge_peaks(self, peaks, labels, n_regions, order=None):
+        '''
+        Merge the peaks of one replicate that share a region label.
+        Values are averaged or maximized according to self.merge; the 
+        start comes from the first peak in the region and the stop from 
+        the last, in order of start.
+        
+        If peaks are not sorted by start, pass the order that sorts them;
+        labels are given in that sorted order.
+
+        Returns a dict of arrays with one entry per region label; regions
+        with no peaks in this replicate have a count of 0.
+        '''
+        if order is None: order = np.arange(labels.shape[0])
+        by_label = np.argsort(labels, kind='mergesort')
+        sorted_labels = labels[by_label]
+        order = order[by_label]
+        firsts = np.flatnonzero(np.r_[True, sorted_labels[1:]
+                                            != sorted_labels[:-1]]
+                                [:sorted_labels.shape[0]])
+        lasts = np.r_[firsts[1:], sorted_labels.shape[0]][:firsts.shape[0]] - 1
+        present = sorted_labels[firsts]
+
+        merged = {'count': np.zeros(n_regions, dtype=np.int64)}
+        merged['count'][present] = lasts - firsts + 1
+        for col in self.value_columns:
+            values = peaks[col][order]
+            merged[col] = np.zeros(n_regions)
+            if not firsts.shape[0]: continue
+            if self.merge == 'best':
+                merged[col][present] = np.maximum.reduceat(values, firsts)
+            else:
+                merged[col][present] = np.add.reduceat(values, firsts)\
+                                        /merged['count'][present]
+        for col, ends in (('chrom', firsts), ('start', firsts),
+                          ('start_ori', firsts),
+                          ('stop', lasts), ('stop_ori', lasts)):
+            merged[col] = np.zeros(n_regions, dtype=np.int64)
+            merged[col][present] = peaks[col][order][ends]
+        return merged
+
+    def fill_missing_peaks(self, merge_1, merge_2):
+        '''
+        Regions found in only one replicate are imputed in the other,
+        copying the location and setting values to impute_value.
+
+        Returns the two merged replicates, with region ids from 1.
+        '''
+        for merge, other in ((merge_1, merge_2), (merge_2, merge_1)):
+            missing = merge['count'] == 0
+            for col in ('chrom', 'start', 'stop', 'start_ori', 'stop_ori'):
+                merge[col] = np.where(missing, other[col], merge[col])
+            for col in self.value_columns:
+                merge[col] = np.where(missing, self.impute_value, merge[col])
+        for merge in (merge_1, merge_2):
+            merge['id'] = np.arange(1, merge['count'].shape[0] + 1)
+            del merge['count']
+        return merge_1, merge_2
+
+    def get_overlap_ratio(self, start_1, stop_1, start_2, stop_2):
+        '''
+        Overlap of two fragments divided by the length of the shorter,
+        as overlap.middle computes it.
+        '''
+        # The middle two of the four ends bound the overlap.
+        overlap = np.abs(np.minimum(stop_1, stop_2)
+                         - np.maximum(start_1, start_2))
+        shorter = np.minimum(stop_1 - start_1, stop_2 - start_2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = overlap/shorter.astype(float)
+        # Single-base peaks that coincide fully overlap.
+        ratio[np.isnan(ratio)] = 1
+        return ratio
+
@@ -0,0 +1,235 @@
+'''
+Runs the steps of a pipeline as a dependency graph of stages, with a
+checkpoint written to disk as each stage completes. Stages whose
+dependencies are complete run concurrently, and a rerun resumes after
+the last completed stages rather than starting over.
+
+Stages of several pipelines can share one scheduler, and so one limit
+on the threads and memory they use, by namespacing their names and
+checkpointing each in its own directory; see add_stage.
+'''
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import hashlib
+import json
+import os
+
+from idr import profiling
+
+class Stage(object):
+    '''
+    A named step, called with the results of the stages it depends on,
+    in order. Its params, along with its dependencies' fingerprints,
+    identify its checkpoint, so a change upstream reruns it.
+    
+    A name may be namespaced, as in experiment/stage; the checkpoint
+    is then named for the stage alone.
+    '''
+    def __init__(self, name, func, depends=(), params=None, 
+                 checkpoint_dir=None, memory=0):
+        self.name = name
+        self.func = func
+        self.depends = tuple(depends)
+        self.params = params or {}
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_name = name.rsplit('/', 1)[-1]
+        # Estimated bytes of memory used while running.
+        self.memory = memory or 0
+
+class Pipeline(object):
+    '''
+    Schedules stages on up to jobs threads. Stages are expected to do
+    their heavy lifting in subprocesses or process pools, so threads
+    suffice to drive them.
+
+    Results must be JSON-serializable, as they are checkpointed; any
+    strings in them that name files are checked to still exist before a
+    checkpoint is trusted.
+    
+    With a memory_limit in bytes, stages are only started while the sum
+    of their estimated memory stays within it; a stage estimated above
+    the limit runs alone. With keep_going, a failed stage only stops
+    the stages that depend on it, and failures are returned rather than
+    raised; see run.
+    '''
+    def __init__(self, checkpoint_dir, jobs=1, restart=False,
+                 memory_limit=None, keep_going=False):
+        self.checkpoint_dir = checkpoint_dir
+        self.jobs = max(jobs or 1, 1)
+        self.restart = restart
+        self.memory_limit = memory_limit
+        self.keep_going = keep_going
+        self.stages = []
+        # Exceptions of stages that failed, by name; stages not run 
+        # because a dependency failed map to None.
+        self.failures = {}
+        self._stages_by_name = {}
+        self._fingerprints = {}
+
+    def add_stage(self, name, func, depends=(), params=None,
+                  checkpoint_dir=None, memory=0):
+        '''
+        Add a stage. Dependencies must already have been added, so the
+        order of addition is a valid order to run in.
+        
+        The stage is checkpointed in checkpoint_dir if passed, or else
+        in the pipeline's; memory is its estimated use in bytes.
+        '''
+        if name in self._stages_by_name:
+            raise Exception('Stage {} was added twice.'.format(name))
+        for dependency in depends:
+            if dependency not in self._stages_by_name:
+                raise Exception('Stage {} depends on unknown stage {}.'\
+                                .format(name, dependency))
+        stage = Stage(name, func, depends=depends, params=params,
+                      checkpoint_dir=checkpoint_dir, memory=memory)
+        self.stages.append(stage)
+        self._stages_by_name[name] = stage
+        return stage
+
+    def remove_namespace(self, namespace):
+        '''
+        Remove the stages named namespace/stage, as when setting up their
+        pipeline failed partway. Other stages must not depend on them.
+        '''
+        prefix = namespace + '/'
+        self.stages = [stage for stage in self.stages 
+                       if not stage.name.startswith(prefix)]
+        for name in list(self._stages_by_name):
+            if name.startswith(prefix):
+                del self._stages_by_name[name]
+                self._fingerprints.pop(name, None)
+
+    def run(self):
+        '''
+        Run all stages, skipping those with valid checkpoints.
+
+        If a stage fails, no further stages are started; stages already
+        running are allowed to finish and checkpoint, and the error is
+        then raised. With keep_going, stages that do not depend on the
+        failed stage still run, and failures are left in self.failures.
+
+        Returns a dict of results by stage name.
+        '''
+        for checkpoint_dir in set(self.get_checkpoint_dir(stage) 
+                                  for stage in self.stages):
+            if not os.path.exists(checkpoint_dir):
+                os.makedirs(checkpoint_dir)
+
+        results, pending, running = {}, list(self.stages), {}
+        rerun, error = set(), None
+        parent = profiling.get_current_stage()
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while True:
+                # Start, or skip, every stage whose dependencies are done,
+                # until no more can be.
+                progressed = error is None
+                while progressed:
+                    progressed = False
+                    for stage in list(pending):
+                        if self.failures.keys() & set(stage.depends):
+                            print(('!! Stage {} not run, as a stage it '
+                                   + 'depends on failed.').format(stage.name))
+                            self.failures[stage.name] = None
+                            pending.remove(stage)
+                            progressed = True
+                            continue
+                        if not all(d in results for d in stage.depends):
+                            continue
+                        # A stage whose dependencies were rerun is too.
+                        completed, result = False, None
+                        if not rerun.intersection(stage.depends):
+                            completed, result = self.load_checkpoint(stage)
+                        if completed:
+                            print('Stage {} already complete; skipping.'\
+                                  .format(stage.name))
+                            results[stage.name] = result
+                            pending.remove(stage)
+                            progressed = True
+                        elif len(running) < self.jobs \
+                                and self.has_memory_for(stage, running):
+                            print('Starting stage {}'.format(stage.name))
+                            future = executor.submit(self.run_stage, stage,
+                                    parent, *[results[d] for d in stage.depends])
+                            running[future] = stage
+                            pending.remove(stage)
+                            rerun.add(stage.name)
+                if not running: break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    try:
+                        results[stage.name] = future.result()
+                    except Exception as e:
+                        print('!! Stage {} failed: {}'.format(stage.name, e))
+                        self.failures[stage.name] = e
+                        if error is None and not self.keep_going: error = e
+                        continue
+                    self.save_checkpoint(stage, results[stage.name])
+                    print('Finished stage {}'.format(stage.name))
+
+        if error is not None: raise error
+        return results
+
+    def run_stage(self, stage, parent, *args):
+        with profiling.stage(stage.name, parent=parent):
+            return stage.func(*args)
+
+    def has_memory_for(self, stage, running):
+        if self.memory_limit is None or not running: return True
+        in_use = sum(s.memory for s in running.values())
+        return in_use + stage.memory <= self.memory_limit
+
+    def get_fingerprint(self, stage):
+        if stage.name not in self._fingerprints:
+            description = {'name': stage.checkpoint_name, 
+                           'params': stage.params,
+                           'depends': [self.get_fingerprint(
+                                            self._stages_by_name[d])
+                                       for d in stage.depends]}
+            self._fingerprints[stage.name] = hashlib.sha256(json.dumps(
+                    description, sort_keys=True, default=str).encode())\
+                    .hexdigest()
+        return self._fingerprints[stage.name]
+
+    def get_checkpoint_dir(self, stage):
+        return stage.checkpoint_dir or self.checkpoint_dir
+
+    def get_checkpoint_file(self, stage):
+        return os.path.join(self.get_checkpoint_dir(stage),
+                            stage.checkpoint_name + '.json')
+
+    def load_checkpoint(self, stage):
+        '''
+        Returns (True, result) if the stage completed with the same
+        fingerprint and its files still exist, else (False, None).
+        '''
+        if self.restart: return False, None
+        try:
+            with open(self.get_checkpoint_file(stage), 'r') as f:
+                checkpoint = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False, None
+        if checkpoint.get('fingerprint') != self.get_fingerprint(stage):
+            return False, None
+        if not all(os.path.exists(f) for f in checkpoint.get('files', [])):
+            return False, None
+        return True, checkpoint['result']
+
+    def save_checkpoint(self, stage, result):
+        checkpoint = {'fingerprint': self.get_fingerprint(stage),
+                      'result': result,
+                      'files': [f for f in self.get_strings(result)
+                                if os.path.isfile(f)]}
+        checkpoint_file = self.get_checkpoint_file(stage)
+        with open(checkpoint_file + '.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+    def get_strings(self, result):
+        if isinstance(result, str): return [result]
+        if isinstance(result, dict): result = list(result.values())
+        if isinstance(result, (list, tuple)):
+            return [s for item in result for s in self.get_strings(item)]
+        return []
+
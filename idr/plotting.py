@@ -0,0 +1,134 @@
+'''
+Plots of pairwise comparisons drawn with matplotlib from the
+-plot-summary.json files the numpy engine saves, in the layout of
+batch-consistency-plot.r: the correspondence profiles of all peaks and
+of matched peaks and their slopes, and the IDR against the number of
+peaks selected, with a legend of the comparisons plotted.
+
+Unlike the R script, nothing is reloaded or recomputed here, so a plot
+takes a fraction of a second and needs no R.
+'''
+import json
+import os
+
+class IdrPlotter(object):
+    '''
+    Draws the plots for a group of comparisons, as
+    batch-consistency-plot.r does.
+    '''
+    summary_suffix = '-plot-summary.json'
+    formats = ('pdf', 'png', 'svg')
+
+    # As in plot.uri.group and plot.ez.group
+    colors = ('black', 'red', 'purple', 'green', 'blue', 'cyan',
+              'magenta', 'orange', 'grey')
+    xlabel = 'num of significant peaks'
+    idr_ylim = (0, 0.6)
+
+    def __init__(self, plot_format='pdf'):
+        if plot_format not in self.formats:
+            raise Exception('Unknown plot format "{}". Options are: {}'.format(
+                                    plot_format, ', '.join(self.formats)))
+        self.plot_format = plot_format
+
+    @classmethod
+    def get_summary_file(cls, output_prefix):
+        return output_prefix + cls.summary_suffix
+
+    @classmethod
+    def has_summaries(cls, output_prefixes):
+        # With no comparisons, there is nothing to plot.
+        return bool(output_prefixes) and all(os.path.exists(cls.get_summary_file(prefix))
+                   for prefix in output_prefixes)
+
+    def load_summary(self, output_prefix):
+        with open(self.get_summary_file(output_prefix), 'r') as f:
+            return json.load(f)
+
+    def get_output_file(self, output_prefix):
+        return output_prefix + '-plot.' + self.plot_format
+
+    def plot_comparisons(self, output_prefixes, output_file):
+        '''
+        Plot the comparisons saved under each of output_prefixes to
+        a single file, in a grid of two rows and three columns.
+        '''
+        try:
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            from matplotlib.figure import Figure
+        except ImportError:
+            raise Exception('Plotting with the numpy engine requires '
+                            + 'matplotlib.')
+        summaries = [self.load_summary(prefix) for prefix in output_prefixes]
+
+        # Figures not tied to pyplot can be drawn on any thread.
+        figure = Figure(figsize=(12, 8))
+        FigureCanvasAgg(figure)
+        axes = figure.subplots(2, 3)
+        for column, (group, title) in enumerate((('all', 'all peaks'),
+                                        ('matched', 'matched peaks'))):
+            self.plot_uri([s[group] for s in summaries], axes[0][column],
+                          axes[1][column], title)
+        self.plot_idr([s['idr'] for s in summaries], axes[0][2])
+
+        legend = axes[1][2]
+        legend.set_axis_off()
+        legend.text(0, 1, '\n'.join('{} = {}'.format(i + 1,
+                                            os.path.basename(prefix))
+                                    for i, prefix in enumerate(output_prefixes)),
+                    va='top', fontsize=8, transform=legend.transAxes)
+
+        figure.tight_layout()
+        figure.savefig(output_file, format=self.plot_format)
+        return output_file
+
+    def plot_uri(self, uris, uri_axes, slope_axes, title):
+        '''
+        Equivalent to plot.uri.group: each correspondence profile up to
+        its jump, with its smoothing spline, and the spline's slope.
+        '''
+        # Scale to the largest number of peaks in common.
+        max_peak = max(uri['tv'][uri['jump_left'] - 1] for uri in uris)*1.05
+        for i, uri in enumerate(uris):
+            color = self.get_color(i)
+            jump_left = uri['jump_left']
+            tv = uri['tv'][:jump_left]
+            uri_axes.scatter(tv, uri['uri'][:jump_left], s=4,
+                             facecolors='none', edgecolors=color)
+            uri_axes.plot(tv, uri['uri_spline'], color=color, lw=2,
+                          label=str(i + 1))
+            slope_axes.plot(tv, uri['uri_der'], color=color, lw=2,
+                            label=str(i + 1))
+
+        uri_axes.plot((0, max_peak), (0, max_peak), ls=':', color='black')
+        uri_axes.set_xlim(0, max_peak)
+        uri_axes.set_ylim(0, max_peak)
+        uri_axes.set_xlabel(self.xlabel)
+        uri_axes.set_ylabel('num of peaks in common')
+        uri_axes.set_title(title)
+        uri_axes.legend(loc='upper left')
+
+        slope_axes.axhline(1, ls=':', color='black')
+        slope_axes.set_xlim(0, max_peak)
+        slope_axes.set_ylim(0, 1.5)
+        slope_axes.set_xlabel(self.xlabel)
+        slope_axes.set_ylabel('slope')
+        slope_axes.set_title(title)
+        slope_axes.legend(loc='upper right')
+
+    def plot_idr(self, idrs, axes):
+        '''
+        Equivalent to plot.ez.group: the IDR against the number of
+        peaks selected.
+        '''
+        for i, idr in enumerate(idrs):
+            axes.plot(idr['n'], idr['idr'], color=self.get_color(i), lw=2,
+                      label=str(i + 1))
+        axes.set_xlim(0, max(idr['npeaks'] for idr in idrs))
+        axes.set_ylim(*self.idr_ylim)
+        axes.set_xlabel(self.xlabel)
+        axes.set_ylabel('IDR')
+        axes.legend(loc='upper left')
+
+    def get_color(self, i):
+        return self.colors[i % len(self.colors)]
@@ -0,0 +1,343 @@
+'''
+Records the wall time, CPU time, peak memory, and I/O of each stage of
+a command, and of each child process it runs, for a machine-readable
+report of where a run spends its time.
+
+Profiling is off unless start is called. Code marks what to measure
+with the stage context manager, and runs child processes through
+check_call or wait; these do nothing extra when profiling is off.
+Stages run in worker processes, such as the numpy engine's pools, are
+spooled to files and gathered into the report of the process that
+started profiling.
+'''
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Tell worker processes, however started, to spool their records.
+spool_variable = 'HOMER_IDR_PROFILE_SPOOL'
+cprofile_variable = 'HOMER_IDR_CPROFILE_DIR'
+
+_profiler = None
+_lock = threading.Lock()
+
+class Profiler(object):
+    '''
+    Collects records of stages and child processes for one process.
+
+    The profiler of the process that started profiling keeps its
+    records; those of other processes append theirs to a spool file.
+    '''
+    # ru_maxrss is in kilobytes, except on macOS, where it is in bytes.
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+    # ru_inblock and ru_oublock count 512-byte blocks.
+    block_size = 512
+
+    def __init__(self, spool_dir, cprofile_dir=None, spool=False):
+        self.spool_dir = spool_dir
+        self.cprofile_dir = cprofile_dir
+        self.spool = spool
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def stage(self, name, kind='stage', parent=None):
+        stack = self.get_stack()
+        if stack: parent = stack[-1]
+        stack.append(name)
+        # cProfile only the outermost stage of each thread, as a thread
+        # can only have one profiler enabled.
+        profile = None
+        if self.cprofile_dir and len(stack) == 1:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                profile = None
+        start = self.snapshot()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            end = self.snapshot()
+            stack.pop()
+            record = self.get_record(name, kind, parent, start, end)
+            record['failed'] = error is not None
+            if profile is not None:
+                profile.disable()
+                record['cprofile'] = self.dump_cprofile(profile, name)
+            self.add(record)
+
+    def get_stack(self):
+        if not hasattr(self._local, 'stack'): self._local.stack = []
+        return self._local.stack
+
+    def snapshot(self):
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {'time': time.time(), 'wall': time.perf_counter(),
+                'thread_cpu': time.thread_time(),
+                'cpu': own.ru_utime + own.ru_stime,
+                'children_cpu': children.ru_utime + children.ru_stime,
+                'peak_rss': own.ru_maxrss*self.rss_unit,
+                'children_peak_rss': children.ru_maxrss*self.rss_unit,
+                'blocks_in': own.ru_inblock, 'blocks_out': own.ru_oublock,
+                'io': self.get_io()}
+
+    def get_io(self):
+        '''
+        Bytes read and written by this process, from /proc where there
+        is one: rchar and wchar count all reads and writes, cached or
+        not; read_bytes and write_bytes count those reaching storage.
+        '''
+        try:
+            with open('/proc/self/io', 'r') as f:
+                return dict((key, int(value)) for key, value in
+                            (line.split(':') for line in f))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def get_record(self, name, kind, parent, start, end):
+        '''
+        CPU time, I/O, and child CPU time are those of the whole process
+        over the stage, so they include stages running alongside it on
+        other threads; thread_cpu_time is the stage's own thread alone.
+        On Linux, I/O also counts child processes once they finish.
+        Peak RSS is the high-water mark of the process by the end of the
+        stage.
+        '''
+        record = {'name': name, 'kind': kind, 'parent': parent,
+                  'pid': self.pid, 'start': start['time'],
+                  'wall_time': end['wall'] - start['wall'],
+                  'cpu_time': end['cpu'] - start['cpu'],
+                  'thread_cpu_time': end['thread_cpu'] - start['thread_cpu'],
+                  'children_cpu_time': end['children_cpu']
+                                        - start['children_cpu'],
+                  'peak_rss': end['peak_rss'],
+                  'children_peak_rss': end['children_peak_rss']}
+        if start['io'] and end['io']:
+            record.update(read_bytes=end['io']['rchar'] - start['io']['rchar'],
+                          write_bytes=end['io']['wchar'] - start['io']['wchar'],
+                          storage_read_bytes=end['io']['read_bytes']
+                                                - start['io']['read_bytes'],
+                          storage_write_bytes=end['io']['write_bytes']
+                                                - start['io']['write_bytes'])
+        else:
+            record.update(read_bytes=None, write_bytes=None,
+                          storage_read_bytes=(end['blocks_in']
+                                    - start['blocks_in'])*self.block_size,
+                          storage_write_bytes=(end['blocks_out']
+                                    - start['blocks_out'])*self.block_size)
+        return record
+
+    def record_process(self, name, started, rusage, returncode):
+        '''
+        Record a child process from the resources wait4 reported for it.
+        Only what reaches storage is known of its I/O.
+        '''
+        stack = self.get_stack()
+        record = {'name': name, 'kind': 'process',
+                  'parent': stack[-1] if stack else None,
+                  'pid': self.pid, 'start': started,
+                  'wall_time': time.time() - started,
+                  'returncode': returncode, 'failed': returncode != 0}
+        if rusage is not None:
+            record.update(cpu_time=rusage.ru_utime + rusage.ru_stime,
+                          peak_rss=rusage.ru_maxrss*self.rss_unit,
+                          read_bytes=None, write_bytes=None,
+                          storage_read_bytes=rusage.ru_inblock*self.block_size,
+                          storage_write_bytes=rusage.ru_oublock
+                                                *self.block_size)
+        self.add(record)
+
+    def add(self, record):
+        with self._lock:
+            if not self.spool:
+                self.records.append(record)
+                return
+            spool_file = os.path.join(self.spool_dir,
+                                      '{}.jsonl'.format(self.pid))
+            with open(spool_file, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def dump_cprofile(self, profile, name):
+        '''
+        Save cProfile stats for a stage to a .prof file, for pstats or
+        snakeviz; returns the file name.
+        '''
+        basename = re.sub(r'[^\w.-]+', '_', name).strip('_') or 'stage'
+        with _lock:
+            os.makedirs(self.cprofile_dir, exist_ok=True)
+            output_file = os.path.join(self.cprofile_dir, basename + '.prof')
+            i = 1
+            while os.path.exists(output_file):
+                i += 1
+                output_file = os.path.join(self.cprofile_dir,
+                                           '{}-{}.prof'.format(basename, i))
+            profile.dump_stats(output_file)
+        return output_file
+
+    def gather(self):
+        '''
+        Records of this process and, from the spool, of its workers,
+        in order of their start, in seconds since profiling started.
+        '''
+        records = [dict(record) for record in self.records]
+        for spool_file in sorted(os.listdir(self.spool_dir)):
+            with open(os.path.join(self.spool_dir, spool_file), 'r') as f:
+                records.extend(json.loads(line) for line in f)
+        for record in records: record['start'] -= self.started
+        return sorted(records, key=lambda r: r['start'])
+
+    def write(self, output_file, command=None):
+        '''
+        Write the report as JSON: the environment of the run, and a
+        record for each stage and child process.
+        '''
+        report = {'command': command or sys.argv,
+                  'started': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                           time.localtime(self.started)),
+                  'wall_time': time.time() - self.started,
+                  'environment': get_environment(),
+                  'records': self.gather()}
+        with open(output_file, 'w') as f:
+            json.dump(report, f, indent=1)
+        return output_file
+
+def get_environment():
+    '''
+    Versions of Python, the libraries we use, and the code, and the
+    machine run on.
+    '''
+    versions = {}
+    for module in ('numpy', 'pandas', 'scipy', 'matplotlib'):
+        if module in sys.modules:
+            versions[module] = getattr(sys.modules[module],
+                                       '__version__', None)
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), 'versions': versions,
+            'code': get_code_version()}
+
+def get_code_version():
+    '''
+    The git commit of the code, if it is a git checkout.
+    '''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                        cwd=os.path.dirname(os.path.realpath(__file__)),
+                        stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def start(cprofile_dir=None):
+    '''
+    Start profiling this process and any worker processes it starts.
+    '''
+    global _profiler
+    spool_dir = tempfile.mkdtemp(prefix='homer-idr-profile-')
+    _profiler = Profiler(spool_dir, cprofile_dir=cprofile_dir)
+    os.environ[spool_variable] = spool_dir
+    if cprofile_dir: os.environ[cprofile_variable] = cprofile_dir
+    return _profiler
+
+def stop(output_file, command=None):
+    '''
+    Write the report of the profiler started in this process, and stop.
+    '''
+    global _profiler
+    profiler, _profiler = _profiler, None
+    os.environ.pop(spool_variable, None)
+    os.environ.pop(cprofile_variable, None)
+    try:
+        return profiler.write(output_file, command=command)
+    finally:
+        shutil.rmtree(profiler.spool_dir, ignore_errors=True)
+
+def get_profiler():
+    '''
+    The profiler for this process, or None if profiling is off. Worker
+    processes get a spooling profiler, whether forked with the
+    parent's or started afresh with only its environment.
+    '''
+    global _profiler
+    if _profiler is not None and _profiler.pid == os.getpid():
+        return _profiler
+    spool_dir = os.environ.get(spool_variable)
+    if not spool_dir or not os.path.isdir(spool_dir): return None
+    with _lock:
+        if _profiler is None or _profiler.pid != os.getpid():
+            _profiler = Profiler(spool_dir, spool=True,
+                            cprofile_dir=os.environ.get(cprofile_variable))
+    return _profiler
+
+@contextmanager
+def stage(name, kind='stage', parent=None):
+    '''
+    Measure the enclosed block as a stage, if profiling. Stages started
+    within it on the same thread are recorded as its children; pass
+    parent to name the parent of a stage run on another thread.
+    '''
+    profiler = get_profiler()
+    if profiler is None:
+        yield
+        return
+    with profiler.stage(name, kind=kind, parent=parent):
+        yield
+
+def get_current_stage():
+    '''
+    The innermost stage running on this thread, if profiling.
+    '''
+    profiler = get_profiler()
+    stack = profiler and profiler.get_stack()
+    return stack[-1] if stack else None
+
+def check_call(args, name=None, **kwargs):
+    '''
+    As subprocess.check_call, recording the child's resource use
+    if profiling.
+    '''
+    if get_profiler() is None:
+        return subprocess.check_call(args, **kwargs)
+    started = time.time()
+    process = subprocess.Popen(args, **kwargs)
+    returncode = wait(process, name or args, started)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, args)
+    return returncode
+
+def wait(process, name, started=None):
+    '''
+    As process.wait, recording the resource use of the child if
+    profiling; started is when it was started, if not just now.
+    '''
+    profiler = get_profiler()
+    if profiler is None: return process.wait()
+    if not isinstance(name, str): name = ' '.join(name)
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    except ChildProcessError:
+        # Already reaped, as by a poll from another thread.
+        process.wait()
+        rusage = None
+    profiler.record_process(name, started or time.time(), rusage,
+                            process.returncode)
+    return process.returncode
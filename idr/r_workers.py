@@ -0,0 +1,240 @@
+'''
+A pool of long-lived R processes for the reference R engine.
+
+Each Rscript run of batch-consistency-analysis.r or
+batch-consistency-plot.r starts R and sources the function library
+anew, which for small peak sets takes longer than the analysis. A
+worker runs batch-consistency-worker.r instead: it sources the library
+once, and then runs the same scripts, with the same arguments, as jobs
+sent to it one line at a time over a pipe.
+
+Workers are started as needed, up to the size of the pool, and checked
+with a ping before each job. A worker that has died, fails a job, or
+stops responding is replaced. Each is also replaced after max_jobs
+jobs, to bound the memory R accumulates.
+'''
+import itertools
+import os
+import queue
+import select
+import subprocess
+import sys
+import tempfile
+import threading
+
+from idr import profiling
+
+class RWorker(object):
+    '''
+    One R process serving analysis and plot jobs.
+    '''
+    script = 'batch-consistency-worker.r'
+
+    def __init__(self, code_dir, timeout=None):
+        self.process = subprocess.Popen(['Rscript', self.script],
+                                        cwd=code_dir, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        universal_newlines=True)
+        self.jobs = 0
+        self._ids = itertools.count(1)
+        try:
+            response = self.read_response(timeout)
+        except Exception:
+            self.kill()
+            raise
+        if response != ['ready']:
+            self.kill()
+            raise Exception('R worker did not start: {}'.format(response))
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def send(self, fields):
+        for field in fields:
+            if '\t' in field or '\n' in field:
+                raise Exception('R worker arguments cannot contain tabs or '
+                                + 'newlines: {}'.format(repr(field)))
+        self.process.stdin.write('\t'.join(fields) + '\n')
+        self.process.stdin.flush()
+
+    def read_response(self, timeout=None):
+        '''
+        The fields of the next line from the worker, waiting at most
+        timeout seconds if passed.
+        '''
+        if timeout is not None:
+            ready, _, _ = select.select([self.process.stdout], [], [],
+                                        timeout)
+            if not ready:
+                raise Exception('R worker did not respond within '
+                                + '{} seconds.'.format(timeout))
+        line = self.process.stdout.readline()
+        if not line:
+            raise Exception('R worker exited with code {}.'.format(
+                                                        self.process.wait()))
+        return line.rstrip('\n').split('\t')
+
+    def request(self, job_type, log_file='', args=(), timeout=None):
+        '''
+        Send a request, and return the error message, or None if it
+        succeeded.
+        '''
+        job_id = str(next(self._ids))
+        self.send([job_id, job_type, log_file] + [str(a) for a in args])
+        response = self.read_response(timeout)
+        if response[0] != job_id:
+            raise Exception('R worker answered job {} for job {}.'.format(
+                                                    response[0], job_id))
+        if response[1:2] == ['ok']: return None
+        return response[2] if len(response) > 2 else 'unknown error'
+
+    def run(self, job_type, args, log_file):
+        self.jobs += 1
+        return self.request(job_type, log_file, args)
+
+    def ping(self, timeout):
+        return self.request('ping', timeout=timeout) is None
+
+    def stop(self, timeout=10):
+        '''
+        Ask the worker to quit, killing it if it does not.
+        '''
+        try:
+            if self.is_alive(): self.send(['0', 'quit', ''])
+            self.process.wait(timeout)
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            self.kill()
+
+    def kill(self):
+        if self.is_alive(): self.process.kill()
+        self.process.wait()
+
+class RWorkerPool(object):
+    '''
+    Runs R jobs on up to size workers at a time, from any thread.
+    '''
+    # Jobs a worker runs before it is replaced
+    max_jobs = 100
+    # Seconds to wait for a worker to load the library, and to answer
+    # a ping
+    start_timeout = 120
+    ping_timeout = 10
+
+    def __init__(self, size, code_dir=None):
+        self.size = size
+        self.code_dir = code_dir or os.path.join(os.path.dirname(
+                                    os.path.realpath(__file__)), 'idrCode')
+        self._idle = queue.LifoQueue()
+        self._workers = []
+        # Log file of the job each busy worker is running
+        self._running = {}
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def run(self, job_type, args, log_file=None):
+        '''
+        Run batch-consistency-analysis.r (analysis) or
+        batch-consistency-plot.r (plot) with args on a worker. Output
+        is appended to log_file, or else printed once the job is done.
+        '''
+        output_file = None
+        if not log_file:
+            handle, output_file = tempfile.mkstemp(prefix='homer-idr-r-',
+                                                   suffix='.log')
+            os.close(handle)
+        try:
+            self.run_job(job_type, args, log_file or output_file)
+        finally:
+            if output_file:
+                with open(output_file, 'r') as f: sys.stdout.write(f.read())
+                os.remove(output_file)
+
+    def run_job(self, job_type, args, log_file):
+        worker = self.acquire()
+        error, healthy = None, False
+        log_file = os.path.abspath(log_file)
+        try:
+            with self._lock: self._running[worker] = log_file
+            with profiling.stage('R worker {}'.format(job_type),
+                                 kind='r-job'):
+                error = worker.run(job_type, args, log_file)
+            healthy = error is None
+        finally:
+            with self._lock: self._running.pop(worker, None)
+            # Replace a worker after any failure, as R may be left in a
+            # bad state.
+            self.release(worker, healthy=healthy)
+        if error is not None:
+            raise Exception('R {} job failed: {}'.format(job_type, error))
+
+    def acquire(self):
+        '''
+        An idle worker that answers a ping, or a new one.
+        '''
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    worker = self._idle.get_nowait()
+                except queue.Empty:
+                    return self.start_worker()
+                if self.is_healthy(worker): return worker
+                print('Restarting unresponsive R worker.')
+                self.discard(worker)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, worker, healthy=True):
+        if healthy and worker.jobs < self.max_jobs and not self._closed:
+            self._idle.put(worker)
+        else:
+            self.discard(worker)
+        self._slots.release()
+
+    def is_healthy(self, worker):
+        try:
+            return worker.is_alive() and worker.ping(self.ping_timeout)
+        except Exception:
+            return False
+
+    def start_worker(self):
+        with self._lock:
+            if self._closed: raise Exception('The R worker pool is closed.')
+        worker = RWorker(self.code_dir, timeout=self.start_timeout)
+        with self._lock: self._workers.append(worker)
+        return worker
+
+    def discard(self, worker):
+        with self._lock:
+            if worker in self._workers: self._workers.remove(worker)
+        worker.stop()
+
+    def close(self):
+        '''
+        Stop idle workers; those running jobs stop when they finish.
+        '''
+        with self._lock: self._closed = True
+        while True:
+            try:
+                self.discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def terminate(self, log_files=None):
+        '''
+        Kill every worker, including those running jobs, and close the
+        pool. If log_files are passed, kill only the workers running
+        jobs logging to them, whose jobs then fail; the pool stays open,
+        and replaces them as needed.
+        '''
+        with self._lock:
+            if log_files is None:
+                self._closed = True
+                workers = list(self._workers)
+            else:
+                log_files = set(os.path.abspath(f) for f in log_files)
+                workers = [worker for worker, log_file 
+                           in self._running.items() if log_file in log_files]
+        for worker in workers: worker.kill()
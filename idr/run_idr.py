@@ -15,13 +15,43 @@ https://sites.google.com/site/anshulkundaje/projects/idr
 
 '''
 from argparse import ArgumentParser
-import math
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import hashlib
 import os
-from random import randint
 
+import numpy as np
+from pandas import DataFrame
+from pandas.io.parsers import read_csv
+
+from idr.benchmark import Benchmark
+from idr.cache import ResultCache
+from idr.columnar import ColumnarTable
+from idr.compression import is_compressed, split_name, strip_compression
+from idr.genome import Genome
 from idr.idr_caller import IdrCaller
+from idr.idr_index import sweep
+from idr.pipeline import Pipeline
+from idr.plotting import IdrPlotter
+from idr import profiling
 from idr.utils import IdrUtilities
 class IdrArgumentParser(ArgumentParser):
+    # Columns of a batch manifest: options of the idr command that each
+    # experiment can set, and its name.
+    manifest_list_columns = ('peak_files', 'pseudorep_files', 
+                             'pooled_pseudoreps', 'rep_narrowpeaks', 
+                             'pseudorep_narrowpeaks', 'pooled_narrowpeaks',
+                             'rep_idr_peaks', 'pseudorep_idr_peaks', 
+                             'pooled_idr_peaks')
+    manifest_columns = ('name', 'output_dir', 'pooled_peaks', 
+                        'number_of_peaks', 'threshold', 'pooled_threshold')\
+                        + manifest_list_columns
+    
+    # A rough multiple of the size of peak files to expect in memory
+    # while they are processed, and of the size of gzipped files.
+    memory_per_input_byte = 10
+    compression_ratio = 4
+    
     def __init__(self):
         description = '''Functions for running Irreproducibility Discovery Rate
         (IDR) analysis on Homer peak files.'''
@@ -31,7 +61,13 @@ class IdrArgumentParser(ArgumentParser):
         self.add_argument('command', 
                 help='Program to run; options are: idr, '
                 + 'pseudoreplicate, pool-pseudoreplicates, '
-                + 'homer2narrow, truncate.'),
+                + 'homer2narrow, truncate, columnar2text, overlap2narrow, '
+                + 'sweep, batch, benchmark.'),
+        self.add_argument('manifest', nargs='?',
+                help='For the batch command, a tab-delimited manifest of '
+                + 'experiments to run the idr command for, with a header. '
+                + 'Columns are: {}. '.format(', '.join(self.manifest_columns))
+                + 'Separate lists of files with commas.')
         
         self.add_argument('-o','--output_dir', nargs='?', dest='output_dir',
                 help='Directory name in which output files will be placed. ' +
@@ -73,15 +109,120 @@ class IdrArgumentParser(ArgumentParser):
         
         self.add_argument('--pooled_dir_name', nargs='?', dest='pooled_dir_name',
                 help='Base name for pooled pseudorep directories.')
+        self.add_argument('--keep_sample_pseudoreps', action='store_true',
+                dest='keep_sample_pseudoreps', default=False,
+                help='With pool-pseudoreplicates, also write the share of '
+                + 'each pooled pseudoreplicate from each tag directory as '
+                + 'its own tag directory, suffixed -Pooling-Pseudorep[N].')
         
         self.add_argument('--pseudorep_count', nargs='?', dest='pseudorep_count',
                 type=int, default=2,
                 help='Number of pseudoreplicates to create. Default: 2')
         
+        self.add_argument('--seed', nargs='?', dest='seed', type=int,
+                help='Random seed for splitting pseudoreplicates, so that '
+                + 'reruns are reproducible. Default: a random seed, which '
+                + 'is printed.')
+        self.add_argument('--split_tag_counts', action='store_true',
+                dest='split_tag_counts', default=False,
+                help='When splitting pseudoreplicates, split the tag count of '
+                + 'each position binomially rather than assigning whole '
+                + 'lines. Use for tag directories with collapsed tags.')
+        self.add_argument('--validate_tag_dirs', action='store_true',
+                dest='validate_tag_dirs', default=False,
+                help='Have Homer re-make each pseudoreplicate tag directory '
+                + 'written, to check its tag counts. Requires Homer.')
+        
         self.add_argument('--ranking_measure', nargs='?', dest='ranking_measure',
                 choices=['tag-count', 'p-value'], default='tag-count',
                 help='Use tag-count or p-value for comparing replicates? ' +
                 'Default: tag-count')
+        self.add_argument('--engine', nargs='?', dest='engine',
+                choices=IdrCaller.engines, default='r',
+                help='Run pairwise IDR analysis with the reference R code (r) '
+                + 'or the in-process NumPy implementation (numpy). Default: r')
+        self.add_argument('--r_workers', nargs='?', dest='r_workers',
+                type=int, default=0,
+                help='Run the r engine\'s comparisons and plots on this many '
+                + 'long-lived R processes, which load the IDR code once, '
+                + 'rather than starting Rscript for each. Default: 0, '
+                + 'start Rscript each time.')
+        self.add_argument('--em_acceleration', nargs='?', 
+                dest='em_acceleration', default=None, choices=['squarem'],
+                help='Accelerate the EM fit of the numpy engine. Options '
+                + 'are: squarem. Default: plain EM, as in R.')
+        self.add_argument('--warm_start', action='store_true', 
+                dest='warm_start', default=False,
+                help='Start the EM fits of the numpy engine from an earlier '
+                + 'fit of the same pair, if there is one, or of the pair '
+                + 'run before it.')
+        self.add_argument('--uri_points', nargs='?', dest='uri_points',
+                type=int, default=100,
+                help='Number of points to compute the correspondence '
+                + 'profile of each comparison at with the numpy engine. '
+                + 'Default: 100, as in R.')
+        self.add_argument('--plot_format', nargs='?', dest='plot_format',
+                default='pdf', choices=IdrPlotter.formats,
+                help='Format of the plots drawn for comparisons run with '
+                + 'the numpy engine. Options are: {}. Default: pdf'.format(
+                                            ', '.join(IdrPlotter.formats)))
+        self.add_argument('--genome', nargs='?', dest='genome',
+                help='Genome whose chromosome sizes are used to pair peaks: '
+                + 'one of {} or the path to a '.format(
+                                        ', '.join(sorted(Genome.available())))
+                + 'table of chromosome names and sizes. '
+                + 'Default: idrCode/genome_table.txt (hg19) for the r engine; '
+                + 'the numpy engine does not need one.')
+        self.add_argument('--compress', action='store_true', 
+                dest='compress', default=False,
+                help='Write intermediate narrowPeak files, overlapped '
+                + 'peaks from the numpy engine, and the output of '
+                + 'overlap2narrow gzip-compressed. Compressed '
+                + 'inputs are read whether or not this is set.')
+        self.add_argument('--columnar', action='store_true', 
+                dest='columnar', default=False,
+                help='Write intermediate narrowPeak files, and overlapped '
+                + 'peaks from the numpy engine, as binary columnar tables '
+                + 'rather than text. Columnar inputs are recognized '
+                + 'automatically, and exported to text for the r engine.')
+        self.add_argument('--no-cache', action='store_true', 
+                dest='no_cache', default=False,
+                help='Do not reuse or store converted peak files and '
+                + 'pairwise comparisons in the result cache.')
+        self.add_argument('--cache_dir', nargs='?', dest='cache_dir',
+                help='Directory for the result cache. '
+                + 'Default: ~/.cache/homer-idr')
+        self.add_argument('--cache_size', nargs='?', dest='cache_size',
+                type=float, default=10,
+                help='Maximum size of the result cache in GB; the least '
+                + 'recently used results are removed beyond it. Default: 10')
+        self.add_argument('--restart', action='store_true', 
+                dest='restart', default=False,
+                help='Rerun every stage of the idr command, rather than '
+                + 'resuming from the checkpoints of an earlier run.')
+        self.add_argument('--max_memory', nargs='?', dest='max_memory',
+                type=float,
+                help='Approximate memory in GB that the stages of the idr '
+                + 'and batch commands may use at once, as estimated from '
+                + 'the sizes of their inputs. Default: no limit')
+        self.add_argument('--profile', action='store_true', 
+                dest='profile', default=False,
+                help='Record the wall time, CPU time, peak memory, and I/O '
+                + 'of each stage and child process, to idr-profile.json '
+                + 'in the output directory.')
+        self.add_argument('--cprofile', action='store_true', 
+                dest='cprofile', default=False,
+                help='With --profile, also save cProfile stats of each '
+                + 'Python stage to the idr-cprofile directory in the '
+                + 'output directory.')
+        self.add_argument('-j', '--jobs', nargs='?', dest='jobs',
+                type=int, default=1,
+                help='Number of parallel workers: pairwise comparisons to run '
+                + 'concurrently, Homer peak files to convert at once, or '
+                + 'chromosome files to split at once when '
+                + 'creating pseudoreplicates. With more than one job, each '
+                + 'comparison logs to its own .log file next to its output. '
+                + 'Default: 1')
         self.add_argument('--number_of_peaks', nargs='?', dest='number_of_peaks',
                 type=int, 
                 help='If you are passing in already-processed IDR peak files, '
@@ -96,35 +237,144 @@ class IdrArgumentParser(ArgumentParser):
                 help='Specificically set the IDR threshold for pooled pseudoreps '
                 + 'if you do not want '
                 + 'it to be auto-calculated based on the number of peaks.')
+        self.add_argument('--thresholds', nargs='*', dest='thresholds',
+                type=float, 
+                help='IDR thresholds to count peaks within for the sweep '
+                + 'command. Default: 0.01 to 0.25 in steps of 0.01.')
+        self.add_argument('--benchmark_scales', nargs='*', 
+                dest='benchmark_scales',
+                help='Scales of synthetic experiments to run the benchmark '
+                + 'command at: {}, '.format(', '.join(Benchmark.scales))
+                + 'or peaks:tags, such as 5000:1e6. Default: small')
         
         
         
-    def homer2narrow(self, options, peak_files, output_dir=None):
+    def homer2narrow(self, options, peak_files, output_dir=None, 
+                     with_counts=False):
         '''
         Convert passed Homer peak files to narrowPeak files as specified by 
         the IdrUtilities object.
         
-        Returns the set of filenames for generated narrowPeak files.
+        Returns the set of filenames for generated narrowPeak files, or,
+        with_counts, the filenames and the number of peaks in each, which
+        is None for files reused from the cache.
         '''
         output_dir = output_dir or options.output_dir
         self.check_output_dir(output_dir)
              
         idrutils = IdrUtilities()
-        output_files = []
+        extension = '.narrowPeak'
+        if options.columnar: extension += ColumnarTable.extension
+        elif options.compress: extension += '.gz'
+        output_prefixes = []
         for peak_file in peak_files:
             # Get extensionless name of file
-            basename = os.path.splitext(os.path.basename(peak_file))[0]
-            # Add a randint to avoid name collision
-            basename = basename + '_' + str(randint(1,999))
-            output_file = os.path.join(output_dir, basename + '.narrowPeak')
-            
-            data = idrutils.import_homer_peaks(peak_file)
-            idrutils.homer_to_narrow_peaks(data, output_file)
-            
-            print('NarrowPeak file output to {}'.format(output_file))
+            basename = split_name(peak_file)[0]
+            # Add a digest of the full path to avoid name collision,
+            # keeping names the same from run to run.
+            basename = basename + '_' + hashlib.md5(
+                    os.path.abspath(peak_file).encode()).hexdigest()[:6]
+            output_prefixes.append(os.path.join(output_dir, basename))
+        output_files = [prefix + extension for prefix in output_prefixes]
+        
+        # Reuse conversions of unchanged files from the cache.
+        cache = self.get_cache(options)
+        code_dir = os.path.dirname(os.path.realpath(__file__))
+        code_files = [os.path.join(code_dir, f) 
+                      for f in ('utils.py', 'columnar.py')]
+        keys, pending = {}, []
+        for peak_file, prefix in zip(peak_files, output_prefixes):
+            if cache is not None:
+                keys[prefix] = cache.get_key('homer2narrow', [peak_file],
+                            params={'extension': extension},
+                            code_files=code_files)
+                if cache.fetch(keys[prefix], prefix) is not None:
+                    print('NarrowPeak file reused from cache at {}'.format(
+                                                        prefix + extension))
+                    continue
+            pending.append((peak_file, prefix + extension))
+        
+        counts = dict.fromkeys(output_files)
+        jobs = min(options.jobs or 1, len(pending))
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                converted = executor.map(idrutils.convert_homer_peaks,
+                                         *zip(*pending), 
+                                         [True]*len(pending))
+                for output_file, count in converted:
+                    counts[output_file] = count
+                    print('NarrowPeak file output to {}'.format(output_file))
+        else:
+            for peak_file, output_file in pending:
+                _, counts[output_file] = idrutils.convert_homer_peaks(
+                                    peak_file, output_file, with_count=True)
+                print('NarrowPeak file output to {}'.format(output_file))
+        
+        if cache is not None:
+            for _, output_file in pending:
+                prefix = output_file[:-len(extension)]
+                cache.store(keys[prefix], prefix, [extension])
+        if with_counts: return output_files, [counts[f] for f in output_files]
+        return output_files
+    
+    def columnar2text(self, options, peak_files, output_dir=None):
+        '''
+        Export columnar narrowPeak or overlapped-peak tables as text.
+        
+        Returns the set of filenames for generated text files.
+        '''
+        output_dir = output_dir or options.output_dir
+        self.check_output_dir(output_dir)
+        
+        output_files = []
+        for peak_file in peak_files:
+            basename = os.path.basename(
+                                ColumnarTable.strip_extension(peak_file))
+            kind = ColumnarTable.read_header(peak_file)['kind']
+            if kind == 'overlapped-peaks' and not basename.endswith('.txt'):
+                basename += '.txt'
+            output_file = os.path.join(output_dir, basename)
+            ColumnarTable.to_text(peak_file, output_file)
+            print('Text file output to {}'.format(output_file))
             output_files.append(output_file)
         return output_files
     
+    def overlap2narrow(self, options, idr_files, output_dir=None):
+        '''
+        Convert -overlapped-peaks files, text or columnar, to narrowPeak
+        files ordered by IDR, as idrOverlap2npk.sh does, on up to 
+        options.jobs processes. Without an output directory, each is 
+        written next to its input.
+        
+        Returns the set of filenames for generated narrowPeak files.
+        '''
+        output_dir = output_dir or options.output_dir
+        if output_dir: self.check_output_dir(output_dir)
+        
+        idrutils = IdrUtilities()
+        extension = '.npk'
+        if options.compress: extension += '.gz'
+        output_files = []
+        for idr_file in idr_files:
+            basename = os.path.basename(strip_compression(
+                                ColumnarTable.strip_extension(idr_file)))
+            output_files.append(os.path.join(
+                                output_dir or os.path.dirname(idr_file),
+                                basename + extension))
+        
+        jobs = min(options.jobs or 1, len(idr_files))
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                converted = executor.map(idrutils.convert_overlapped_peaks,
+                                         idr_files, output_files)
+                for output_file in converted:
+                    print('NarrowPeak file output to {}'.format(output_file))
+        else:
+            for idr_file, output_file in zip(idr_files, output_files):
+                idrutils.convert_overlapped_peaks(idr_file, output_file)
+                print('NarrowPeak file output to {}'.format(output_file))
+        return output_files
+    
     def pseudoreplicate(self, options, suffix='Pseudorep'):
         '''
         Generate pseudoreplicates for passed tag directory by splitting randomly.
@@ -143,36 +393,51 @@ class IdrArgumentParser(ArgumentParser):
             pseudoreps.append(idrutils.create_pseudoreps(tag_dir, 
                                         options.output_dir, 
                                         count=options.pseudorep_count,
-                                        suffix=suffix))
+                                        suffix=suffix,
+                                        seed=options.seed,
+                                        jobs=options.jobs,
+                                        split_tag_counts=options.split_tag_counts,
+                                        validate=options.validate_tag_dirs))
         
         return list(zip(*pseudoreps))
             
     def pool_pseudoreplicates(self, options):
         '''
-        Generate pseudoreplicates for each directory, then pool the pseudoreps.
+        Generate pooled pseudoreplicates for the passed tag directories,
+        in one pass over all their tags. Each directory's share of each
+        pooled pseudorep is kept as a tag directory only if asked for.
         '''
         if not options.pooled_dir_name:
             raise Exception('A name for the pooled directory is needed. '
                             + 'Please indicate one with the --pooled-dir-name option.')
-            
-        pseudorep_sets = self.pseudoreplicate(options, suffix='Pooling-Pseudorep')
+        self.check_output_dir(options.output_dir)
         
+        print('Generating {} pooled pseudoreplicate tag directories for {}'\
+              .format(options.pseudorep_count, ', '.join(options.tag_dirs)))
         idrutils = IdrUtilities()
-        for i, pseudorep_set in enumerate(pseudorep_sets):
-            idrutils.clean_up_pseudoreps(os.path.join(options.output_dir,
-                                            options.pooled_dir_name + 
-                                            '-Pseudorep' + str(i + 1)), 
-                                     pseudorep_set)
-        
-    def truncate(self, options, peak_files, output_dir=None):
+        return idrutils.create_pooled_pseudoreps(options.tag_dirs, 
+                                options.output_dir, options.pooled_dir_name,
+                                count=options.pseudorep_count,
+                                seed=options.seed, jobs=options.jobs,
+                                split_tag_counts=options.split_tag_counts,
+                                validate=options.validate_tag_dirs,
+                                sample_suffix=options.keep_sample_pseudoreps 
+                                                and 'Pooling-Pseudorep')
+        
+    def truncate(self, options, peak_files, output_dir=None, counts=None):
         '''
         Truncate SORTED narrowPeak files so that they are all the same length.
+        
+        Pass counts, the number of peaks in each file, if already known.
         '''
-        self.check_output_dir(output_dir or options.output_dir)
+        output_dir = output_dir or options.output_dir
+        self.check_output_dir(output_dir)
         
         idrutils = IdrUtilities()
         output_files = idrutils.standardize_peak_counts(peak_files, 
-                                                        output_dir)
+                                                        output_dir,
+                                                        counts=counts,
+                                                        jobs=options.jobs)
         
         return output_files
         
@@ -182,8 +447,55 @@ class IdrArgumentParser(ArgumentParser):
         Go through entire IDR pipeline, starting from replicate peak_files
         and pseudoreplicate peak files.
         
+        Each step is a stage of a Pipeline, checkpointed in the output
+        directory, so that a rerun after a failure resumes from the last
+        completed stages. With --jobs, independent stages run concurrently;
+        for example, replicate comparisons are plotted while pooled 
+        comparisons are still running.
+        '''
+        self.check_output_dir(options.output_dir)
+        
+        pipeline = Pipeline(os.path.join(options.output_dir, 'checkpoints'),
+                            jobs=options.jobs, restart=options.restart,
+                            memory_limit=self.get_memory_limit(options))
+        idrcaller = self.get_idrcaller(options)
+        self.add_idr_stages(pipeline, idrcaller, options)
+        
+        idrcaller.start_executor()
+        try:
+            pipeline.run()
+        finally:
+            idrcaller.shutdown()
+    
+    def get_idrcaller(self, options):
+        return IdrCaller(engine=options.engine, jobs=options.jobs,
+                         genome=options.genome, 
+                         columnar=options.columnar,
+                         compress=options.compress,
+                         cache=self.get_cache(options),
+                         em_acceleration=options.em_acceleration,
+                         warm_start=options.warm_start,
+                         uri_points=options.uri_points,
+                         plot_format=options.plot_format,
+                         r_workers=options.r_workers)
+    
+    def add_idr_stages(self, pipeline, idrcaller, options, namespace=None):
+        '''
+        Add the stages of the idr command for one experiment to pipeline.
+        
+        With a namespace, stage names are prefixed with it, so that the 
+        stages of several experiments can share one pipeline; each
+        experiment is still checkpointed in its own output directory.
         '''
         self.check_output_dir(options.output_dir)
+        checkpoint_dir = os.path.join(options.output_dir, 'checkpoints')
+        def add_stage(name, func, depends=(), params=None, memory=0):
+            if namespace:
+                name = namespace + '/' + name
+                depends = [namespace + '/' + d for d in depends]
+            return pipeline.add_stage(name, func, depends=depends, 
+                                      params=params, memory=memory,
+                                      checkpoint_dir=checkpoint_dir)
         
         peak_sets = [options.peak_files, 
                      options.pseudorep_files, 
@@ -209,91 +521,371 @@ class IdrArgumentParser(ArgumentParser):
         pooled_dir = os.path.join(options.output_dir, 'pooled_comparisons')
         for d in (replicate_dir, pseudorep_dir, pooled_dir):
             if not os.path.exists(d): os.mkdir(d)
-            
+        
         if len(all_idr_peaks) == 0:
             if len(all_narrowpeaks) == 0:
                 narrowpeak_dir = os.path.join(options.output_dir, 'narrowpeaks')
+                input_sets = peak_sets
                 # First, convert all peak files and truncate to the same length
-                narrows = self.homer2narrow(options, peak_files=all_peaks,
-                                            output_dir=narrowpeak_dir)
-                truncated = self.truncate(options, peak_files=narrows,
-                                          output_dir=narrowpeak_dir)
-                
-                # Split back out into two separate groups
-                rep_truncated = truncated[:len(options.peak_files)]
-                pseudorep_truncated = truncated[len(options.peak_files):\
-                                                (len(options.peak_files) + \
-                                                len(options.pseudorep_files))]
-                pooled_truncated = truncated[-len(options.pooled_pseudoreps):]
+                def convert():
+                    return self.homer2narrow(options, peak_files=all_peaks,
+                                             output_dir=narrowpeak_dir,
+                                             with_counts=True)
+                def truncate(converted):
+                    # Counts from conversion save reading each file again.
+                    narrows, counts = converted
+                    truncated = self.truncate(options, peak_files=narrows,
+                                              output_dir=narrowpeak_dir,
+                                              counts=counts)
+                    # Split back out into separate groups
+                    return self.split_groups(truncated, peak_sets)
+                add_stage('convert', convert, 
+                          params={'peak_files': self.get_file_stats(all_peaks),
+                                  'columnar': options.columnar,
+                                  'compress': options.compress,
+                                  # Checkpoints of files alone are stale.
+                                  'with_counts': True},
+                          memory=self.get_memory_estimate(all_peaks))
+                add_stage('truncate', truncate, depends=['convert'],
+                          memory=self.get_memory_estimate(all_peaks))
             else:
-                rep_truncated = options.rep_narrowpeaks
-                pseudorep_truncated = options.pseudorep_narrowpeaks
-                pooled_truncated = options.pooled_narrowpeaks
+                input_sets = narrowpeak_sets
+                add_stage('truncate', lambda: narrowpeak_sets,
+                          params={'narrowpeaks': 
+                                  self.get_file_stats(all_narrowpeaks)})
             
-            # Compare our replicates, pairwise.
-            idrcaller = IdrCaller()
-            rep_prefixes = idrcaller.compare_replicates(rep_truncated, 
-                                                replicate_dir, ranking_measure)
-            pseudorep_prefixes = idrcaller.compare_pseudoreps(pseudorep_truncated, 
-                                                pseudorep_dir, ranking_measure)
-            pooled_prefixes = idrcaller.compare_pseudoreps(pooled_truncated, 
-                                                pooled_dir, ranking_measure)
-            
-            # Where did we output our files?
-            suffix = '-overlapped-peaks.txt'
-            rep_files = []
-            for prefix in rep_prefixes:
-                prefix = os.path.basename(prefix)
-                rep_files.append(os.path.join(replicate_dir, prefix + suffix))
-            pseudorep_files = []
-            for prefix in pseudorep_prefixes:
-                prefix = os.path.basename(prefix)
-                pseudorep_files.append(os.path.join(pseudorep_dir, prefix + suffix))
-            pooled_files = []
-            for prefix in pooled_prefixes:
-                prefix = os.path.basename(prefix)
-                pooled_files.append(os.path.join(pooled_dir, prefix + suffix))
-        
-            # Plot all of our pairwise comparisons
+            # Compare our replicates, pairwise, and each set of 
+            # pseudoreps. Comparison stages share one pool of workers.
+            compare_params = {'engine': options.engine, 
+                              'genome': options.genome,
+                              'columnar': options.columnar,
+                              'compress': options.compress,
+                              'em_acceleration': options.em_acceleration,
+                              'warm_start': options.warm_start,
+                              'uri_points': options.uri_points,
+                              'ranking_measure': ranking_measure}
             plot_dir = os.path.join(options.output_dir, 'plots')
             if not os.path.exists(plot_dir): os.mkdir(plot_dir)
-            idrcaller.plot_comparisons(rep_prefixes, plot_dir, 
-                                       output_prefix='Replicate_comparison')
-            
-            idrcaller.plot_comparisons(pseudorep_prefixes, plot_dir, 
-                                       output_prefix='Pseudorep_comparison')
+            for i, (name, get_pairs, output_dir, plot_name) in enumerate((
+                        ('replicates', idrcaller.get_replicate_pairs,
+                         replicate_dir, 'Replicate_comparison'),
+                        ('pseudoreps', idrcaller.get_pseudorep_pairs,
+                         pseudorep_dir, 'Pseudorep_comparison'),
+                        ('pooled', idrcaller.get_pseudorep_pairs,
+                         pooled_dir, 'Pooled_pseudorep_comparison'))):
+                add_stage('compare_' + name, 
+                          self.get_compare_stage(idrcaller, get_pairs, i,
+                                                 output_dir, ranking_measure),
+                          depends=['truncate'], params=compare_params,
+                          memory=self.get_memory_estimate(input_sets[i]))
+                
+                # Plot all of our pairwise comparisons, if there are any;
+                # every pair needs two files.
+                if len(input_sets[i]) < 2: continue
+                add_stage('plot_' + name,
+                          self.get_plot_stage(idrcaller, plot_dir, plot_name),
+                          depends=['compare_' + name],
+                          params={'plot_format': options.plot_format})
+            slice_depends = ['truncate', 'compare_replicates', 
+                             'compare_pseudoreps', 'compare_pooled']
             
-            idrcaller.plot_comparisons(pooled_prefixes, plot_dir, 
-                                       output_prefix='Pooled_pseudorep_comparison')
-         
+            def slice_all(truncated, *comparisons):
+                # We need the number of peaks input into analysis
+                # to automatically determine a threshold
+                number_of_peaks = options.number_of_peaks
+                if truncated[0]:
+                    number_of_peaks = IdrUtilities().count_peaks(
+                                                        truncated[0][0])
+                return self.slice_all(options, number_of_peaks, 
+                                      *[c['files'] for c in comparisons])
         else:
-            rep_files = options.rep_idr_peaks
-            pseudorep_files = options.pseudorep_idr_peaks
-            pooled_files = options.pooled_idr_peaks
+            slice_depends = []
+            def slice_all():
+                return self.slice_all(options, options.number_of_peaks, 
+                                      *idr_peak_sets)
+        
+        pooled_peaks = [options.pooled_peaks] if options.pooled_peaks else []
+        add_stage('slice', slice_all, depends=slice_depends,
+                  params={'threshold': options.threshold,
+                          'pooled_threshold': options.pooled_threshold,
+                          'number_of_peaks': options.number_of_peaks,
+                          'ranking_measure': options.ranking_measure,
+                          'pooled_peaks': self.get_file_stats(pooled_peaks),
+                          'idr_peaks': self.get_file_stats(all_idr_peaks)},
+                  memory=self.get_memory_estimate(pooled_peaks))
+    
+    def get_memory_limit(self, options):
+        if not options.max_memory: return None
+        return int(options.max_memory*2**30)
+    
+    def get_memory_estimate(self, filenames):
+        '''
+        A rough estimate of the memory used to process filenames at 
+        once, from their sizes on disk.
+        '''
+        size = 0
+        for filename in filenames:
+            factor = self.memory_per_input_byte
+            if is_compressed(filename): factor *= self.compression_ratio
+            size += factor*os.path.getsize(filename)
+        return size
+    
+    def batch(self, options):
+        '''
+        Run the idr command for each experiment in a manifest, with the 
+        stages of all experiments on one pipeline, sharing its limits on
+        workers and memory, and comparisons on one pool of workers.
+        
+        Completed stages of each experiment are skipped as in the idr
+        command, and an experiment that fails, even in setting up its
+        stages, as when an input file is missing, does not stop the 
+        others. A summary table of all experiments is written at the end.
         
-        # We need the number of peaks input into analysis
-        # to automatically determine a threshold
+        Returns the name of the summary table.
+        '''
+        if not options.manifest:
+            raise Exception('A manifest of experiments is needed for the '
+                            + 'batch command: run_idr.py batch manifest.tsv')
+        experiments = self.read_manifest(options)
+        output_dir = options.output_dir \
+                        or os.path.dirname(os.path.abspath(options.manifest))
+        self.check_output_dir(output_dir)
+        
+        pipeline = Pipeline(os.path.join(output_dir, 'checkpoints'),
+                            jobs=options.jobs, restart=options.restart,
+                            memory_limit=self.get_memory_limit(options),
+                            keep_going=True)
+        idrcaller = self.get_idrcaller(options)
+        setup_failures = {}
+        for name, experiment in experiments:
+            try:
+                self.add_idr_stages(pipeline, idrcaller, experiment, 
+                                    namespace=name)
+            except Exception as e:
+                print('!! Experiment {} could not be set up: {}'.format(
+                                                                name, e))
+                pipeline.remove_namespace(name)
+                setup_failures[name] = e
+        print('Running {} experiments on {} workers.'.format(
+                                        len(experiments), pipeline.jobs))
+        
+        idrcaller.start_executor()
         try:
-            number_of_peaks = len(open(rep_truncated[0], 'r').readlines())
-        except Exception:
-            # We skipped truncating our peaks; expect number of peaks
-            # OR a threshold.
-            if options.number_of_peaks is None \
-                and (options.threshold is None or options.pooled_threshold is None):
-                    raise Exception('You must pass the number_of_peaks '
-                                    + 'or both a threshold and pooled_threshold '
-                                    + 'to complete analysis.')
-            number_of_peaks = options.number_of_peaks
+            results = pipeline.run()
+        finally:
+            idrcaller.shutdown()
+        
+        summary = self.get_batch_summary(experiments, pipeline, results,
+                                         setup_failures)
+        output_file = os.path.join(output_dir, 'idr-batch-summary.txt')
+        summary.to_csv(output_file, sep='\t', index=False)
+        print(summary.to_string(index=False))
+        print('Batch summary output to {}'.format(output_file))
+        
+        failed = (summary['status'] == 'failed').sum()
+        if failed:
+            raise Exception('{} of {} experiments failed; see {}'.format(
+                                    failed, len(experiments), output_file))
+        return output_file
+    
+    def read_manifest(self, options):
+        '''
+        Read a tab-delimited manifest of experiments, with a header naming
+        columns from manifest_columns. Each row is an experiment, run with
+        the options passed on the command line, as overridden by the row;
+        empty cells are left unset, and lists of files are 
+        comma-separated.
+        
+        Returns a list of (name, options) for each experiment; names 
+        default to the basename of the output directory.
+        '''
+        manifest = read_csv(options.manifest, sep='\t', header=0, dtype=str,
+                            keep_default_na=False, comment='#')
+        unknown = set(manifest.columns) - set(self.manifest_columns)
+        if unknown:
+            raise Exception('Unknown manifest columns: {}. '.format(
+                                        ', '.join(sorted(unknown)))
+                            + 'Options are: {}'.format(
+                                        ', '.join(self.manifest_columns)))
+        if 'output_dir' not in manifest.columns:
+            raise Exception('The manifest needs an output_dir column.')
+        
+        experiments = []
+        for _, row in manifest.iterrows():
+            experiment = copy.copy(options)
+            for column, value in row.items():
+                value = value.strip()
+                if column == 'name' or not value: continue
+                if column in self.manifest_list_columns:
+                    value = [f.strip() for f in value.split(',') if f.strip()]
+                elif column == 'number_of_peaks': value = int(value)
+                elif column in ('threshold', 'pooled_threshold'): 
+                    value = float(value)
+                setattr(experiment, column, value)
+            # Experiments run side by side, so each converts its files 
+            # one at a time; comparisons share the pool of --jobs workers.
+            experiment.jobs = 1
+            experiment = self.sanitize_inputs(experiment)
+            name = row.get('name', '').strip() \
+                        or os.path.basename(experiment.output_dir)
+            experiments.append((name, experiment))
+        
+        names = [name for name, _ in experiments]
+        if len(set(names)) < len(names):
+            raise Exception('Experiment names in the manifest must be unique.')
+        return experiments
+    
+    def get_batch_summary(self, experiments, pipeline, results, 
+                          setup_failures=None):
+        '''
+        A row for each experiment: whether it completed, or where it
+        failed, and its thresholds and final peaks. Experiments in
+        setup_failures, by name, failed before any stage was run.
+        '''
+        setup_failures = setup_failures or {}
+        rows = []
+        for name, experiment in experiments:
+            row = {'experiment': name, 'output_dir': experiment.output_dir,
+                   'status': 'complete', 'failed_stage': '', 'error': '',
+                   'threshold': None, 'pooled_threshold': None,
+                   'peaks': None, 'output_file': ''}
+            for stage, error in pipeline.failures.items():
+                if not stage.startswith(name + '/') or error is None: continue
+                row.update(status='failed', failed_stage=stage[len(name) + 1:],
+                           error=str(error))
+            if name in setup_failures:
+                row.update(status='failed', failed_stage='setup',
+                           error=str(setup_failures[name]))
+            sliced = results.get(name + '/slice')
+            if isinstance(sliced, dict):
+                row.update(threshold=sliced['threshold'],
+                           pooled_threshold=sliced['pooled_threshold'])
+                if sliced['output_file']:
+                    row['output_file'] = sliced['output_file']
+                    # Less the header
+                    row['peaks'] = IdrUtilities().count_peaks(
+                                                sliced['output_file']) - 1
+            rows.append(row)
+        summary = DataFrame(rows, columns=['experiment', 'output_dir', 
+                                           'status', 'failed_stage', 'error',
+                                           'threshold', 'pooled_threshold', 
+                                           'peaks', 'output_file'])
+        # Keep counts whole among experiments without them.
+        return summary.astype({'peaks': 'Int64'})
+    
+    def get_compare_stage(self, idrcaller, get_pairs, group, output_dir,
+                          ranking_measure):
+        '''
+        Stage comparing the pairs of one group of truncated narrowPeak 
+        files; returns the output prefixes and overlapped peak files.
+        '''
+        def compare(truncated):
+            pairs = get_pairs(truncated[group], output_dir)
+            prefixes = idrcaller.run_pairs(pairs, 
+                                           ranking_measure=ranking_measure)
+            return {'prefixes': prefixes,
+                    'files': [idrcaller.get_overlapped_peaks_file(prefix)
+                              for prefix in prefixes]}
+        return compare
+    
+    def get_plot_stage(self, idrcaller, plot_dir, output_prefix):
+        def plot(comparison):
+            return idrcaller.plot_comparisons(comparison['prefixes'], plot_dir, 
+                                              output_prefix=output_prefix)
+        return plot
+    
+    def split_groups(self, items, groups):
+        '''
+        Split items back into lists the lengths of the passed groups.
+        '''
+        split, start = [], 0
+        for group in groups:
+            split.append(items[start:start + len(group)])
+            start += len(group)
+        return split
+    
+    def get_file_stats(self, filenames):
+        '''
+        Path, size, and mtime of each file, to tell when inputs change.
+        '''
+        stats = []
+        for filename in filenames:
+            stat = os.stat(filename)
+            stats.append((os.path.abspath(filename), stat.st_size, 
+                          stat.st_mtime_ns))
+        return stats
+    
+    def slice_all(self, options, number_of_peaks, 
+                  rep_files, pseudorep_files, pooled_files):
+        '''
+        Determine thresholds and slice the pooled peaks, if passed.
+        
+        Returns the thresholds, and the sliced peak file or None.
+        '''
+        if number_of_peaks is None \
+            and (options.threshold is None or options.pooled_threshold is None):
+                raise Exception('You must pass the number_of_peaks '
+                                + 'or both a threshold and pooled_threshold '
+                                + 'to complete analysis.')
             
         threshold = self.get_threshold(options, number_of_peaks, pooled=False)
         pooled_threshold = self.get_threshold(options, 
                                     number_of_peaks, pooled=True)
         
+        output_file = None
         if options.pooled_peaks:
-            self.slice_pooled_peaks(threshold, pooled_threshold,
+            output_file = self.slice_pooled_peaks(threshold, pooled_threshold,
                                     rep_files, pseudorep_files, pooled_files,
                                     options.pooled_peaks, options.output_dir,
                                     ranking_measure=options.ranking_measure)
+        return {'threshold': threshold, 'pooled_threshold': pooled_threshold,
+                'output_file': output_file}
+    
+    def sweep(self, options):
+        '''
+        Count the peaks within each of a grid of IDR thresholds for 
+        each of the passed IDR peak files, and for each group, the
+        greatest count across its files, as used to slice the pooled peaks.
+        
+        Returns the name of the tab-delimited table written.
+        '''
+        self.check_output_dir(options.output_dir)
+        
+        thresholds = options.thresholds
+        if not thresholds: thresholds = np.round(np.arange(1, 26)*.01, 2)
+        
+        groups = (('replicates', options.rep_idr_peaks),
+                  ('pseudoreps', options.pseudorep_idr_peaks),
+                  ('pooled', options.pooled_idr_peaks))
+        idr_files = [f for _, group in groups for f in group]
+        if not idr_files:
+            raise Exception('Pass IDR peak files to sweep with the '
+                            + '--rep_idr_peaks, --pseudorep_idr_peaks, or '
+                            + '--pooled_idr_peaks options.')
+        counts = sweep(idr_files, thresholds)
+        for name, group in groups:
+            if group: counts[name] = counts[group].max(axis=1)
+        counts.index.name = 'threshold'
+        
+        output_file = os.path.join(options.output_dir, 'idr-threshold-sweep.txt')
+        counts.to_csv(output_file, sep='\t')
+        print(counts[[name for name, group in groups if group]].to_string())
+        print('Threshold sweep output to {}'.format(output_file))
+        return output_file
+    
+    def benchmark(self, options):
+        '''
+        Time each stage of the pipeline on synthetic experiments, and 
+        check that the faster engines reproduce the reference IDR values.
+        
+        Returns the name of the JSON report written.
+        '''
+        self.check_output_dir(options.output_dir)
+        seed = options.seed if options.seed is not None else 0
+        benchmark = Benchmark(options.output_dir, 
+                              scales=options.benchmark_scales or ['small'],
+                              seed=seed, jobs=options.jobs)
+        return benchmark.run()
     
     def get_threshold(self, options, number_of_peaks, pooled=False):
         idrutil = IdrUtilities()
@@ -320,19 +912,14 @@ class IdrArgumentParser(ArgumentParser):
         pooled_count = idrutil.get_peaks_within_threshold(pooled_threshold, 
                                                           pooled_files)
         
-        # Pooled count should be within 2-fold of keep_count
-        if abs(math.log(keep_count/pooled_count, 2)) > 1:
-            print('!! Warning: The number of peaks within the replicate '
-                  + 'threshold is not within two-fold of the number of '
-                  + 'peaks within the pooled threshold. This could indicate '
-                  + 'inconsistencies in the datasets.\n'
-                  + 'Replicate count: {}, Pooled count: {}'.format(keep_count, 
-                                                                   pooled_count))
+        idrutil.check_pooled_count(keep_count, pooled_count)
         
         # Slice our pooled peak file accordingly.
         output_file = idrutil.slice_peaks(pooled_peaks, keep_count, 
-                                          ranking_measure, output_dir)
+                                          ranking_measure, output_dir,
+                                          idr_files=rep_files)
         print('{} peaks output to {}'.format(keep_count, output_file))
+        return output_file
     
     def sanitize_inputs(self, options):
         if not options.peak_files: options.peak_files = []
@@ -368,6 +955,22 @@ class IdrArgumentParser(ArgumentParser):
         
         return options
 
+    def get_cache(self, options):
+        '''
+        The result cache to use, or None with --no-cache.
+        '''
+        if options.no_cache: return None
+        return ResultCache(cache_dir=options.cache_dir, 
+                           max_size=int(options.cache_size*2**30))
+    
+    def get_profile_file(self, options, name):
+        '''
+        Profiles go in the output directory, or else the working directory.
+        '''
+        output_dir = options.output_dir or os.getcwd()
+        self.check_output_dir(output_dir)
+        return os.path.join(output_dir, name)
+    
     def check_output_dir(self, output_dir):
         if not output_dir:
             raise Exception('An output directory is needed. '
@@ -381,18 +984,36 @@ if __name__ == '__main__':
 
     options = parser.sanitize_inputs(options)
     
-    if options.command == 'idr':
-        parser.idr(options)
-    elif options.command == 'pseudoreplicate':
-        parser.pseudoreplicate(options)
-    elif options.command == 'pool-pseudoreplicates':
-        parser.pool_pseudoreplicates(options)
-    elif options.command == 'homer2narrow':
-        parser.homer2narrow(options, peak_files=options.peak_files)
-    elif options.command == 'truncate':
-        parser.truncate(options, peak_files=options.peak_files)
-        
-    
-    else:
-        print('Command {} not recognized.'.format(options.command))
-        parser.print_help()
\ No newline at end of file
+    profile = options.profile or options.cprofile
+    if profile:
+        profiling.start(cprofile_dir=options.cprofile 
+                        and parser.get_profile_file(options, 'idr-cprofile'))
+    try:
+        with profiling.stage(options.command, kind='command'):
+            if options.command == 'idr':
+                parser.idr(options)
+            elif options.command == 'pseudoreplicate':
+                parser.pseudoreplicate(options)
+            elif options.command == 'pool-pseudoreplicates':
+                parser.pool_pseudoreplicates(options)
+            elif options.command == 'homer2narrow':
+                parser.homer2narrow(options, peak_files=options.peak_files)
+            elif options.command == 'truncate':
+                parser.truncate(options, peak_files=options.peak_files)
+            elif options.command == 'columnar2text':
+                parser.columnar2text(options, peak_files=options.peak_files)
+            elif options.command == 'overlap2narrow':
+                parser.overlap2narrow(options, idr_files=options.peak_files)
+            elif options.command == 'sweep':
+                parser.sweep(options)
+            elif options.command == 'batch':
+                parser.batch(options)
+            elif options.command == 'benchmark':
+                parser.benchmark(options)
+            else:
+                print('Command {} not recognized.'.format(options.command))
+                parser.print_help()
+    finally:
+        if profile:
+            print('Profile output to {}'.format(profiling.stop(
+                    parser.get_profile_file(options, 'idr-profile.json'))))
\ No newline at end of file
@@ -0,0 +1,109 @@
+'''
+A comparison session: the replicates of a group of pairwise comparisons,
+each read, cleaned, and indexed once, rather than once per pair.
+
+With n replicates there are n(n-1)/2 pairs, and each would otherwise
+parse both of its narrowPeak files, shift their chromosomes into one
+coordinate range, and sort them. A session does this for each file
+once, and saves the resulting columns as .npy files in a scratch
+directory. Comparisons memory-map them read-only, so workers in other
+processes share the same pages rather than each holding a copy.
+
+Coordinates are shifted by one genome for the whole session: the
+engine's genome if it has one, or else one range per chromosome wide
+enough for every peak of every replicate. Pairing is the same whatever
+the width of the ranges, so results match those of separate runs.
+'''
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from idr.genome import Genome
+from idr.overlap import PeakOverlapper
+
+class PeakSession(object):
+    '''
+    Cleaned peaks and position indexes of a set of narrowPeak files,
+    saved in session_dir.
+    '''
+    columns = ('start', 'stop', 'start_ori', 'stop_ori', 'signal_value',
+               'p_value', 'q_value', 'summit')
+    # Columns of the position index used to pair peaks
+    index_columns = ('codes', 'starts', 'stops', 'order')
+
+    def __init__(self, session_dir, genome, files):
+        self.session_dir = session_dir
+        self.genome = genome
+        # Index of each file's arrays, by absolute path
+        self.files = files
+
+    @classmethod
+    def create(cls, engine, filenames, parent_dir=None):
+        '''
+        Read and clean each of filenames with the engine, index them, and
+        save them to a new session directory in parent_dir.
+        '''
+        filenames = list(dict.fromkeys(os.path.abspath(f) for f in filenames))
+        reps = [engine.process_narrow_peaks(f) for f in filenames]
+        for filename, rep in zip(filenames, reps):
+            print('Read {}: {} peaks left after cleaning.'.format(
+                                                filename, rep.shape[0]))
+
+        genome, indexes = PeakOverlapper(genome=engine.genome)\
+                                .index_peaks(*reps)
+
+        session_dir = tempfile.mkdtemp(prefix='.homer-idr-session-',
+                                       dir=parent_dir)
+        files = {}
+        for i, (filename, rep, index) in enumerate(zip(filenames, reps, 
+                                                       indexes)):
+            arrays = dict((col, rep[col].values) for col in cls.columns)
+            arrays.update(index)
+            for col, values in arrays.items():
+                np.save(os.path.join(session_dir, '{}-{}.npy'.format(i, col)),
+                        values)
+            files[filename] = i
+
+        session = cls(session_dir, genome, files)
+        with open(os.path.join(session_dir, 'session.json'), 'w') as f:
+            json.dump({'chroms': genome.chroms.tolist(),
+                       'sizes': genome.sizes.tolist(), 'files': files}, f)
+        return session
+
+    @classmethod
+    def open(cls, session_dir):
+        with open(os.path.join(session_dir, 'session.json'), 'r') as f:
+            session = json.load(f)
+        return cls(session_dir, Genome(session['chroms'], session['sizes']),
+                   session['files'])
+
+    def __getstate__(self):
+        # Workers reopen the session from its directory.
+        return {'session_dir': self.session_dir}
+
+    def __setstate__(self, state):
+        self.__dict__.update(self.open(state['session_dir']).__dict__)
+
+    def has(self, filename):
+        return os.path.abspath(filename) in self.files
+
+    def get(self, filename):
+        '''
+        The cleaned peaks of a file, as a dict of read-only arrays, with
+        chrom names, and its position index.
+        '''
+        i = self.files[os.path.abspath(filename)]
+        def load(col):
+            return np.load(os.path.join(self.session_dir,
+                                        '{}-{}.npy'.format(i, col)),
+                           mmap_mode='r')
+        rep = dict((col, load(col)) for col in self.columns)
+        index = dict((col, load(col)) for col in self.index_columns)
+        rep['chrom'] = self.genome.chroms[index['codes']]
+        return rep, index
+
+    def close(self):
+        shutil.rmtree(self.session_dir, ignore_errors=True)
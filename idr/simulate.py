@@ -0,0 +1,252 @@
+'''
+Synthetic Homer peak files and tag directories for benchmarking and
+checking the pipeline at realistic scales.
+
+Replicate signal is drawn from the two-component Gaussian copula
+mixture of simu.copula.2mix in functions-all-clayton-12-13.r: a share
+p of peaks are reproducible, with correlated signal between replicates,
+and the rest are noise. Tags are placed in peaks in proportion to their
+signal, over a uniform background.
+'''
+from collections import OrderedDict
+import json
+import os
+import re
+
+import numpy as np
+from pandas import DataFrame
+
+from idr.genome import Genome
+from idr.utils import IdrUtilities
+
+class SyntheticData(object):
+    '''
+    Writes a synthetic experiment: a Homer peak file and tag directory
+    for each of two replicates, and a peak file for the pooled replicates.
+    '''
+    # Copula mixture parameters, by default those of the IDR paper's
+    # simulations: 60% reproducible peaks, with replicate correlation 0.8.
+    mixture = {'p': 0.6, 'rho1': 0.8, 'rho2': 0,
+               'mu1': 2.5, 'mu2': 0, 'sd1': 1, 'sd2': 1}
+
+    # Normalized tag count of a peak with simulated signal 0.
+    signal_scale = 10
+    peak_width = 200
+    # Standard deviation of the shift of each replicate's peak positions.
+    position_jitter = 20
+    # Share of noise peaks that are moved elsewhere in each replicate,
+    # so that they appear in one replicate only.
+    unique_fraction = 0.2
+    # Share of tags placed in peaks rather than in the background.
+    peak_tag_fraction = 0.3
+    tag_length = 50
+
+    # Tag lines to write at a time.
+    write_chunk_size = 2**22
+
+    def __init__(self, genome='hg19', seed=None, **mixture):
+        genome = Genome.get(genome)
+        # Main chromosomes only, in their natural order.
+        keep = [i for i, chrom in enumerate(genome.chroms)
+                if re.match('chr[0-9XY]+$', chrom)]
+        keep.sort(key=lambda i: self.chrom_order(genome.chroms[i]))
+        self.genome_name = genome.name
+        self.chroms = genome.chroms[keep]
+        self.sizes = genome.sizes[keep]
+        self.seed = seed
+        self.random_state = np.random.RandomState(seed)
+        self.mixture = dict(self.mixture, **mixture)
+
+    def chrom_order(self, chrom):
+        name = chrom[3:]
+        return (0, int(name), '') if name.isdigit() else (1, 0, name)
+
+    def simulate_copula_mixture(self, n, p, rho1, rho2, mu1, mu2, sd1, sd2):
+        '''
+        Equivalent to simu.copula.2mix with a Gaussian copula: round(n*p)
+        reproducible pairs with correlation rho1 and margins N(mu1, sd1),
+        then noise pairs with correlation rho2 and margins N(mu2, sd2).
+
+        R draws u uniformly and v by the copula, and returns
+        qnorm(u, mu, sd) and qnorm(v, mu, sd); that is a bivariate
+        normal pair, which we draw directly.
+
+        Returns the two samples and the label of each pair, 1 for
+        reproducible and 2 for noise.
+        '''
+        n1 = int(round(n*p))
+        x, y = [], []
+        for count, rho, mu, sd in ((n1, rho1, mu1, sd1),
+                                   (n - n1, rho2, mu2, sd2)):
+            a = self.random_state.standard_normal(count)
+            b = rho*a + np.sqrt(1 - rho**2)\
+                        *self.random_state.standard_normal(count)
+            x.append(mu + sd*a)
+            y.append(mu + sd*b)
+        label = np.repeat([1, 2], [n1, n - n1])
+        return np.concatenate(x), np.concatenate(y), label
+
+    def write_experiment(self, output_dir, number_of_peaks, number_of_tags):
+        '''
+        Write peak files and tag directories for two replicates, and the
+        pooled peak file, to output_dir, with a synthetic.json describing
+        them. An experiment already written there with the same
+        parameters is reused.
+
+        Returns the description: lists of peak_files and tag_dirs, the
+        pooled_peaks file, and the parameters.
+        '''
+        description_file = os.path.join(output_dir, 'synthetic.json')
+        params = {'peaks': number_of_peaks, 'tags': number_of_tags,
+                  'seed': self.seed, 'genome': self.genome_name,
+                  'mixture': self.mixture}
+        if os.path.exists(description_file):
+            with open(description_file, 'r') as f:
+                description = json.load(f)
+            if description['params'] == params: return description
+
+        if not os.path.exists(output_dir): os.makedirs(output_dir)
+        x, y, label = self.simulate_copula_mixture(number_of_peaks,
+                                                   **self.mixture)
+        chrom_index, starts = self.get_positions(number_of_peaks)
+        signals = [self.signal_scale*np.exp(x), self.signal_scale*np.exp(y)]
+
+        description = {'params': params, 'peak_files': [], 'tag_dirs': []}
+        for i, signal in enumerate(signals):
+            name = 'Rep{}'.format(i + 1)
+            rep_index, rep_starts = self.get_replicate_positions(
+                                            chrom_index, starts, label)
+            peak_file = os.path.join(output_dir, name + '-peaks.txt')
+            self.write_peak_file(peak_file, rep_index, rep_starts, signal)
+            tag_dir = os.path.join(output_dir, name + '-tags')
+            self.write_tag_directory(tag_dir, number_of_tags,
+                                     rep_index, rep_starts, signal)
+            description['peak_files'].append(peak_file)
+            description['tag_dirs'].append(tag_dir)
+            print('Synthetic peaks and tags for {} output to {}'.format(
+                                                        name, output_dir))
+
+        description['pooled_peaks'] = os.path.join(output_dir,
+                                                   'Pooled-peaks.txt')
+        self.write_peak_file(description['pooled_peaks'], chrom_index,
+                             starts, signals[0] + signals[1])
+        with open(description_file, 'w') as f:
+            json.dump(description, f, indent=1)
+        return description
+
+    def get_positions(self, count, width=None):
+        '''
+        Random positions for count features of width, on chromosomes
+        chosen in proportion to their size. Returns the index of each
+        chromosome, and the starts.
+        '''
+        width = width or self.peak_width
+        chrom_index = self.random_state.choice(len(self.chroms), count,
+                                        p=self.sizes/self.sizes.sum())
+        starts = (self.random_state.random_sample(count)
+                  *(self.sizes[chrom_index] - width)).astype(np.int64)
+        return chrom_index, starts
+
+    def get_replicate_positions(self, chrom_index, starts, label):
+        '''
+        Shift each peak slightly for a replicate, and move some noise
+        peaks elsewhere entirely.
+        '''
+        starts = starts + np.round(self.random_state.normal(0,
+                            self.position_jitter, len(starts))).astype(np.int64)
+        moved = (label == 2) \
+                & (self.random_state.random_sample(len(starts))
+                   < self.unique_fraction)
+        chrom_index = chrom_index.copy()
+        chrom_index[moved], starts[moved] = self.get_positions(moved.sum())
+        return chrom_index, np.clip(starts, 0,
+                            self.sizes[chrom_index] - self.peak_width)
+
+    def write_peak_file(self, peak_file, chrom_index, starts, signal):
+        '''
+        Write peaks as a Homer peak file, sorted by signal as findPeaks
+        does, with a p-value falling with the signal.
+        '''
+        order = np.argsort(-signal, kind='mergesort')
+        signal = signal[order]
+        data = DataFrame({
+                    '#PeakID': ['Peak-{}'.format(i + 1)
+                                for i in range(len(order))],
+                    'chr': self.chroms[chrom_index[order]],
+                    'start': starts[order],
+                    'end': starts[order] + self.peak_width,
+                    'strand': '+',
+                    'Normalized Tag Count': signal,
+                    'findPeaks Score': signal,
+                    'Total Tags': signal,
+                    'p-value vs Control': 10**-np.clip(signal/10, 0, 300)})
+        with open(peak_file, 'w') as f:
+            f.write('# HOMER Peaks\n')
+            f.write('# Synthetic peaks simulated from a copula mixture\n')
+            f.write('# total peaks = {}\n'.format(len(order)))
+            data.to_csv(f, sep='\t', index=False, float_format='%.6g')
+
+    def write_tag_directory(self, tag_dir, number_of_tags,
+                            chrom_index, starts, signal):
+        '''
+        Write a Homer tag directory of single tags: a share of them
+        within peaks, in proportion to peak signal, and the rest spread
+        uniformly over the genome. Each chromosome is written as a
+        chr[X].tags.tsv file sorted by position, with tags at the same
+        position and strand collapsed into one line, as Homer does, and 
+        a tagInfo.txt.
+        '''
+        if not os.path.exists(tag_dir): os.makedirs(tag_dir)
+        peak_tags = self.random_state.multinomial(
+                        int(number_of_tags*self.peak_tag_fraction),
+                        signal/signal.sum())
+        background_tags = self.random_state.multinomial(
+                        number_of_tags - peak_tags.sum(),
+                        self.sizes/self.sizes.sum())
+
+        chrom_stats = OrderedDict()
+        for i, (chrom, size) in enumerate(zip(self.chroms, self.sizes)):
+            on_chrom = chrom_index == i
+            peak_starts = np.repeat(starts[on_chrom], peak_tags[on_chrom])
+            positions = np.concatenate((
+                    peak_starts + self.random_state.randint(0,
+                                    self.peak_width, len(peak_starts)),
+                    self.random_state.randint(0, size,
+                                              background_tags[i])))
+            strands = self.random_state.randint(0, 2, len(positions))
+            # Sorted by position, then strand
+            keys, counts = np.unique(positions*2 + strands, 
+                                     return_counts=True)
+            self.write_tag_file(os.path.join(tag_dir, chrom + '.tags.tsv'),
+                                chrom, keys//2, keys%2, counts)
+            chrom_stats[chrom] = (len(keys), len(positions), 
+                                  len(positions)*self.tag_length)
+        IdrUtilities().write_tag_info(tag_dir, chrom_stats, 
+                    genome=self.genome_name,
+                    parameters=['fragmentLengthEstimate={}'.format(
+                                                        self.peak_width),
+                                'peakSizeEstimate={}'.format(self.peak_width),
+                                'gsizeEstimate={}'.format(self.sizes.sum())])
+        return tag_dir
+
+    def write_tag_file(self, tag_file, chrom, positions, strands, counts):
+        '''
+        Homer tag lines: read ID, chromosome, position, strand (0 for +,
+        1 for -), number of tags, and tag length. IDs are left blank.
+        
+        Lines are joined from strings rather than written with to_csv,
+        which is several times slower at hundreds of millions of tags.
+        '''
+        prefix = '\t' + chrom + '\t'
+        strand_fields = ('\t0\t', '\t1\t')
+        suffix = '\t{}\n'.format(self.tag_length)
+        with open(tag_file, 'w') as f:
+            for start in range(0, len(positions), self.write_chunk_size):
+                end = start + self.write_chunk_size
+                f.write(''.join([prefix + position + strand_fields[strand]
+                                 + count + suffix
+                        for position, strand, count in zip(
+                                map(str, positions[start:end].tolist()),
+                                strands[start:end].tolist(),
+                                map(str, counts[start:end].astype(float)
+                                                          .tolist()))]))
@@ -5,14 +5,26 @@ Created on Aug 4, 2014
 
 '''
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import heapq
+from io import BytesIO, StringIO
+import itertools
+import math
 import os
+from random import randint
 import re
-import subprocess
+import shutil
+import zlib
 
-from pandas import DataFrame, Series
+from pandas import DataFrame
 from pandas.io.parsers import read_csv
 
 import numpy as np
+
+from idr.columnar import ColumnarTable
+from idr.compression import open_file, split_name, strip_compression
+from idr.idr_index import IdrIndex
+from idr import profiling
 class IdrUtilities(object):
     '''
     Various utilities for converting files, processing data, etc. that are 
@@ -22,16 +34,56 @@ class IdrUtilities(object):
     p_value_columns = ['p-value vs Control', 'p-value vs Local', 'p-value']
     tag_count_columns = ['Normalized Tag Count', 'findPeaks Score', 
                          'score', 'Total Tags']
+    chrom_columns = ['chr','chrom', 'chromosome']
+    start_columns = ['chromStart','start']
+    end_columns = ['chromEnd','end']
+    name_columns = ['#PeakID','PeakID','ID','name']
+    
+    # Bytes of tag lines to read at a time when splitting tag files
+    split_chunk_size = 2**24
+    # Tag lines to split at a time when merging the tag files of
+    # several directories
+    merge_chunk_lines = 2**18
+    
+    tag_file_pattern = r'chr[A-Za-z0-9]+\.tags\.tsv(\.b?gz)?$'
+    
+    # Peak lines to write at a time when slicing peak files
+    write_chunk_size = 2**14
+    
+    # Bytes to read at a time when counting and truncating peak files
+    read_chunk_size = 2**20
+    
+    # tagInfo.txt parameters recomputed for each pseudorep; others, such
+    # as fragmentLengthEstimate, describe the library and are carried over.
+    tag_info_computed = ('averageTagsPerPosition', 'averageTagLength', 
+                         'tagsPerBP')
+    
     ######################################################
     # Creating pseudo-replicates
     ######################################################
-    def create_pseudoreps(self, tag_dir, output_dir, count=2, suffix='Pseudorep'):
+    def create_pseudoreps(self, tag_dir, output_dir, count=2, suffix='Pseudorep',
+                          seed=None, jobs=1, split_tag_counts=False,
+                          validate=False):
         '''
-        Randomly split a Homer tag directory into two parts with approximately
+        Randomly split a Homer tag directory into parts with approximately
         equal number of reads.
         
-        @todo: this is super slow. Using Python IO is slower... maybe shuf 
-        would be faster? But many systems, OS X included, don't come with shuf.
+        Each chr[X].tags.tsv file is streamed once, and each line is 
+        assigned at random to one of the pseudoreps. If split_tag_counts 
+        is set, the tag count column of each line is instead split 
+        binomially across pseudoreps, so that collapsed tags at one position 
+        are divided too. 
+        
+        Pseudorep tag directories are written in place: the tags, unique 
+        positions, and tag lengths of each chromosome are counted as its 
+        file is split, and tagInfo.txt is written from them, so that
+        Homer need not read every tag again. With validate, Homer's 
+        makeTagDirectory re-reads each pseudorep to check the counts.
+        
+        Chromosome files are processed in parallel on up to jobs processes.
+        Pass a seed for reproducible splits; each chromosome of each tag 
+        directory draws from its own stream derived from the seed, so 
+        results do not depend on jobs.
         '''
         tag_dir_name = os.path.basename(tag_dir)
         # Make destination directories
@@ -39,57 +91,442 @@ class IdrUtilities(object):
         for i in range(1,count + 1):
             pseudo_tag_dirs.append(os.path.join(output_dir, 
                                     tag_dir_name + '-{}{}'.format(suffix,i)))
-            # Make tmp directory
-            os.mkdir(pseudo_tag_dirs[i - 1] + '-tmp')
-        
-        for f in os.listdir(tag_dir):
-            # If this is a chr[X].txt file
-            if re.match('chr[A-Za-z0-9]+\.tags\.tsv$',f):
-                chr_file = os.path.join(tag_dir, f)
-                shuffled_file = os.path.join(pseudo_tag_dirs[0] + '-tmp', 
-                                             f + '.tmp')
-                # Shuffle the source chr file:
-                subprocess.check_call("awk 'BEGIN{srand()}{print rand(),$0}' " +
-                                    "{} | sort -n | cut -d ' ' -f2- > {}".format(
-                                    chr_file, shuffled_file), shell=True)
-                
-                # How many lines do we have to split up?
-                line_count = subprocess.check_output('wc -l {}'.format(
-                                    shuffled_file), shell=True)
-                line_count = int(line_count.split()[0])
-                per_file = line_count//count
-                for i in range(1, count+1):
-                    # Output into file.
-                    subprocess.check_call('head -n {} {} | tail -n {} > {}'.format(
-                                i*per_file, shuffled_file, per_file, 
-                                os.path.join(pseudo_tag_dirs[i - 1] + '-tmp', f)),
-                                shell=True)
-        
-                subprocess.check_call('rm {}'.format(shuffled_file), shell=True)
-        
-        # Finally, use Homer to clean up
-        for i in range(0, count):
-            self.clean_up_pseudoreps(pseudo_tag_dirs[i], 
-                                     [pseudo_tag_dirs[i] + '-tmp'])
+            os.mkdir(pseudo_tag_dirs[i - 1])
+        
+        if seed is None:
+            seed = randint(0, 2**32 - 1)
+            print('Splitting {} with seed {}'.format(tag_dir, seed))
+        
+        # Each chr[X].tags.tsv file, and its outputs in each pseudorep
+        chr_files = self.get_tag_files(tag_dir)
+        tasks = []
+        for f in chr_files:
+            # Homer reads plain tag files, so outputs are not compressed.
+            tasks.append(([os.path.join(tag_dir, f)],
+                          [os.path.join(d, strip_compression(f)) 
+                           for d in pseudo_tag_dirs],
+                          (seed + zlib.crc32((tag_dir_name + f).encode()))
+                                %(2**32),
+                          split_tag_counts))
+        
+        stats = self.run_split_tasks(tasks, jobs)
+        
+        # Finally, describe each pseudorep as Homer would
+        genome, parameters = self.read_tag_info(tag_dir)
+        chroms = [f.split('.')[0] for f in chr_files]
+        for i, pseudo_tag_dir in enumerate(pseudo_tag_dirs):
+            self.write_tag_info(pseudo_tag_dir, 
+                                OrderedDict((chrom, chrom_stats[0][i]) 
+                                    for chrom, chrom_stats in zip(chroms, stats)),
+                                genome=genome, parameters=parameters)
+            if validate: self.validate_tag_directory(pseudo_tag_dir)
     
         return pseudo_tag_dirs
     
-    def clean_up_pseudoreps(self, target_dir, source_dirs): 
+    def create_pooled_pseudoreps(self, tag_dirs, output_dir, pooled_name, 
+                                 count=2, seed=None, jobs=1, 
+                                 split_tag_counts=False, validate=False,
+                                 sample_suffix=None):
         '''
-        Use Homer to re-make tag directory, as we want an accurate tagInfo file.
-        Make sure to use the /usr/bin/env clause to tell Python to look
-        in the environment's path for Homer.
+        Randomly split the pooled tags of several Homer tag directories 
+        into pooled pseudoreps, named pooled_name-Pseudorep[k], in a 
+        single pass.
+        
+        The chr[X].tags.tsv files of one chromosome in all tag directories
+        are streamed together, merged by position, and each line is 
+        assigned at random to one pooled pseudorep, or its tag count split
+        with split_tag_counts, as in create_pseudoreps. Lines at the 
+        same position and strand in different directories are collapsed
+        into one, with their tags summed, as Homer does: the position is
+        assigned as a whole, or each line's share of the split summed.
+        
+        With a sample_suffix, each directory's share of pooled pseudorep k
+        is also written as its own tag directory, named 
+        [tag_dir]-[sample_suffix][k]; pooled pseudorep k is then the 
+        union of these. Otherwise, no per-sample directories are written.
+        
+        Chromosomes are processed in parallel on up to jobs processes, each
+        drawing from its own stream derived from the seed.
         '''
-        cmd = '/usr/bin/env makeTagDirectory {} -d {}'.format(
-                            target_dir,
-                            ' '.join(source_dirs))
+        pooled_dirs = [os.path.join(output_dir, 
+                                    pooled_name + '-Pseudorep{}'.format(i))
+                       for i in range(1, count + 1)]
+        sample_dirs = []
+        if sample_suffix:
+            sample_dirs = [[os.path.join(output_dir, os.path.basename(tag_dir)
+                                         + '-{}{}'.format(sample_suffix, i))
+                            for i in range(1, count + 1)]
+                           for tag_dir in tag_dirs]
+        for d in pooled_dirs + [d for dirs in sample_dirs for d in dirs]:
+            os.mkdir(d)
+        
+        if seed is None:
+            seed = randint(0, 2**32 - 1)
+            print('Splitting {} with seed {}'.format(pooled_name, seed))
+        
+        # The tag directories with a file for each chromosome
+        sources = OrderedDict()
+        for i, tag_dir in enumerate(tag_dirs):
+            for f in self.get_tag_files(tag_dir):
+                sources.setdefault(strip_compression(f), []).append(
+                                                (i, os.path.join(tag_dir, f)))
+        tasks = []
+        for f, chrom_sources in sorted(sources.items()):
+            tasks.append(([chr_file for _, chr_file in chrom_sources],
+                          [os.path.join(d, f) for d in pooled_dirs],
+                          (seed + zlib.crc32((pooled_name + f).encode()))
+                                %(2**32),
+                          split_tag_counts,
+                          [[os.path.join(d, f) for d in sample_dirs[i]]
+                           for i, _ in chrom_sources] if sample_dirs else None))
+        stats = self.run_split_tasks(tasks, jobs)
         
-        subprocess.check_call(cmd.split())
-        for source in source_dirs:
-            subprocess.check_call('rm -rf {}'.format(source), shell=True)
+        # Describe each directory as Homer would; pooled pseudoreps take
+        # the library parameters of the first directory.
+        chroms = [f.split('.')[0] for f in sorted(sources)]
+        genome, parameters = self.read_tag_info(tag_dirs[0])
+        for i, pooled_dir in enumerate(pooled_dirs):
+            self.write_tag_info(pooled_dir, 
+                                OrderedDict((chrom, chrom_stats[0][i]) 
+                                    for chrom, chrom_stats in zip(chroms, stats)),
+                                genome=genome, parameters=parameters)
+        for i, dirs in enumerate(sample_dirs):
+            genome, parameters = self.read_tag_info(tag_dirs[i])
+            for k, sample_dir in enumerate(dirs):
+                chrom_stats = OrderedDict()
+                for f, (_, source_stats) in zip(sorted(sources), stats):
+                    sample_indices = [j for j, _ in sources[f]]
+                    if i not in sample_indices: continue
+                    chrom_stats[f.split('.')[0]] = \
+                        source_stats[sample_indices.index(i)][k]
+                self.write_tag_info(sample_dir, chrom_stats, 
+                                    genome=genome, parameters=parameters)
         
-        return target_dir
+        if validate:
+            for d in pooled_dirs + [d for dirs in sample_dirs for d in dirs]:
+                self.validate_tag_directory(d)
+        return pooled_dirs
+    
+    def get_tag_files(self, tag_dir):
+        '''
+        The chr[X].tags.tsv files of a tag directory, compressed or not.
+        '''
+        return [f for f in sorted(os.listdir(tag_dir))
+                if re.match(self.tag_file_pattern, f)]
+    
+    def run_split_tasks(self, tasks, jobs):
+        '''
+        Run split_tag_files for each tuple of arguments in tasks, on up
+        to jobs processes.
+        '''
+        if jobs > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) \
+                    as executor:
+                return list(executor.map(self.split_tag_files, *zip(*tasks)))
+        return [self.split_tag_files(*task) for task in tasks]
+    
+    def split_tag_file(self, chr_file, output_files, seed, 
+                       split_tag_counts=False):
+        '''
+        Stream a Homer chr[X].tags.tsv file once, randomly distributing
+        its tags across the passed output files.
+        
+        Returns, for each output file, its number of lines (unique 
+        positions), of tags, and the total length of its tags.
+        '''
+        return self.split_tag_files([chr_file], output_files, seed, 
+                                    split_tag_counts=split_tag_counts)[0]
+    
+    def split_tag_files(self, chr_files, output_files, seed, 
+                        split_tag_counts=False, source_output_files=None):
+        '''
+        Stream the Homer tag files of one chromosome from one or more 
+        tag directories once, merged by position, randomly distributing 
+        their tags across the passed output files.
+        
+        With source_output_files, a list of output files for each of 
+        chr_files, each tag is also written to the output of its own 
+        source with the same index as the output it is assigned to.
+        
+        Lines of several files at the same position and strand are 
+        collapsed into one in the outputs, with their tags summed; in 
+        each source's output files, they stay as they are.
+        
+        Returns, for each output file, its number of lines (unique 
+        positions), of tags, and the total length of its tags; and the 
+        same for each source's output files, if passed.
+        '''
+        random_state = np.random.RandomState(seed)
+        count = len(output_files)
+        source_output_files = source_output_files or []
+        stats = np.zeros((count, 3))
+        source_stats = np.zeros((len(source_output_files), count, 3))
+        outputs = [open(f, 'w') for f in output_files]
+        source_outputs = [[open(f, 'w') for f in files] 
+                          for files in source_output_files]
+        sources = [open_file(f, 'r') for f in chr_files]
+        try:
+            for lines, line_sources, keys in self.read_tag_chunks(sources):
+                if split_tag_counts:
+                    split, lengths, output_lines = self.split_tag_counts(
+                                                lines, count, random_state)
+                else:
+                    split, lengths, output_lines = self.assign_tag_lines(
+                                        lines, count, random_state, keys=keys)
+                collapsed, collapsed_lines = split, output_lines
+                if keys is not None:
+                    collapsed, collapsed_lines = self.collapse_tag_lines(
+                                            lines, keys, split, output_lines)
+                for output, lines_out in zip(outputs, collapsed_lines):
+                    output.writelines(lines_out)
+                stats += self.get_split_stats(split, lengths, 
+                                              collapsed=collapsed)
                 
+                for i, source_files in enumerate(source_outputs):
+                    in_source = line_sources == i
+                    source_stats[i] += self.get_split_stats(
+                                    split[:, in_source], lengths[in_source])
+                    for k, output in enumerate(source_files):
+                        output.writelines(np.asarray(output_lines[k], 
+                                                     dtype=object)[
+                                            in_source[split[k] > 0]])
+        finally:
+            for f in outputs + sources: f.close()
+            for files in source_outputs: 
+                for f in files: f.close()
+        return stats.tolist(), source_stats.tolist()
+    
+    def read_tag_chunks(self, sources):
+        '''
+        Chunks of lines from open Homer tag files, with the index of the
+        source of each line. The lines of several files, each sorted by
+        position, are merged by position, and each is also given the 
+        key of its position and strand, numbered within the chunk; the 
+        lines of one position are never split between chunks. A single
+        file is read as is, without keys.
+        '''
+        if len(sources) == 1:
+            while True:
+                lines = sources[0].readlines(self.split_chunk_size)
+                if not lines: return
+                yield lines, np.zeros(len(lines), dtype=np.intp), None
+        merged = heapq.merge(*[((int(line.split('\t', 3)[2]), i, line) 
+                                for line in source)
+                               for i, source in enumerate(sources)])
+        pending = []
+        while True:
+            chunk = pending + list(itertools.islice(merged, 
+                                                    self.merge_chunk_lines))
+            if not chunk: return
+            pending = []
+            for item in merged:
+                if item[0] != chunk[-1][0]:
+                    pending = [item]
+                    break
+                chunk.append(item)
+            _, line_sources, lines = zip(*chunk)
+            numbers = {}
+            keys = [numbers.setdefault(tuple(line.split('\t', 4)[1:4]), 
+                                       len(numbers)) 
+                    for line in lines]
+            yield list(lines), np.array(line_sources, dtype=np.intp),\
+                    np.array(keys, dtype=np.intp)
+    
+    def collapse_tag_lines(self, lines, keys, split, output_lines):
+        '''
+        Collapse the lines of each output that share a key, numbered as 
+        from read_tag_chunks, into the first of them, with their tags 
+        summed. Lines with a key of their own are kept as they are.
+        
+        Returns the tag count of each key in each output, and a list of 
+        lines for each output.
+        '''
+        n_keys = keys.max() + 1
+        collapsed = np.array([np.bincount(keys, weights=tags, 
+                                          minlength=n_keys) 
+                              for tags in split])
+        shared = np.bincount(keys, minlength=n_keys) > 1
+        if not shared.any(): return collapsed, output_lines
+        
+        # The first line of each key, in order
+        firsts = np.zeros(n_keys, dtype=np.intp)
+        firsts[keys[::-1]] = np.arange(len(keys) - 1, -1, -1)
+        collapsed_lines = []
+        for k, lines_out in enumerate(output_lines):
+            # Output lines are those of the chunk with tags in output k.
+            present = np.flatnonzero(split[k] > 0)
+            kept = [(i, line) for i, line in zip(present, lines_out)
+                    if not shared[keys[i]]]
+            for key in np.flatnonzero(shared & (collapsed[k] > 0)):
+                fields = lines[firsts[key]].rstrip('\n').split('\t')
+                kept.append((firsts[key], '\t'.join(
+                                fields[:4] + [str(collapsed[k, key])] 
+                                + fields[5:]) + '\n'))
+            kept.sort(key=lambda item: item[0])
+            collapsed_lines.append([line for _, line in kept])
+        return collapsed, collapsed_lines
+    
+    def assign_tag_lines(self, lines, count, random_state, keys=None):
+        '''
+        Assign each Homer tag line, with all its tags, to one of count
+        outputs at random. With keys, lines with the same key are 
+        assigned together.
+        
+        Returns the tag count of each line in each output, the tag length
+        of each line, and a list of lines for each output.
+        '''
+        if keys is None:
+            assignments = random_state.randint(0, count, len(lines))
+        else:
+            assignments = random_state.randint(0, count, keys.max() + 1)[keys]
+        tags, lengths = self.get_tag_columns(lines)
+        split = np.zeros((count, len(lines)))
+        split[assignments, np.arange(len(lines))] = tags
+        lines = np.array(lines, dtype=object)
+        return split, lengths, [lines[split[i] > 0] for i in range(count)]
+    
+    def get_split_stats(self, split, lengths, collapsed=None):
+        '''
+        Lines, tags, and total tag length for each output of a split.
+        Pass the tags of each output collapsed by key, if lines were, to 
+        count the lines written.
+        '''
+        if collapsed is None: collapsed = split
+        return np.c_[(collapsed > 0).sum(axis=1), split.sum(axis=1), 
+                     split.dot(lengths)]
+    
+    def get_tag_columns(self, lines):
+        '''
+        The tag count and tag length of each Homer tag line; lengths are 
+        zero if the lines have none.
+        '''
+        columns = [4, 5] if lines[0].count('\t') >= 5 else [4]
+        data = read_csv(StringIO(''.join(lines)), sep='\t', header=None,
+                        usecols=columns, dtype=np.float64)
+        tags = data[4].values
+        if 5 in data: lengths = data[5].values
+        else: lengths = np.zeros(len(tags))
+        return tags, lengths
+    
+    def split_tag_counts(self, lines, count, random_state):
+        '''
+        Split the tag count column of each Homer tag line across count
+        outputs, binomially, so that each tag is equally likely to land
+        in any output. Any fractional part of a tag count goes to a single
+        randomly chosen output.
+        
+        Returns the tag count of each line in each output, the tag 
+        length of each line, and a list of lines for each output.
+        '''
+        fields = [line.rstrip('\n').split('\t') for line in lines]
+        tags = np.array([float(f[4]) for f in fields])
+        lengths = np.array([float(f[5]) if len(f) > 5 else 0 
+                            for f in fields])
+        whole = np.floor(tags)
+        
+        remaining = whole.astype(np.int64)
+        split = np.zeros((count, len(lines)))
+        for i in range(count - 1):
+            split[i] = random_state.binomial(remaining, 1/(count - i))
+            remaining = remaining - split[i].astype(np.int64)
+        split[count - 1] = remaining
+        split[random_state.randint(0, count, len(lines)), 
+              np.arange(len(lines))] += tags - whole
+        
+        output_lines = []
+        for i in range(count):
+            output_lines.append(['\t'.join(f[:4] + [str(c)] + f[5:]) + '\n'
+                                    for f, c in zip(fields, split[i]) if c > 0])
+        return split, lengths, output_lines
+    
+    def read_tag_info(self, tag_dir):
+        '''
+        The genome named in a tag directory's tagInfo.txt, and its 
+        parameters that describe the library rather than the tag counts,
+        as key=value strings. Without a tagInfo.txt, there are none.
+        '''
+        genome, parameters = None, []
+        tag_info = os.path.join(tag_dir, 'tagInfo.txt')
+        if not os.path.exists(tag_info): return genome, parameters
+        with open(tag_info, 'r') as f:
+            for line in f:
+                field = line.rstrip('\r\n').split('\t')[0]
+                if '=' not in field: continue
+                key, value = field.split('=', 1)
+                if key == 'genome': genome = value
+                elif key not in self.tag_info_computed: 
+                    parameters.append(field)
+        return genome, parameters
+    
+    def write_tag_info(self, tag_dir, chrom_stats, genome=None, 
+                       parameters=()):
+        '''
+        Write a tagInfo.txt as makeTagDirectory does, from the unique 
+        positions, tags, and total tag length of each chromosome, followed
+        by the passed key=value parameters. The average tags per position 
+        and tag length are computed, and tags per bp, if the parameters 
+        include gsizeEstimate.
+        '''
+        positions = sum(s[0] for s in chrom_stats.values())
+        tags = sum(s[1] for s in chrom_stats.values())
+        length = sum(s[2] for s in chrom_stats.values())
+        parameters = list(parameters)
+        parameters.append('averageTagsPerPosition={:.3f}'.format(
+                                                tags/max(positions, 1)))
+        parameters.append('averageTagLength={:.3f}'.format(
+                                                length/max(tags, 1)))
+        for parameter in parameters:
+            key, value = parameter.split('=', 1)
+            if key == 'gsizeEstimate' and float(value) > 0:
+                parameters.append('tagsPerBP={:.6f}'.format(
+                                                tags/float(value)))
+                break
+        with open(os.path.join(tag_dir, 'tagInfo.txt'), 'w') as f:
+            f.write('name\tUnique Positions\tTotal Tags\n')
+            f.write('genome={}\t{}\t{:.1f}\n'.format(genome or 'unknown', 
+                                                     int(positions), tags))
+            for chrom, (chrom_positions, chrom_tags, _) in chrom_stats.items():
+                f.write('{}\t{}\t{:.1f}\n'.format(chrom, int(chrom_positions),
+                                                 chrom_tags))
+            for parameter in parameters: f.write(parameter + '\n')
+    
+    def validate_tag_directory(self, tag_dir):
+        '''
+        Have Homer re-make a tag directory in a scratch directory beside 
+        it, and check that it counts the same unique positions and tags 
+        as our tagInfo.txt. Make sure to use the /usr/bin/env clause to 
+        tell Python to look in the environment's path for Homer.
+        '''
+        homer_dir = tag_dir + '-homer-validation'
+        cmd = '/usr/bin/env makeTagDirectory {} -d {}'.format(homer_dir, 
+                                                               tag_dir)
+        profiling.check_call(cmd.split(), name='makeTagDirectory')
+        try:
+            counts = [self.read_tag_totals(d) for d in (tag_dir, homer_dir)]
+        finally:
+            shutil.rmtree(homer_dir, ignore_errors=True)
+        if abs(counts[0][0] - counts[1][0]) > 0 \
+                or abs(counts[0][1] - counts[1][1]) > .5:
+            raise Exception('Tag directory {} counts {} positions and {} '
+                            .format(tag_dir, *counts[0])
+                            + 'tags, but Homer counts {} and {}.'.format(
+                                                                *counts[1]))
+        print('Validated {} with Homer.'.format(tag_dir))
+        return tag_dir
+    
+    def read_tag_totals(self, tag_dir):
+        '''
+        Unique positions and total tags from the genome line of a tag 
+        directory's tagInfo.txt.
+        '''
+        with open(os.path.join(tag_dir, 'tagInfo.txt'), 'r') as f:
+            for line in f:
+                fields = line.rstrip('\r\n').split('\t')
+                if fields[0].startswith('genome='):
+                    return int(float(fields[1])), float(fields[2])
+        raise Exception('No totals in {}'.format(
+                                        os.path.join(tag_dir, 'tagInfo.txt')))
+    
                         
     ######################################################
     # Converting Homer Peaks to narrowPeak files
@@ -98,23 +535,59 @@ class IdrUtilities(object):
         '''
         Takes filename, returns dataframe of Homer peaks after stripping
         out comment lines at the top.
+        
+        The file is read once: comment lines are skipped up to the 
+        #PeakID header, and the rest is parsed from there. Columns we 
+        use get compact dtypes; p-values stay 64-bit, as they are often 
+        too small for 32-bit floats.
         '''
-        # Find header row
-        header_row = None
-        f = open(filename,'r')
-        for i,line in enumerate(f):
-            if line[:7] == '#PeakID': 
-                header_row = i
-                break
-        if header_row is None: 
-            raise Exception('There is no header in this Homer peak file!') 
-        data = read_csv(filename, sep='\t', header=i)
+        with open_file(filename, 'r') as f:
+            # Find header row
+            while True:
+                line = f.readline()
+                if not line:
+                    raise Exception('There is no header in this Homer peak file!')
+                if line[:7] == '#PeakID': break
+            header = line.rstrip('\r\n').split('\t')
+            data = read_csv(f, sep='\t', header=None, names=header,
+                            dtype=self.get_homer_dtypes(header))
         return data
+    
+    def get_homer_dtypes(self, columns):
+        '''
+        Dtypes for the Homer peak columns we know; others are inferred.
+        '''
+        dtypes = {}
+        for col in columns:
+            if col in self.chrom_columns: dtypes[col] = 'category'
+            elif col in self.start_columns + self.end_columns: 
+                dtypes[col] = np.int32
+            elif col in self.tag_count_columns: dtypes[col] = np.float32
+            elif col in self.p_value_columns: dtypes[col] = np.float64
+        return dtypes
+    
+    def convert_homer_peaks(self, peak_file, output_file, with_count=False):
+        '''
+        Read a Homer peak file and write it out as a narrowPeak file.
+        
+        Returns the output file, or, with_count, the output file and the
+        number of peaks written, so that they need not be counted again.
+        '''
+        with profiling.stage('homer2narrow ' + os.path.basename(peak_file)):
+            data = self.import_homer_peaks(peak_file)
+            self.homer_to_narrow_peaks(data, output_file)
+        if with_count: return output_file, len(data)
+        return output_file
         
-    def homer_to_narrow_peaks(self, data, output_file):
+    def homer_to_narrow_peaks(self, data, output_file=None):
         '''
         Given a Homer peak dataframe, extract necessary columns and convert
-        to a broadPeak file. From the IDR package description:
+        to a narrowPeak file, written as a columnar table if output_file
+        has the columnar extension. Without an output_file, nothing is 
+        written. Returns the narrowPeak dataframe, sorted, with the signal
+        and p-values a file would be read back with.
+        
+        From the IDR package description:
         
             NarrowPeak files are in BED6+4 format. It consists of 10 tab-delimited columns
     
@@ -133,28 +606,45 @@ class IdrUtilities(object):
 
         # We don't want to require p-value, as Homer doesn't always output it.
         # Prep it here if it exists, or substitute tag count.
+        # Keep it 64-bit: rounding to 32 bits would tie peaks that rank
+        # apart with --ranking_measure p-value.
         pval_col = self.get_first_column(data,
             self.p_value_columns, required=False)
         if pval_col is not None:
-            pvals = -np.log10(pval_col)
+            pvals = -np.log10(pval_col.values.astype(np.float64))
         else: 
-            pvals = pvals = [-1]*data.shape[0]
-            
+            pvals = np.full(data.shape[0], -1, dtype=np.float64)
+        signal = self.get_first_column(data, self.tag_count_columns).values
+        
+        # Constant columns are broadcast from scalars.
         columns = OrderedDict((
-            ('chrom', self.get_first_column(data, ['chr','chrom', 'chromosome'])),
-            ('chromStart', self.get_first_column(data, ['chromStart','start'])),
-            ('chromEnd', self.get_first_column(data, ['chromEnd','end'])),
-            ('name', self.get_first_column(data, ['#PeakID','PeakID','ID','name'])),
-            ('score', Series([0]*data.shape[0])), # Leave zero so that signalValue column is used
-            ('strand', self.get_first_column(data, ['strand'])),       
-            ('signalValue', self.get_first_column(data, self.tag_count_columns)),
+            ('chrom', self.get_first_column(data, self.chrom_columns).values),
+            ('chromStart', self.get_first_column(data, self.start_columns).values),
+            ('chromEnd', self.get_first_column(data, self.end_columns).values),
+            ('name', self.get_first_column(data, self.name_columns).values),
+            ('score', 0), # Leave zero so that signalValue column is used
+            ('strand', self.get_first_column(data, ['strand']).values),       
+            ('signalValue', signal),
             ('pValue', pvals), # P-value if it exists, or tag count
-            ('qValue', Series([-1]*data.shape[0])), # Leave -1 as no individual FDR is called for each peak
-            ('peak', Series([-1]*data.shape[0])), # Leave -1 as no point-source is called for each peak
+            ('qValue', -1), # Leave -1 as no individual FDR is called for each peak
+            ('peak', -1), # Leave -1 as no point-source is called for each peak
             ))
         df = DataFrame(columns)
-        df = df.sort(['signalValue', 'pValue'], ascending=False)
-        df.to_csv(output_file, sep='\t', header=False, index=False)
+        
+        # Sort by signalValue, then pValue, both descending.
+        order = np.lexsort((-pvals, -signal))
+        if output_file and not output_file.endswith(ColumnarTable.extension):
+            with open_file(output_file, 'w') as f:
+                df.iloc[order].to_csv(f, sep='\t', header=False, index=False)
+        
+        # Keep the signal text output would be read back as, rather
+        # than float32 values widened with their binary noise.
+        df['signalValue'] = df['signalValue'].values.astype(str)\
+                                .astype(np.float64)
+        df = df.iloc[order].reset_index(drop=True)
+        if output_file and output_file.endswith(ColumnarTable.extension):
+            ColumnarTable.write(df, output_file)
+        return df
         
     def get_first_column(self, data, names, required=True):
         '''
@@ -173,33 +663,103 @@ class IdrUtilities(object):
     ######################################################
     # Standardizing peak counts for narrowPeak files
     ######################################################
-    def standardize_peak_counts(self, peak_files, output_dir, max_count=None):
+    def standardize_peak_counts(self, peak_files, output_dir, max_count=None,
+                                counts=None, jobs=1):
         '''
         Make sure all passed narrowPeak files have the same number of rows.
         
         Assumes peak files are sorted in descending order!
+        
+        Pass counts, the number of rows in each file, if they are already
+        known; files whose count is None, or all files if counts is not
+        passed, are counted. Truncated files are written concurrently on 
+        up to jobs threads.
         '''
         # Find the peak file with the fewest rows
-        min_rows = None
-        for peak_file in peak_files:
-            count = subprocess.check_output('wc -l {}'.format(peak_file), shell=True)
-            count = int(count.split()[0])
-            if min_rows is None or count < min_rows:
-                min_rows = int(count)
+        if counts is None: counts = [None]*len(peak_files)
+        counts = [self.count_peaks(f) if count is None else count
+                  for f, count in zip(peak_files, counts)]
+        min_rows = min(counts) if counts else 0
         
         if max_count and min_rows > max_count: min_rows = max_count 
         
         # Truncate all to the min count
         output_files = []
         for peak_file in peak_files:
-            basename, ext = os.path.splitext(os.path.basename(peak_file))
+            basename, ext = split_name(
+                                    ColumnarTable.strip_extension(peak_file))
             output_file = os.path.join(output_dir, basename + '-truncated' + ext)
-            subprocess.check_call('head -n {} {} > {}'.format(
-                                        min_rows, peak_file, output_file), 
-                                  shell=True)
+            if ColumnarTable.is_columnar(peak_file):
+                output_file += ColumnarTable.extension
             output_files.append(output_file)
         
+        jobs = min(jobs or 1, len(peak_files))
+        if jobs > 1:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                list(executor.map(self.truncate_peak_file, peak_files,
+                                  output_files, [min_rows]*len(peak_files)))
+        else:
+            for peak_file, output_file in zip(peak_files, output_files):
+                self.truncate_peak_file(peak_file, output_file, min_rows)
+        
         return output_files
+    
+    def truncate_peak_file(self, peak_file, output_file, rows):
+        '''
+        Write the first rows of a narrowPeak file, text or columnar.
+        
+        Text is copied a buffer at a time up to the last newline needed,
+        rather than parsed.
+        '''
+        if ColumnarTable.is_columnar(peak_file):
+            # Columns are memory-mapped, so the slice reads only the 
+            # rows kept.
+            ColumnarTable.write(self.truncate_tables(
+                                    [ColumnarTable.read(peak_file)], rows)[0],
+                                output_file)
+            return output_file
+        
+        with open_file(peak_file, 'rb') as f,\
+                open_file(output_file, 'wb') as out:
+            remaining = rows
+            while remaining > 0:
+                chunk = f.read(self.read_chunk_size)
+                if not chunk: break
+                lines = chunk.count(b'\n')
+                if lines >= remaining:
+                    end = -1
+                    for _ in range(remaining): end = chunk.index(b'\n', end + 1)
+                    chunk = chunk[:end + 1]
+                    lines = remaining
+                out.write(chunk)
+                remaining -= lines
+        return output_file
+    
+    def truncate_tables(self, tables, rows=None):
+        '''
+        Truncate sorted in-memory peak tables to the same number of rows,
+        the fewest of any table or rows if less. Rows are sliced, not 
+        copied.
+        '''
+        min_rows = min([len(table) for table in tables] 
+                       + ([rows] if rows is not None else []))
+        return [table.iloc[:min_rows] for table in tables]
+    
+    def count_peaks(self, peak_file):
+        '''
+        Number of peaks in a narrowPeak file, text or columnar.
+        
+        Text files are counted by scanning for newlines a buffer at a 
+        time; a last line without a newline still counts.
+        '''
+        if ColumnarTable.is_columnar(peak_file):
+            return ColumnarTable.count_rows(peak_file)
+        count, last = 0, b'\n'
+        with open_file(peak_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.read_chunk_size), b''):
+                count += chunk.count(b'\n')
+                last = chunk[-1:]
+        return count + (last != b'\n')
 
 
     ######################################################
@@ -251,13 +811,18 @@ class IdrUtilities(object):
         
         Meanwhile, compare counts across all the files. If any are
         substantially different (>2-fold), issue a warning.
+        
+        Counts come from each file's IdrIndex, built if needed.
+        '''
+        return self.get_max_count([int(IdrIndex.load(filename)
+                                                .count(threshold))
+                                   for filename in idr_files])
+    
+    def get_max_count(self, counts):
+        '''
+        The greatest of the counts of peaks within the threshold for 
+        each comparison, warning if they differ by more than 2-fold.
         '''
-        counts = []
-        for filename in idr_files:
-            data = read_csv(filename, sep=" ", header=0)
-            within_thresh = len(data[data['IDR'] <= threshold])
-            counts.append(within_thresh)
-            
         if min(counts)*2 < max(counts):
             print('!! Warning: There is a large discrepancy between the number'
                   + ' of peaks within the threshold for each pair of compared'
@@ -266,37 +831,201 @@ class IdrUtilities(object):
             
         return max(counts)
     
+    def check_pooled_count(self, keep_count, pooled_count):
+        '''
+        Pooled count should be within 2-fold of keep_count.
+        '''
+        if abs(math.log(keep_count/pooled_count, 2)) > 1:
+            print('!! Warning: The number of peaks within the replicate '
+                  + 'threshold is not within two-fold of the number of '
+                  + 'peaks within the pooled threshold. This could indicate '
+                  + 'inconsistencies in the datasets.\n'
+                  + 'Replicate count: {}, Pooled count: {}'.format(keep_count, 
+                                                                   pooled_count))
+    
     def slice_peaks(self, peak_file, number_of_peaks, 
-                    ranking_measure, output_dir):
+                    ranking_measure, output_dir, idr_files=None):
         '''
         Given a Homer tag file, import the file and output just the 
-        specified number of peaks.
-        '''
-        data = self.import_homer_peaks(peak_file)
+        specified number of peaks, in rank order.
         
-        sort_col = None
-        if ranking_measure == 'p-value':
-            ascending = True
-            for col_name in self.p_value_columns: 
-                if col_name in data.columns:
-                    sort_col = col_name
-                    break
-        else:
-            ascending = False
-            for col_name in self.tag_count_columns: 
-                if col_name in data.columns:
-                    sort_col = col_name
-                    break
+        Only the ranking column is parsed; the top peaks are selected
+        without sorting the whole file, ties keeping file order, and
+        their lines are written out as they were read.
+        
+        If the IDR files the number of peaks was chosen from are passed,
+        a second copy of the top set is written alongside, suffixed with
+        -top-set-idr, with each peak's rank and the lowest IDR threshold
+        at which a comparison keeps that many peaks.
+        '''
+        header, lines = self.read_homer_lines(peak_file)
+        sort_col = self.get_sort_column(header, ranking_measure)
         if not sort_col:
             raise Exception('Could not find column to sort final peaks by!')
-            
-        data = data.sort([sort_col], ascending=ascending)
-        data = data[:number_of_peaks]
+        
+        values = read_csv(BytesIO(b'\n'.join(lines)), sep='\t', header=None,
+                          usecols=[header.index(sort_col)],
+                          dtype=np.float64).iloc[:, 0].values
+        if ranking_measure != 'p-value': values = -values
+        top = self.get_top_indices(values, number_of_peaks)
+        
+        rank_idr = None
+        if idr_files:
+            rank_idr = self.get_rank_idr([IdrIndex.load(idr_file).idr
+                                          for idr_file in idr_files],
+                                         len(top))
         
         # Output to file
         # Use the \r line ending because that is what Homer expects.
-        basename, ext = os.path.splitext(os.path.basename(peak_file))
+        basename, ext = split_name(peak_file)
         output_file = os.path.join(output_dir, basename + '-top-set' + ext)
-        data.to_csv(output_file, sep='\t', header=True, index=False, 
-                    line_terminator='\r\n')
-        return output_file
\ No newline at end of file
+        idr_file = os.path.join(output_dir, basename + '-top-set-idr' + ext)
+        with open_file(output_file, 'wb') as f,\
+                open_file(idr_file if idr_files else os.devnull, 'wb') as f_idr:
+            f.write('\t'.join(header).encode() + b'\r\n')
+            f_idr.write('\t'.join(header + ['Rank', 'IDR']).encode() 
+                        + b'\r\n')
+            for start in range(0, len(top), self.write_chunk_size):
+                chunk = top[start:start + self.write_chunk_size]
+                f.write(b''.join(lines[i] + b'\r\n' for i in chunk))
+                if rank_idr is None: continue
+                f_idr.write(b''.join(
+                        lines[i] + '\t{}\t{:.6g}\r\n'.format(
+                                    start + r + 1, rank_idr[start + r]).encode()
+                        for r, i in enumerate(chunk)))
+        if idr_files: print('IDR-annotated peaks output to ' + idr_file)
+        return output_file
+    
+    def slice_peak_table(self, data, number_of_peaks, ranking_measure,
+                         idrs=None):
+        '''
+        As slice_peaks, for a Homer peak dataframe: the top 
+        number_of_peaks rows, in rank order. If the sorted IDR values of 
+        the comparisons the number was chosen from are passed as idrs, 
+        each peak's Rank and IDR are added as columns.
+        '''
+        sort_col = self.get_sort_column(data.columns, ranking_measure)
+        if not sort_col:
+            raise Exception('Could not find column to sort final peaks by!')
+        values = data[sort_col].values.astype(np.float64)
+        if ranking_measure != 'p-value': values = -values
+        top = data.iloc[self.get_top_indices(values, number_of_peaks)]
+        top = top.reset_index(drop=True)
+        if idrs:
+            top['Rank'] = np.arange(1, len(top) + 1)
+            top['IDR'] = self.get_rank_idr(idrs, len(top))
+        return top
+    
+    def get_rank_idr(self, idrs, count):
+        '''
+        The IDR threshold for each rank up to count, given the sorted IDR
+        values of each comparison.
+        
+        The r-th lowest IDR in a comparison is the threshold at which
+        it keeps r peaks; the number of peaks kept is the greatest 
+        count across comparisons, so take the least such threshold.
+        '''
+        rank_idr = np.full(count, np.nan)
+        for idr in idrs:
+            available = min(len(idr), count)
+            rank_idr[:available] = np.fmin(rank_idr[:available],
+                                           idr[:available])
+        return rank_idr
+    
+    def read_homer_lines(self, filename):
+        '''
+        Returns the header columns of a Homer peak file, and its peak
+        lines as bytes, without line endings.
+        '''
+        with open_file(filename, 'rb') as f:
+            while True:
+                line = f.readline()
+                if not line:
+                    raise Exception('There is no header in this Homer peak file!')
+                if line[:7] == b'#PeakID': break
+            header = line.decode().rstrip('\r\n').split('\t')
+            lines = [l.rstrip(b'\r') for l in f.read().split(b'\n') 
+                     if l.strip()]
+        return header, lines
+    
+    def get_sort_column(self, columns, ranking_measure):
+        '''
+        The column to rank Homer peaks by: the first p-value column we
+        know, or the first tag count column.
+        '''
+        if ranking_measure == 'p-value': candidates = self.p_value_columns
+        else: candidates = self.tag_count_columns
+        for col_name in candidates:
+            if col_name in columns: return col_name
+        return None
+    
+    def get_top_indices(self, values, count):
+        '''
+        Indices of the count lowest values, in ascending order, with ties
+        in their original order and NaNs last; equivalent to a stable
+        sort, but selects the top count with a partition first.
+        '''
+        values = np.where(np.isnan(values), np.inf, values)
+        count = min(max(count, 0), len(values))
+        if count == 0: return np.empty(0, dtype=np.intp)
+        if count < len(values):
+            kth = np.partition(values, count - 1)[count - 1]
+            below = np.flatnonzero(values < kth)
+            tied = np.flatnonzero(values == kth)[:count - len(below)]
+            selected = np.sort(np.r_[below, tied])
+        else:
+            selected = np.arange(len(values))
+        return selected[np.argsort(values[selected], kind='mergesort')]
+    
+    ######################################################
+    # Converting IDR output to narrowPeak files
+    ######################################################
+    def convert_overlapped_peaks(self, idr_file, output_file):
+        '''
+        Equivalent to idrOverlap2npk.sh: write the peaks of an
+        -overlapped-peaks file, text or columnar, as narrowPeak lines,
+        in order of IDR. Each line has the chromosome of the first 
+        replicate; the smallest start and largest stop of the pair; the
+        rank by IDR as the name; the signal of the first replicate as 
+        the score; no strand; the signal of the second replicate as the
+        signalValue; and -log10 of the local IDR and of the IDR as the 
+        pValue and qValue.
+        
+        The table is read in one pass and sorted in memory. Peaks with
+        equal IDR keep their order in the file, where sort(1) fell back
+        to comparing whole lines.
+        '''
+        columns = ['chr1', 'start1', 'stop1', 'sig.value1', 
+                   'start2', 'stop2', 'sig.value2', 'idr.local', 'IDR']
+        with profiling.stage('overlap2narrow ' + os.path.basename(idr_file)):
+            if ColumnarTable.is_columnar(idr_file):
+                data = ColumnarTable.read(idr_file, columns=columns)
+                # Signals as R writes them, as the script copies them.
+                for col in ('sig.value1', 'sig.value2'):
+                    data[col] = ['{:.15g}'.format(v) for v in data[col].values]
+            else:
+                with open_file(idr_file, 'r') as f:
+                    data = read_csv(f, sep=' ', header=0, usecols=columns,
+                                    dtype={'chr1': str, 'sig.value1': str, 
+                                           'sig.value2': str})
+            
+            order = np.argsort(data['IDR'].values, kind='mergesort')
+            with np.errstate(divide='ignore'):
+                p_values = -np.log10(data['idr.local'].values[order])
+                q_values = -np.log10(data['IDR'].values[order])
+            df = DataFrame(OrderedDict((
+                ('chrom', np.asarray(data['chr1'])[order]),
+                ('chromStart', np.minimum(data['start1'].values, 
+                                          data['start2'].values)[order]),
+                ('chromEnd', np.maximum(data['stop1'].values, 
+                                        data['stop2'].values)[order]),
+                ('name', np.arange(1, len(order) + 1)),
+                ('score', np.asarray(data['sig.value1'])[order]),
+                ('strand', '.'),
+                ('signalValue', np.asarray(data['sig.value2'])[order]),
+                ('pValue', p_values),
+                ('qValue', q_values))))
+            with open_file(output_file, 'w') as f:
+                df.to_csv(f, sep='\t', header=False, index=False,
+                          float_format='%.6f')
+        return output_file
@@ -0,0 +1,33 @@
+'''
+Shared fixtures: a small synthetic experiment, and its peaks converted
+and truncated as the idr command does. Nothing here needs R or Homer.
+'''
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from idr.simulate import SyntheticData
+from idr.utils import IdrUtilities
+
+@pytest.fixture(scope='session')
+def experiment(tmp_path_factory):
+    '''
+    Peak files and tag directories for two replicates, and pooled peaks.
+    '''
+    output_dir = tmp_path_factory.mktemp('experiment')
+    return SyntheticData(seed=0).write_experiment(str(output_dir), 3000, 20000)
+
+@pytest.fixture(scope='session')
+def narrowpeaks(experiment, tmp_path_factory):
+    '''
+    The replicate peaks as truncated narrowPeak files.
+    '''
+    output_dir = str(tmp_path_factory.mktemp('narrowpeaks'))
+    idrutils = IdrUtilities()
+    converted = [idrutils.convert_homer_peaks(peak_file, os.path.join(
+                                    output_dir, 'Rep{}.narrowPeak'.format(i + 1)))
+                 for i, peak_file in enumerate(experiment['peak_files'])]
+    return idrutils.standardize_peak_counts(converted, output_dir)
@@ -0,0 +1,20 @@
+'''
+IdrAnalysis against the files of the idr command's slice step.
+'''
+from pandas.io.parsers import read_csv
+
+from idr.analysis import IdrAnalysis
+
+def test_analysis_returns_top_set(experiment, tmp_path, capsys):
+    result = IdrAnalysis(output_dir=str(tmp_path), seed=0).run(
+                    experiment['peak_files'], 
+                    pooled_peaks=experiment['pooled_peaks'])
+    assert result['number_of_peaks'] == len(result['peaks']) \
+            == result['counts']['replicates'] > 0
+    assert list(result['peaks']['Rank']) \
+            == list(range(1, result['number_of_peaks'] + 1))
+    assert (result['peaks']['IDR'] <= result['threshold']).all()
+    written = read_csv(result['output_file'], sep='\t')
+    assert len(written) == result['number_of_peaks']
+    # Counts are left to the caller to report.
+    assert 'peaks selected' not in capsys.readouterr().out
@@ -0,0 +1,31 @@
+'''
+The batch command: experiments that fail, even before starting, do not
+stop the others.
+'''
+from pandas.io.parsers import read_csv
+import pytest
+
+from idr.run_idr import IdrArgumentParser
+
+def test_batch_runs_experiments_past_a_missing_file(experiment, tmp_path):
+    manifest = str(tmp_path/'manifest.tsv')
+    with open(manifest, 'w') as f:
+        f.write('name\toutput_dir\tpeak_files\n')
+        f.write('A\t{}\t{}\n'.format(tmp_path/'A', 
+                                      ','.join(experiment['peak_files'])))
+        f.write('B\t{}\t{},{}\n'.format(tmp_path/'B', 
+                        experiment['peak_files'][0], tmp_path/'missing.txt'))
+    parser = IdrArgumentParser()
+    options = parser.parse_args(['batch', manifest, '--no-cache', 
+                                 '--engine', 'numpy', '-o', str(tmp_path)])
+    with pytest.raises(Exception, match='1 of 2 experiments failed'):
+        parser.batch(options)
+    
+    summary = read_csv(str(tmp_path/'idr-batch-summary.txt'), sep='\t',
+                       index_col='experiment', keep_default_na=False)
+    assert summary.loc['A', 'status'] == 'complete'
+    assert float(summary.loc['A', 'threshold']) > 0
+    assert (tmp_path/'A'/'replicate_comparisons').exists()
+    assert summary.loc['B', 'status'] == 'failed'
+    assert summary.loc['B', 'failed_stage'] == 'setup'
+    assert 'missing.txt' in summary.loc['B', 'error']
@@ -0,0 +1,79 @@
+'''
+The columnar table format, compressed files, and the sorted IDR index.
+'''
+import gzip
+import os
+
+import numpy as np
+from pandas import DataFrame
+import pytest
+
+from idr.columnar import ColumnarTable
+from idr.compression import is_compressed, open_file, split_name
+from idr.idr_index import IdrIndex, sweep
+
+def get_table(n=1000):
+    random_state = np.random.RandomState(0)
+    return DataFrame({'chrom': random_state.choice(['chr1', 'chr2', 'chrX'], n),
+                      'start': np.arange(n, dtype=np.int64)*100,
+                      'sig.value': random_state.exponential(size=n),
+                      'IDR': np.sort(random_state.random_sample(n))})
+
+def test_columnar_round_trip(tmp_path):
+    data = get_table()
+    filename = str(tmp_path/'table.cols')
+    ColumnarTable.write(data, filename, kind='overlapped-peaks')
+    assert ColumnarTable.is_columnar(filename)
+    assert not ColumnarTable.is_columnar(__file__)
+    assert ColumnarTable.count_rows(filename) == len(data)
+
+    read = ColumnarTable.read(filename)
+    assert list(read.columns) == list(data.columns)
+    assert list(read['chrom']) == list(data['chrom'])
+    for col in ('start', 'sig.value', 'IDR'):
+        assert np.array_equal(read[col].values, data[col].values)
+    assert list(ColumnarTable.read(filename, columns=['IDR']).columns) \
+            == ['IDR']
+
+@pytest.mark.parametrize('extension', ('.gz', '.bgz'))
+def test_compressed_round_trip(tmp_path, extension):
+    filename = str(tmp_path/('lines.txt' + extension))
+    lines = ['line {}\n'.format(i) for i in range(100000)]
+    with open_file(filename, 'w') as f: f.writelines(lines)
+    with open_file(filename, 'a') as f: f.write('appended\n')
+    assert is_compressed(filename)
+    # Readable as standard gzip, and by our reader
+    with gzip.open(filename, 'rt') as f:
+        assert f.readlines() == lines + ['appended\n']
+    with open_file(filename, 'r') as f:
+        assert f.readlines() == lines + ['appended\n']
+
+def test_split_name():
+    assert split_name('/a/peaks.narrowPeak.gz') == ('peaks', '.narrowPeak.gz')
+    assert split_name('peaks.txt') == ('peaks', '.txt')
+
+@pytest.mark.parametrize('kind', ('text', 'gz', 'columnar'))
+def test_idr_index(tmp_path, kind):
+    data = get_table()
+    data['IDR'] = np.random.RandomState(1).random_sample(len(data))
+    idr_file = str(tmp_path/'x-overlapped-peaks.txt')
+    if kind == 'columnar':
+        idr_file = str(tmp_path/'x-overlapped-peaks.cols')
+        ColumnarTable.write(data, idr_file, kind='overlapped-peaks')
+    else:
+        if kind == 'gz': idr_file += '.gz'
+        with open_file(idr_file, 'w') as f:
+            data.to_csv(f, sep=' ', index=False, float_format='%.15g')
+
+    index = IdrIndex.load(idr_file)
+    assert os.path.exists(IdrIndex.get_index_file(idr_file))
+    assert len(index) == len(data)
+    thresholds = [0.01, 0.05, 0.5]
+    expected = [int((data['IDR'] <= t).sum()) for t in thresholds]
+    assert index.count(thresholds).tolist() == expected
+    assert sweep([idr_file], thresholds)[idr_file].tolist() == expected
+
+    # A stale index is rebuilt.
+    old = os.path.getmtime(idr_file) - 10
+    os.utime(IdrIndex.get_index_file(idr_file), (old, old))
+    assert IdrIndex.load(idr_file).count(thresholds).tolist() == expected
@@ -0,0 +1,97 @@
+'''
+Running comparisons with IdrCaller: on a shared pool, from the cache, and
+stopping them on failure.
+'''
+import os
+import subprocess
+
+from idr.cache import ResultCache
+from idr.idr_caller import IdrCaller
+from idr.plotting import IdrPlotter
+from idr.run_idr import IdrArgumentParser
+
+def test_shared_executor_runs_single_pairs(narrowpeaks, tmp_path):
+    idrcaller = IdrCaller(engine='numpy', jobs=2)
+    pairs = idrcaller.get_replicate_pairs(narrowpeaks, str(tmp_path))
+    assert len(pairs) == 1
+    idrcaller.start_executor()
+    try:
+        prefixes = idrcaller.run_pairs(pairs)
+    finally:
+        idrcaller.shutdown()
+    # Run on the pool, so logged rather than printed
+    assert os.path.getsize(prefixes[0] + '.log') > 0
+    assert os.path.exists(idrcaller.get_overlapped_peaks_file(prefixes[0]))
+
+def read_npeaks(output_prefix):
+    with open(output_prefix + '-npeaks-aboveIDR.txt', 'r') as f:
+        return [line.split() for line in f]
+
+def test_cached_comparisons_name_their_own_files(narrowpeaks, tmp_path, 
+                                                 capsys):
+    cache = ResultCache(str(tmp_path/'cache'))
+    output_prefixes = []
+    for name in ('first', 'second'):
+        output_dir = tmp_path/name
+        output_dir.mkdir()
+        # The same contents, under other names
+        files = []
+        for i, narrowpeak in enumerate(narrowpeaks):
+            files.append(str(output_dir/'Rep{}.narrowPeak'.format(i + 1)))
+            with open(narrowpeak) as f, open(files[-1], 'w') as out:
+                out.write(f.read())
+        output_prefix = str(output_dir/'Rep1-Rep2')
+        IdrCaller(engine='numpy', cache=cache).run_batch_analysis(
+                                        files[0], files[1], output_prefix)
+        assert [line[:2] for line in read_npeaks(output_prefix)] \
+                == [files]*25
+        output_prefixes.append(output_prefix)
+    # The second was restored, with the same counts.
+    assert 'Reusing cached comparison for ' + output_prefixes[1] \
+            in capsys.readouterr().out
+    assert [line[2:] for line in read_npeaks(output_prefixes[0])] \
+            == [line[2:] for line in read_npeaks(output_prefixes[1])]
+
+class FakeWorker(object):
+    def __init__(self): self.killed = False
+    def kill(self): self.killed = True
+
+def test_terminate_running_stops_only_the_failed_pairs(tmp_path):
+    idrcaller = IdrCaller(engine='r', r_workers=2)
+    prefixes = [str(tmp_path/'a'), str(tmp_path/'b')]
+    processes = [subprocess.Popen(['sleep', '30']) for _ in prefixes]
+    pool = idrcaller.get_r_pool()
+    workers = [FakeWorker() for _ in prefixes]
+    try:
+        for prefix, process, worker in zip(prefixes, processes, workers):
+            idrcaller._processes[prefix] = process
+            pool._running[worker] = prefix + '.log'
+        idrcaller.terminate_running(prefixes[:1])
+        assert processes[0].wait(10) is not None
+        assert processes[1].poll() is None
+        assert [w.killed for w in workers] == [True, False]
+        # The shared pool stays open for other comparisons.
+        assert idrcaller.get_r_pool() is pool and not pool._closed
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
+
+def test_groups_without_pairs_are_not_plotted(tmp_path, capsys):
+    assert not IdrPlotter.has_summaries([])
+    idrcaller = IdrCaller(engine='numpy')
+    assert idrcaller.get_pseudorep_pairs([], str(tmp_path)) == []
+    assert idrcaller.plot_comparisons([], str(tmp_path), 'Empty') is None
+    assert 'no comparisons' in capsys.readouterr().out
+    assert os.listdir(str(tmp_path)) == []
+
+def test_idr_without_pseudoreps(experiment, tmp_path):
+    parser = IdrArgumentParser()
+    options = parser.sanitize_inputs(parser.parse_args(
+                    ['idr', '--no-cache', '--engine', 'numpy', 
+                     '-p'] + experiment['peak_files'] + 
+                    ['-o', str(tmp_path)]))
+    parser.idr(options)
+    # Only the replicates have pairs to plot.
+    assert os.listdir(str(tmp_path/'plots')) \
+            == ['Replicate_comparison-plot.pdf']
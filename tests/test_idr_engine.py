@@ -0,0 +1,128 @@
+'''
+The numpy engine: the correspondence profile against comp.uri computed
+point by point, the smoothing spline, the EM fit on data simulated from
+the model, and each variant of the engine against the plain one.
+'''
+import os
+
+import numpy as np
+import pytest
+
+from idr.benchmark import Benchmark
+from idr.idr_caller import IdrCaller
+from idr.idr_engine import IdrEngine
+from idr.idr_index import IdrIndex
+from idr.simulate import SyntheticData
+
+def get_uri(x_1, x_2, tt):
+    '''
+    get.uri.2d and comp.uri: for each t, the share of peaks in the top t
+    of x_1 whose x_2 is at least its 1 - t quantile.
+    '''
+    n = len(x_1)
+    x_2_ordered = x_2[np.lexsort((-x_2, -x_1))]
+    return np.array([np.sum(x_2_ordered[:int(np.ceil(n*t))]
+                            >= np.percentile(x_2_ordered, 100*(1 - t)))/n
+                     for t in tt])
+
+@pytest.mark.parametrize('uri_points', (100, 1000))
+def test_compute_uri_matches_comp_uri(uri_points):
+    random_state = np.random.RandomState(0)
+    x_1 = random_state.exponential(size=2000)
+    x_2 = x_1 + random_state.exponential(size=2000)
+    # Ties, and peaks missing from one replicate
+    x_1[::7] = np.round(x_1[::7])
+    x_2[::11] = 0
+    engine = IdrEngine(uri_points=uri_points)
+    uri = engine.compute_uri(x_1, x_2, tt=engine.uri_grid)
+    assert np.allclose(uri['uri'], get_uri(x_1, x_2, engine.uri_grid))
+
+def test_smoothing_spline_keeps_lines():
+    x = np.linspace(0.01, 1, 60)
+    fitted, derivative = IdrEngine().fit_smoothing_spline(x, 3*x + 1)
+    assert np.allclose(fitted, 3*x + 1)
+    assert np.allclose(derivative, 3)
+
+def test_smoothing_spline_smooths_to_df():
+    x = np.linspace(0, 1, 40)
+    y = np.sin(6*x) + np.random.RandomState(0).normal(0, .1, 40)
+    fitted, _ = IdrEngine().fit_smoothing_spline(x, y, df=6.4)
+    # Smoother than the data, and closer to the curve it was drawn from
+    assert np.abs(np.diff(fitted, 2)).sum() < np.abs(np.diff(y, 2)).sum()
+    assert np.abs(fitted - np.sin(6*x)).mean() \
+            < np.abs(y - np.sin(6*x)).mean()
+
+@pytest.fixture(scope='module')
+def mixture():
+    x, y, label = SyntheticData(seed=0).simulate_copula_mixture(20000,
+                                        **SyntheticData.mixture)
+    return np.exp(x), np.exp(y), label
+
+@pytest.mark.parametrize('acceleration', IdrEngine.em_accelerations)
+def test_em_recovers_mixture(mixture, acceleration):
+    sig_1, sig_2, label = mixture
+    fit = IdrEngine(seed=0).fit_em(sig_1, sig_2, acceleration=acceleration)
+    # Histogram marginals bias estimates at this size slightly upward.
+    assert fit['para']['p'] == pytest.approx(0.6, abs=0.05)
+    assert fit['para']['rho1'] == pytest.approx(0.8, abs=0.05)
+    # Reproducible peaks are mostly the ones called reproducible.
+    assert np.mean((fit['e_z'] > .5) == (label == 1)) > 0.9
+    # Histogram marginals are not exact maximizers, so the log likelihood
+    # can fall, but only by a hair.
+    assert np.all(np.diff(fit['loglik_trace']) > -1e-2)
+    assert fit['loglik'] > fit['loglik_trace'][0]
+
+def test_em_acceleration_and_warm_start_agree(mixture):
+    sig_1, sig_2, _ = mixture
+    plain = IdrEngine(seed=0).fit_em(sig_1, sig_2)
+    squarem = IdrEngine(seed=0).fit_em(sig_1, sig_2, acceleration='squarem')
+    warm = IdrEngine(seed=0).fit_em(sig_1, sig_2, init=plain)
+    for fit in (squarem, warm):
+        for name in ('p', 'rho1'):
+            assert fit['para'][name] == pytest.approx(plain['para'][name],
+                                                      abs=0.01)
+    assert len(warm['loglik_trace']) < len(plain['loglik_trace'])
+
+@pytest.fixture(scope='module')
+def comparisons(narrowpeaks, tmp_path_factory):
+    '''
+    Overlapped peaks from each variant of the engine in the benchmark,
+    with the plain engine first.
+    '''
+    output_dir = str(tmp_path_factory.mktemp('comparisons'))
+    idr_files = {}
+    for name, options in Benchmark.engines.items():
+        if options['engine'] != 'numpy': continue
+        idrcaller = IdrCaller(**options)
+        output_prefix = os.path.join(output_dir, name)
+        idrcaller.run_batch_analysis(narrowpeaks[0], narrowpeaks[1],
+                                     output_prefix)
+        idr_files[name] = idrcaller.get_overlapped_peaks_file(output_prefix)
+    idrcaller = IdrCaller(engine='numpy', compress=True)
+    idrcaller.run_batch_analysis(narrowpeaks[0], narrowpeaks[1],
+                                 os.path.join(output_dir, 'numpy-compressed'))
+    idr_files['numpy-compressed'] = idrcaller.get_overlapped_peaks_file(
+                            os.path.join(output_dir, 'numpy-compressed'))
+    return idr_files
+
+@pytest.mark.parametrize('name', ('numpy-squarem', 'numpy-columnar',
+                                  'numpy-compressed'))
+def test_engine_variants_match_plain_engine(comparisons, name):
+    check = Benchmark('.').compare_idr(comparisons['numpy'],
+                                       comparisons[name])
+    assert check['matched_peaks'] == check['reference_peaks'] > 0
+    assert check['passed'], check
+
+def test_idr_values_and_counts(comparisons, narrowpeaks):
+    index = IdrIndex.load(comparisons['numpy'])
+    # IDR values are cumulative means of local IDR, so they lie in [0, 1],
+    # and most of the simulated reproducible peaks pass 0.05.
+    assert 0 <= index.idr.min() and index.idr.max() <= 1
+    assert index.count(0.05) > 0.3*len(index)
+
+    output_prefix = comparisons['numpy'][:-len('-overlapped-peaks.txt')]
+    with open(output_prefix + '-npeaks-aboveIDR.txt', 'r') as f:
+        lines = [line.split() for line in f]
+    assert [line[:2] for line in lines] == [narrowpeaks]*25
+    assert [int(line[3]) for line in lines] \
+            == index.count(IdrEngine.idr_cutoffs).tolist()
@@ -0,0 +1,81 @@
+'''
+PeakOverlapper against a brute-force search over every pair of peaks.
+'''
+import numpy as np
+import pytest
+
+from idr.overlap import PeakOverlapper
+
+def get_regions(start_1, stop_1, start_2, stop_2):
+    '''
+    Sets of peaks, rep 1 numbered first, connected by overlaps between the
+    replicates, found by comparing every pair.
+    '''
+    n_1 = len(start_1)
+    parent = list(range(n_1 + len(start_2)))
+    def find(i):
+        while parent[i] != i: i = parent[i]
+        return i
+    for i in range(n_1):
+        for j in range(len(start_2)):
+            if start_1[i] <= stop_2[j] and start_2[j] <= stop_1[i]:
+                parent[find(i)] = find(n_1 + j)
+    regions = {}
+    for i in range(len(parent)): regions.setdefault(find(i), set()).add(i)
+    return set(frozenset(r) for r in regions.values())
+
+def get_random_peaks(random_state, n, span=5000, max_width=200):
+    starts = np.sort(random_state.randint(0, span, n))
+    return starts, starts + random_state.randint(0, max_width, n)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_find_overlap_matches_brute_force(seed):
+    random_state = np.random.RandomState(seed)
+    start_1, stop_1 = get_random_peaks(random_state, 60)
+    start_2, stop_2 = get_random_peaks(random_state, 80)
+    labels, n_regions = PeakOverlapper().find_overlap(start_1, stop_1,
+                                                      start_2, stop_2)
+    found = {}
+    for i, label in enumerate(labels): found.setdefault(label, set()).add(i)
+    assert n_regions == len(found)
+    assert set(frozenset(r) for r in found.values()) \
+            == get_regions(start_1, stop_1, start_2, stop_2)
+
+    # Regions are numbered in order of their first start.
+    starts = np.concatenate((start_1, start_2))
+    firsts = [min(starts[list(found[label])]) for label in range(n_regions)]
+    assert firsts == sorted(firsts)
+
+def get_peaks(chroms, starts, stops, values):
+    return {'chrom': np.array(chroms, dtype=object),
+            'start': np.array(starts), 'stop': np.array(stops),
+            'start_ori': np.array(starts), 'stop_ori': np.array(stops),
+            'sig_value': np.array(values, dtype=float),
+            'signal_value': np.array(values, dtype=float),
+            'p_value': np.zeros(len(starts)), 'q_value': np.zeros(len(starts))}
+
+@pytest.mark.parametrize('merge,expected', (('mean', 3), ('best', 4)))
+def test_pair_peaks_merges_and_imputes(merge, expected):
+    # Two rep 1 peaks overlap one rep 2 peak; one peak of each replicate
+    # overlaps nothing; the same coordinates on chr2 do not overlap chr1.
+    rep_1 = get_peaks(['chr1', 'chr1', 'chr1', 'chr2'], [100, 150, 1000, 100],
+                      [160, 300, 1100, 160], [2, 4, 5, 6])
+    rep_2 = get_peaks(['chr1', 'chr1'], [140, 5000], [200, 5100], [7, 8])
+    merge_1, merge_2 = PeakOverlapper(merge=merge).pair_peaks(rep_1, rep_2)
+
+    assert list(merge_1['chrom']) == ['chr1', 'chr1', 'chr1', 'chr2']
+    # Starts are shifted by chromosome; start_ori keeps the original.
+    assert list(merge_1['start_ori']) == [100, 1000, 5000, 100]
+    assert list(merge_1['sig_value']) == [expected, 5, 0, 6]
+    assert list(merge_2['sig_value']) == [7, 0, 8, 0]
+    assert list(merge_1['id']) == list(merge_2['id']) == [1, 2, 3, 4]
+    # Imputed peaks take the location of the other replicate's.
+    assert merge_2['start_ori'][1] == 1000 and merge_2['stop_ori'][3] == 160
+
+def test_pair_peaks_filters_by_overlap_ratio():
+    rep_1 = get_peaks(['chr1', 'chr1'], [0, 1000], [100, 1100], [1, 2])
+    rep_2 = get_peaks(['chr1', 'chr1'], [90, 1010], [190, 1110], [3, 4])
+    merge_1, merge_2 = PeakOverlapper(overlap_ratio=0.5).pair_peaks(rep_1,
+                                                                    rep_2)
+    assert list(merge_1['start_ori']) == [1000]
+    assert merge_1['frag_ratio'][0] == pytest.approx(0.9)
@@ -0,0 +1,166 @@
+'''
+Splitting tag directories into pseudoreps, and converting, counting, and
+truncating peak files.
+'''
+from collections import Counter
+import os
+
+import numpy as np
+from pandas import DataFrame
+from pandas.io.parsers import read_csv
+import pytest
+
+from idr.columnar import ColumnarTable
+from idr.compression import open_file
+from idr.utils import IdrUtilities
+
+def read_tags(tag_dir):
+    '''
+    Tags at each (chromosome, position, strand) of a tag directory, and
+    the number of lines each key is on.
+    '''
+    tags, lines = Counter(), Counter()
+    for f in IdrUtilities().get_tag_files(tag_dir):
+        with open_file(os.path.join(tag_dir, f), 'r') as tag_file:
+            for line in tag_file:
+                fields = line.rstrip('\n').split('\t')
+                key = tuple(fields[1:4])
+                tags[key] += float(fields[4])
+                lines[key] += 1
+    return tags, lines
+
+def add_counters(counters):
+    total = Counter()
+    for counter in counters: total.update(counter)
+    return total
+
+@pytest.mark.parametrize('split_tag_counts', (False, True))
+def test_create_pseudoreps_splits_every_tag(experiment, tmp_path,
+                                            split_tag_counts):
+    idrutils = IdrUtilities()
+    tag_dir = experiment['tag_dirs'][0]
+    pseudoreps = idrutils.create_pseudoreps(tag_dir, str(tmp_path), seed=1,
+                                    jobs=2, split_tag_counts=split_tag_counts)
+    tags, _ = read_tags(tag_dir)
+    split = [read_tags(d) for d in pseudoreps]
+    assert +add_counters(s[0] for s in split) == +tags
+    for pseudorep_tags, pseudorep_lines in split:
+        # Roughly half of the tags each
+        assert sum(pseudorep_tags.values()) \
+                == pytest.approx(sum(tags.values())/2, rel=0.05)
+        assert max(pseudorep_lines.values()) == 1
+
+    # tagInfo.txt counts what was written.
+    for d, (pseudorep_tags, _) in zip(pseudoreps, split):
+        positions, total = idrutils.read_tag_totals(d)
+        assert positions == len(+pseudorep_tags)
+        assert total == pytest.approx(sum(pseudorep_tags.values()))
+
+def test_create_pseudoreps_is_reproducible(experiment, tmp_path):
+    idrutils = IdrUtilities()
+    tag_dir = experiment['tag_dirs'][0]
+    splits = []
+    for jobs in (1, 3):
+        output_dir = tmp_path/str(jobs)
+        output_dir.mkdir()
+        splits.append([read_tags(d)[0] for d in idrutils.create_pseudoreps(
+                            tag_dir, str(output_dir), seed=5, jobs=jobs)])
+    assert splits[0] == splits[1]
+
+@pytest.mark.parametrize('split_tag_counts', (False, True))
+def test_create_pooled_pseudoreps_splits_every_tag(experiment, tmp_path,
+                                                   split_tag_counts):
+    idrutils = IdrUtilities()
+    pooled = idrutils.create_pooled_pseudoreps(experiment['tag_dirs'],
+                                str(tmp_path), 'Pooled', seed=1, jobs=2,
+                                split_tag_counts=split_tag_counts,
+                                sample_suffix='Pooling-Pseudorep')
+    sample_tags = [read_tags(d)[0] for d in experiment['tag_dirs']]
+    # Samples share positions, which pooling must collapse.
+    assert set(sample_tags[0]) & set(sample_tags[1])
+    tags = add_counters(sample_tags)
+    pooled_tags = [read_tags(d)[0] for d in pooled]
+    assert +add_counters(pooled_tags) == +tags
+    for pooled_dir in pooled:
+        pooled_tags_k, pooled_lines = read_tags(pooled_dir)
+        assert max(pooled_lines.values()) == 1
+        positions, _ = idrutils.read_tag_totals(pooled_dir)
+        assert positions == len(+pooled_tags_k)
+
+    # Each pooled pseudorep is the union of the samples' shares of it.
+    for k, pooled_dir in enumerate(pooled):
+        samples = [read_tags(os.path.join(str(tmp_path),
+                        os.path.basename(d) + '-Pooling-Pseudorep{}'.format(
+                                                                k + 1)))[0]
+                   for d in experiment['tag_dirs']]
+        assert +add_counters(samples) == +pooled_tags[k]
+        positions, total = idrutils.read_tag_totals(pooled_dir)
+        assert total == pytest.approx(sum(pooled_tags[k].values()))
+
+def test_convert_homer_peaks(experiment, tmp_path):
+    idrutils = IdrUtilities()
+    peak_file = experiment['peak_files'][0]
+    homer = idrutils.import_homer_peaks(peak_file)
+    output_file, count = idrutils.convert_homer_peaks(peak_file,
+                        str(tmp_path/'Rep1.narrowPeak'), with_count=True)
+    narrow = read_csv(output_file, sep='\t', header=None)
+    assert len(narrow) == count == len(homer)
+    assert list(narrow[3]) == list(homer['#PeakID'])
+    # Sorted by signal, with p-values as -log10
+    assert np.all(np.diff(narrow[6].values) <= 0)
+    assert np.allclose(narrow[7].values,
+                       -np.log10(homer['p-value vs Control'].values),
+                       rtol=1e-6)
+
+    columnar = idrutils.convert_homer_peaks(peak_file,
+                        str(tmp_path/'Rep1.narrowPeak') + ColumnarTable.extension)
+    ColumnarTable.to_text(columnar, str(tmp_path/'exported.narrowPeak'))
+    with open(output_file) as f, open(str(tmp_path/'exported.narrowPeak')) as g:
+        assert f.read() == g.read()
+
+def test_homer_to_narrow_peaks_keeps_p_values_apart():
+    # -log10 p-values that 32-bit floats would round to one value
+    p_values = 1e-100*(1 + np.arange(4)*1e-6)
+    data = DataFrame({'#PeakID': ['a', 'b', 'c', 'd'], 'chr': 'chr1',
+                      'start': [0, 100, 200, 300], 'end': [50, 150, 250, 350],
+                      'strand': '+', 'Normalized Tag Count': 10.0,
+                      'p-value vs Control': p_values})
+    narrow = IdrUtilities().homer_to_narrow_peaks(data)
+    assert list(narrow['name']) == ['a', 'b', 'c', 'd']
+    assert len(set(narrow['pValue'])) == 4
+
+@pytest.mark.parametrize('suffix', ('', '.gz'))
+def test_count_and_truncate_peaks(tmp_path, suffix):
+    idrutils = IdrUtilities()
+    peak_files = []
+    for rows in (5, 8):
+        peak_file = str(tmp_path/'peaks{}.narrowPeak{}'.format(rows, suffix))
+        with open_file(peak_file, 'w') as f:
+            f.write(''.join('chr1\t{}\t{}\tp{}\t0\t+\t{}\t-1\t-1\t-1\n'.format(
+                                        i*100, i*100 + 50, i, rows - i)
+                            for i in range(rows)))
+        peak_files.append(peak_file)
+    assert [idrutils.count_peaks(f) for f in peak_files] == [5, 8]
+
+    truncated = idrutils.standardize_peak_counts(peak_files, str(tmp_path))
+    assert [idrutils.count_peaks(f) for f in truncated] == [5, 5]
+    with open_file(truncated[1], 'r') as f, open_file(peak_files[1], 'r') as g:
+        assert f.read() == ''.join(g.readlines()[:5])
+
+def test_truncate_with_known_counts(tmp_path, monkeypatch):
+    idrutils = IdrUtilities()
+    peak_files = []
+    for rows in (5, 8):
+        peak_files.append(str(tmp_path/'peaks{}.narrowPeak'.format(rows)))
+        with open(peak_files[-1], 'w') as f:
+            f.write(''.join('chr1\t{}\t{}\tp{}\t0\t+\t1\t-1\t-1\t-1\n'\
+                            .format(i*100, i*100 + 50, i) for i in range(rows)))
+    counted = []
+    count_peaks = idrutils.count_peaks
+    monkeypatch.setattr(idrutils, 'count_peaks', 
+                        lambda f: counted.append(f) or count_peaks(f))
+    # Only files without a known count are read to count them.
+    truncated = idrutils.standardize_peak_counts(peak_files, str(tmp_path),
+                                                 counts=[None, 8])
+    assert counted == peak_files[:1]
+    assert [count_peaks(f) for f in truncated] == [5, 5]